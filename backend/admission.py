@@ -0,0 +1,231 @@
+"""
+Control de admisión: límites de tasa por usuario e IP y descarte por prioridad
+
+Cada petición pasa, antes de llegar a la ruta, por:
+
+1. Descarte por sobrecarga. El nivel de carga del worker es el mayor de
+   peticiones en curso / ADMISSION_MAX_IN_FLIGHT y retraso del event loop /
+   ADMISSION_TARGET_LAG_MS. Las rutas de prioridad baja (análisis,
+   exportación) se descartan a partir de ADMISSION_SHED_LOW, las normales a
+   partir de ADMISSION_SHED_NORMAL y las críticas (login, crear y calificar
+   actividades, estado de ánimo) nunca. Se responde 503 con Retry-After.
+2. Token buckets (tasa por segundo, ráfaga). Todas las peticiones pasan por el
+   de la IP y, si llevan token válido, por el del usuario. El login, el
+   registro y la renovación de tokens (bcrypt) tienen además uno por IP, y las
+   rutas de análisis uno por usuario. Se responde 429 con Retry-After.
+
+Los buckets viven en memoria del proceso (RATE_LIMIT_BACKEND=memory) o en un
+servidor compatible con Redis compartido por todos los workers
+(RATE_LIMIT_BACKEND=redis, RATE_LIMIT_REDIS_URL); RedisBuckets acepta
+cualquier cliente con la API de redis.asyncio. Si el backend compartido no
+responde, las peticiones pasan.
+
+Configuración por entorno:
+    ADMISSION_ENABLED        0 para desactivarlo (benchmarks de carga desde una sola IP)
+    RATE_LIMITS              JSON con [tasa, ráfaga] por bucket, p. ej. {"auth": [0.2, 5]}
+                             (buckets: ip, user, auth, analytics)
+    ADMISSION_TRUST_FORWARDED 1 para tomar la IP de X-Forwarded-For (detrás de un proxy)
+"""
+
+import json
+import logging
+import math
+import os
+import time
+
+from starlette.routing import Match
+
+import metrics
+
+logger = logging.getLogger("loveacts.admission")
+
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "1") == "1"
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_REDIS_URL = os.environ.get("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+RATE_LIMIT_DEFAULTS = {
+    "ip": (50, 200),
+    "user": (10, 60),
+    "auth": (0.2, 10),  # un login cada 5 s sostenido por IP
+    "analytics": (1, 15),
+}
+RATE_LIMITS = {**RATE_LIMIT_DEFAULTS, **{
+    name: tuple(limit) for name, limit in json.loads(os.environ.get("RATE_LIMITS", "{}")).items()
+}}
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", "100"))
+ADMISSION_TARGET_LAG_MS = float(os.environ.get("ADMISSION_TARGET_LAG_MS", "100"))
+ADMISSION_SHED_LOW = float(os.environ.get("ADMISSION_SHED_LOW", "0.6"))
+ADMISSION_SHED_NORMAL = float(os.environ.get("ADMISSION_SHED_NORMAL", "0.9"))
+ADMISSION_TRUST_FORWARDED = os.environ.get("ADMISSION_TRUST_FORWARDED", "0") == "1"
+
+CRITICAL, NORMAL, LOW = "critical", "normal", "low"
+SHED_THRESHOLDS = {LOW: ADMISSION_SHED_LOW, NORMAL: ADMISSION_SHED_NORMAL, CRITICAL: None}
+
+# Rutas que nunca pasan por el control de admisión
+EXEMPT_PATHS = ("/metrics", "/api/health")
+
+
+class MemoryBuckets:
+    """Token buckets en el proceso, con los menos usados descartados al pasar de max_keys"""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._buckets = {}  # clave -> (tokens, instante); orden de inserción = orden de uso
+
+    async def take(self, key, rate, burst):
+        """Consume un token; devuelve 0 si había o los segundos hasta que haya uno"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_keys:
+            del self._buckets[next(iter(self._buckets))]
+        return wait
+
+
+# Mismo algoritmo que MemoryBuckets, atómico en el servidor y con su reloj
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    """Token buckets compartidos entre workers en un servidor compatible con Redis"""
+
+    def __init__(self, client):
+        self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def take(self, key, rate, burst):
+        try:
+            return float(await self._script(keys=[key], args=[rate, burst]))
+        except Exception as e:  # sin backend compartido no se limita: mejor que rechazar todo
+            logger.warning("Backend de límites de tasa no disponible", extra={"error": str(e)})
+            return 0.0
+
+
+def create_buckets(backend=RATE_LIMIT_BACKEND):
+    if backend == "memory":
+        return MemoryBuckets()
+    if backend == "redis":
+        import redis.asyncio  # dependencia opcional, solo con el backend compartido
+        return RedisBuckets(redis.asyncio.Redis.from_url(RATE_LIMIT_REDIS_URL))
+    raise ValueError(f"RATE_LIMIT_BACKEND desconocido: {backend}")
+
+
+def route_template(scope):
+    """Plantilla de la ruta que atenderá la petición (el router aún no la ha resuelto)"""
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return None
+
+
+def client_ip(scope):
+    if ADMISSION_TRUST_FORWARDED:
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "-"
+
+
+class AdmissionMiddleware:
+    """Descarte por sobrecarga y límites de tasa antes de entrar a la ruta
+
+    identify(scope) devuelve el usuario verificado de la petición (o None).
+    priorities: {"POST /api/activities": CRITICAL, ...}; el resto es NORMAL.
+    auth_routes y analytics_routes ("METHOD /plantilla") tienen bucket propio.
+    """
+
+    def __init__(self, app, identify, priorities, auth_routes, analytics_routes, buckets=None):
+        self.app = app
+        self.identify = identify
+        self.priorities = priorities
+        self.auth_routes = set(auth_routes)
+        self.analytics_routes = set(analytics_routes)
+        self.buckets = buckets or create_buckets()
+        self.in_flight = 0
+
+    def overload(self):
+        level = max(self.in_flight / ADMISSION_MAX_IN_FLIGHT,
+                    metrics.event_loop_lag * 1000 / ADMISSION_TARGET_LAG_MS)
+        metrics.ADMISSION_OVERLOAD.set(level)
+        return level
+
+    async def check(self, scope, route):
+        """None si se admite; (status, motivo, Retry-After) si no"""
+        name = f"{scope['method']} {route}"
+        threshold = SHED_THRESHOLDS[self.priorities.get(name, NORMAL)]
+        if threshold is not None and self.overload() >= threshold:
+            return 503, "overload", 1
+
+        ip = client_ip(scope)
+        user_id = self.identify(scope)
+        buckets = [("ip", ip)]
+        if user_id is not None:
+            buckets.append(("user", user_id))
+        if name in self.auth_routes:
+            buckets.append(("auth", ip))
+        if name in self.analytics_routes:
+            buckets.append(("analytics", user_id or ip))
+
+        for bucket, identity in buckets:
+            rate, burst = RATE_LIMITS[bucket]
+            wait = await self.buckets.take(f"rl:{bucket}:{identity}", rate, burst)
+            if wait > 0:
+                return 429, f"rate_limit_{bucket}", max(1, math.ceil(wait))
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or not ADMISSION_ENABLED
+                or scope["path"].startswith(EXEMPT_PATHS)):
+            await self.app(scope, receive, send)
+            return
+
+        route = route_template(scope) or "unmatched"
+        rejection = await self.check(scope, route)
+        if rejection is not None:
+            status, reason, retry_after = rejection
+            metrics.ADMISSION_REJECTED.labels(route, reason).inc()
+            if status == 429:
+                body = b'{"detail":"Demasiadas peticiones, reintenta en unos segundos"}'
+            else:
+                body = b'{"detail":"Servidor sobrecargado, reintenta en unos segundos"}'
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(retry_after).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Exportación analítica de LoveActs a Parquet
+
+Vuelca las colecciones `activities` y `moods` de todas las parejas a archivos
+Parquet particionados por mes (month=YYYY-MM), leyendo los cursores de Mongo en
+bloques de tamaño fijo y escribiendo cada bloque como un RecordBatch de Arrow.
+La memoria queda acotada por --batch-size sin importar el tamaño de la colección.
+
+Las ejecuciones son incrementales: se guarda una marca de agua por colección en
+<output>/_watermarks.json (la última escritura exportada: created_at, o rated_at
+en las actividades calificadas) y la siguiente ejecución solo exporta documentos
+escritos después. Un documento que vuelve a exportarse (actividad calificada,
+mood cambiado en el día) reemplaza a su fila anterior: la partición mensual es
+la de created_at, que no cambia de mes, y al cerrar cada partición se quitan de
+los archivos de ejecuciones anteriores las filas con los mismos `id` (por
+bloques, sin cargar ni los archivos ni los ids en memoria).
+
+Uso:
+    python analytics_export.py --output ./analytics
+    python analytics_export.py --output ./analytics --collections moods --batch-size 20000
+    python analytics_export.py --output ./analytics --full
+"""
+
+import argparse
+import json
+import os
+import uuid
+from datetime import datetime, timezone
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+from pymongo import MongoClient, ASCENDING
+
+DEFAULT_BATCH_SIZE = 50_000
+WATERMARKS_FILE = "_watermarks.json"
+
+# Solo campos analíticos: se omiten textos libres (descripciones, comentarios, notas)
+EXPORT_SCHEMAS = {
+    "activities": pa.schema([
+        ("id", pa.string()),
+        ("user_id", pa.string()),
+        ("category", pa.string()),
+        ("time_of_day", pa.string()),
+        ("rating", pa.int8()),
+        ("is_pending_rating", pa.bool_()),
+        ("date", pa.string()),
+        ("created_at", pa.timestamp("ms", tz="UTC")),
+        ("rated_at", pa.timestamp("ms", tz="UTC")),
+    ]),
+    "moods": pa.schema([
+        ("id", pa.string()),
+        ("user_id", pa.string()),
+        ("mood_id", pa.string()),
+        ("date", pa.string()),
+        ("created_at", pa.timestamp("ms", tz="UTC")),
+    ]),
+}
+
+
+# Campos con la fecha de cada escritura: la marca de agua avanza con cualquiera de ellos
+CHANGE_FIELDS = {
+    "activities": ("created_at", "rated_at"),
+    "moods": ("created_at",),  # create_mood reescribe created_at
+}
+
+
+def load_watermarks(output_dir):
+    path = os.path.join(output_dir, WATERMARKS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        data = json.load(f)
+    return {name: datetime.fromisoformat(value) for name, value in data.items()}
+
+
+def save_watermarks(output_dir, watermarks):
+    path = os.path.join(output_dir, WATERMARKS_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({name: value.isoformat() for name, value in watermarks.items()}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _as_utc(value):
+    # pymongo devuelve datetimes naive en UTC
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+class MonthPartitionWriter:
+    """Escribe RecordBatches en <output>/<collection>/month=YYYY-MM/part-<run>.parquet
+
+    Los documentos llegan ordenados por created_at, así que solo hay un archivo
+    abierto a la vez. Se escribe con nombre oculto y se renombra al cerrar para
+    que los lectores nunca vean archivos a medio escribir. Al cerrar una
+    partición se quitan de sus archivos anteriores los ids recién escritos.
+    """
+
+    def __init__(self, output_dir, collection, schema, run_id, batch_size=DEFAULT_BATCH_SIZE):
+        self.base_dir = os.path.join(output_dir, collection)
+        self.schema = schema
+        self.run_id = run_id
+        self.batch_size = batch_size
+        self.month = None
+        self.writer = None
+        self.tmp_path = None
+        self.final_path = None
+        self.partition_dir = None
+        self.files = []
+
+    def write(self, month, batch):
+        if month != self.month:
+            self.close()
+            partition_dir = os.path.join(self.base_dir, f"month={month}")
+            os.makedirs(partition_dir, exist_ok=True)
+            self.final_path = os.path.join(partition_dir, f"part-{self.run_id}.parquet")
+            self.tmp_path = os.path.join(partition_dir, f".part-{self.run_id}.parquet.tmp")
+            self.writer = pq.ParquetWriter(self.tmp_path, self.schema, compression="zstd")
+            self.partition_dir = partition_dir
+            self.month = month
+        self.writer.write_batch(batch)
+
+    def _written_ids(self):
+        """ids de la parte recién escrita, por bloques de batch_size (solo se lee esa columna)"""
+        written = pq.ParquetFile(self.final_path)
+        for batch in written.iter_batches(batch_size=self.batch_size, columns=["id"]):
+            yield batch.column(0)
+
+    def _replaced(self, ids):
+        """Máscara de las filas con un id reescrito en esta ejecución"""
+        mask = None
+        for written in self._written_ids():
+            found = pc.is_in(ids, value_set=written)
+            mask = found if mask is None else pc.or_(mask, found)
+        return mask
+
+    def _replace_previous(self):
+        """Quita de los archivos de otras ejecuciones las filas reexportadas ahora
+
+        Se recorren por bloques tanto esos archivos como los ids de la parte
+        nueva: la memoria queda acotada por batch_size y no por la partición.
+        """
+        for name in sorted(os.listdir(self.partition_dir)):
+            path = os.path.join(self.partition_dir, name)
+            if not name.endswith(".parquet") or name.startswith(".") or path == self.final_path:
+                continue
+            previous = pq.ParquetFile(path)
+            if not any(
+                pc.any(self._replaced(batch.column(0))).as_py()
+                for batch in previous.iter_batches(batch_size=self.batch_size, columns=["id"])
+            ):
+                continue
+
+            tmp_path = os.path.join(self.partition_dir, f".{name}.tmp")
+            kept_rows = 0
+            with pq.ParquetWriter(tmp_path, previous.schema_arrow, compression="zstd") as writer:
+                for batch in previous.iter_batches(batch_size=self.batch_size):
+                    kept = batch.filter(pc.invert(self._replaced(batch.column("id"))))
+                    if kept.num_rows:
+                        writer.write_batch(kept)
+                        kept_rows += kept.num_rows
+            if kept_rows == 0:
+                os.remove(tmp_path)
+                os.remove(path)
+            else:
+                os.replace(tmp_path, path)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.tmp_path, self.final_path)
+            self.files.append(self.final_path)
+            self._replace_previous()
+        self.writer = None
+        self.month = None
+
+
+def export_collection(db, collection, output_dir, batch_size, since, until, run_id):
+    """Exporta los documentos escritos en (since, until]. Devuelve (filas, marca de agua, archivos)"""
+    schema = EXPORT_SCHEMAS[collection]
+    fields = schema.names
+    change_fields = CHANGE_FIELDS[collection]
+
+    written = {"$lte": until}
+    if since is not None:
+        written["$gt"] = since
+    query = {"$or": [{field: written} for field in change_fields]}
+
+    cursor = (
+        db[collection]
+        .find(query, {field: 1 for field in fields} | {"_id": 0})
+        .sort("created_at", ASCENDING)
+        .batch_size(batch_size)
+    )
+
+    writer = MonthPartitionWriter(output_dir, collection, schema, run_id, batch_size)
+    columns = {field: [] for field in fields}
+    pending = 0
+    pending_month = None
+    total_rows = 0
+    watermark = since
+
+    def flush():
+        nonlocal columns, pending
+        if pending:
+            writer.write(pending_month, pa.RecordBatch.from_pydict(columns, schema=schema))
+        columns = {field: [] for field in fields}
+        pending = 0
+
+    try:
+        for doc in cursor:
+            created_at = _as_utc(doc["created_at"])
+            month = created_at.strftime("%Y-%m")
+            # Cada RecordBatch pertenece a una sola partición mensual
+            if pending and (pending >= batch_size or month != pending_month):
+                flush()
+            pending_month = month
+
+            for field in fields:
+                value = doc.get(field)
+                if isinstance(value, datetime):
+                    value = _as_utc(value)
+                columns[field].append(value)
+            pending += 1
+            total_rows += 1
+            for field in change_fields:
+                changed_at = _as_utc(doc.get(field))
+                if changed_at is not None and changed_at <= until and (watermark is None or changed_at > watermark):
+                    watermark = changed_at
+        flush()
+    finally:
+        cursor.close()
+        writer.close()
+
+    return total_rows, watermark, writer.files
+
+
+def run_export(db, output_dir, collections=None, batch_size=DEFAULT_BATCH_SIZE, full=False):
+    """Ejecuta una exportación (incremental salvo full=True) y actualiza las marcas de agua"""
+    collections = collections or list(EXPORT_SCHEMAS)
+    os.makedirs(output_dir, exist_ok=True)
+
+    watermarks = {} if full else load_watermarks(output_dir)
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:6]
+    # Límite superior fijo: lo insertado durante la ejecución entra en la siguiente
+    until = datetime.now(timezone.utc)
+
+    summary = {"run_id": run_id, "collections": {}}
+    for collection in collections:
+        if collection not in EXPORT_SCHEMAS:
+            raise ValueError(f"Colección no exportable: {collection}")
+        for field in CHANGE_FIELDS[collection]:
+            db[collection].create_index([(field, ASCENDING)])
+
+        rows, watermark, files = export_collection(
+            db, collection, output_dir, batch_size,
+            since=watermarks.get(collection), until=until, run_id=run_id
+        )
+        if watermark is not None:
+            watermarks[collection] = watermark
+            # Se persiste tras cada colección para no repetir trabajo si la siguiente falla
+            save_watermarks(output_dir, watermarks)
+
+        summary["collections"][collection] = {
+            "rows": rows,
+            "files": files,
+            "watermark": watermark.isoformat() if watermark else None,
+        }
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta activities y moods a Parquet particionado por mes")
+    parser.add_argument("--output", required=True, help="Directorio de salida")
+    parser.add_argument("--collections", nargs="+", choices=list(EXPORT_SCHEMAS), default=None)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Documentos por RecordBatch (acota la memoria usada)")
+    parser.add_argument("--full", action="store_true", help="Ignora las marcas de agua y exporta todo")
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.environ.get('MONGO_URL', 'mongodb://localhost:27017'))
+    db = client[os.environ.get('DB_NAME', 'loveacts_expanded_db')]
+
+    try:
+        summary = run_export(db, args.output, args.collections, args.batch_size, args.full)
+    finally:
+        client.close()
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Efectos de las escrituras fuera de los handlers de la API (change streams)
+
+Los endpoints solo escriben. Lo que depende de esas escrituras (invalidar
+cachés, mantener los resúmenes de user_stats, notificar a la pareja) se
+registra con ChangeFeed.on() y corre por cada evento de cambio de las
+colecciones observadas, venga de la API o de una escritura directa en Mongo
+(importaciones, correcciones a mano).
+
+Los handlers locales (por defecto) corren en cada proceso que consume el feed:
+invalidan estado de ese proceso. Los exclusivos (exclusive=True) corren una
+sola vez: solo en el proceso que tiene el lease en change_feed_state, donde
+también se guarda el resume token para continuar tras un reinicio o un cambio
+de líder. La entrega es al menos una vez: tras una caída se repiten los
+eventos desde el último checkpoint (CHANGE_FEED_CHECKPOINT_SECONDS).
+
+Modos (CHANGE_FEED_MODE):
+    inline  (por defecto) Mongo standalone o motor en memoria, sin change
+            streams: los endpoints publican su propia escritura con written().
+            Los handlers locales corren en la petición (la respuesta ya ve las
+            cachés invalidadas) y los exclusivos en una tarea aparte, sin
+            retrasarla. Las escrituras directas en Mongo no disparan nada.
+    stream  requiere replica set. Cada worker abre un change stream en su
+            lifespan y el que consigue el lease corre además los exclusivos.
+            Con CHANGE_FEED_LEADER=0 los workers no lo piden y los exclusivos
+            quedan para un proceso aparte:
+
+    CHANGE_FEED_MODE=stream python change_feed.py   (desde backend/)
+
+Con varios workers y caché de vistas en memoria, cada worker invalida la suya
+con su propio stream; los borrados no se siguen (la API no borra actividades,
+estados de ánimo ni usuarios).
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+
+import metrics
+
+logger = logging.getLogger("loveacts.change_feed")
+
+CHANGE_FEED_MODE = os.environ.get("CHANGE_FEED_MODE", "inline")
+CHANGE_FEED_LEADER = os.environ.get("CHANGE_FEED_LEADER", "1") == "1"
+CHANGE_FEED_LEASE_SECONDS = float(os.environ.get("CHANGE_FEED_LEASE_SECONDS", "15"))
+CHANGE_FEED_CHECKPOINT_SECONDS = float(os.environ.get("CHANGE_FEED_CHECKPOINT_SECONDS", "1"))
+CHANGE_FEED_MAX_AWAIT_MS = 1000  # espera máxima de cada try_next: lo que tarda en notar stop()
+
+# ChangeStreamHistoryLost, ChangeStreamFatalError, InvalidResumeToken: el token ya no sirve
+RESUME_LOST_CODES = {260, 280, 286}
+
+if CHANGE_FEED_MODE not in ("inline", "stream"):
+    raise ValueError(f"CHANGE_FEED_MODE desconocido: {CHANGE_FEED_MODE}")
+
+
+class ChangeFeed:
+    """Despacha los eventos de cambio de collections a los handlers registrados
+
+    on_history_lost() se llama (en un hilo) si el resume token caducó y hubo
+    que empezar desde el presente: los exclusivos se perdieron esos eventos.
+    """
+
+    def __init__(self, database, collections, name="loveacts", on_history_lost=None):
+        self.database = database
+        self.collections = list(collections)
+        self.name = name
+        self.on_history_lost = on_history_lost
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.handlers = []  # (colección, operaciones, exclusivo, handler)
+        self.pending = set()  # handlers exclusivos de written() aún en curso
+        self._stopping = False
+        self._task = None
+
+    def on(self, collection, *operations, exclusive=False):
+        """Registra un handler async(change) para esas operaciones (insert, update, replace...)"""
+        def register(handler):
+            self.handlers.append((collection, set(operations), exclusive, handler))
+            return handler
+        return register
+
+    def _matching(self, change, local, exclusive):
+        collection, operation = change["ns"]["coll"], change["operationType"]
+        return [
+            handler for handler_collection, operations, handler_exclusive, handler in self.handlers
+            if handler_collection == collection and operation in operations
+            and (exclusive if handler_exclusive else local)
+        ]
+
+    async def dispatch(self, change, exclusive, local=True):
+        collection, operation = change["ns"]["coll"], change["operationType"]
+        if local:
+            metrics.CHANGE_FEED_EVENTS.labels(collection, operation).inc()
+        for handler in self._matching(change, local, exclusive):
+            try:
+                await handler(change)
+            except Exception:  # un handler roto no detiene el feed ni a los demás handlers
+                logger.exception("Error en handler del change feed", extra={
+                    "handler": handler.__name__, "collection": collection, "operation": operation,
+                })
+
+    async def written(self, collection, operation, document, updated_fields=None, context=None):
+        """Publica una escritura de la API en modo inline (en modo stream la entrega el change stream)
+
+        document es el documento tal como quedó (o al menos los campos que usan los
+        handlers); updated_fields, en las actualizaciones, los campos que se cambiaron.
+        context son datos que el endpoint ya tiene (el autor) y que los handlers
+        tendrían que leer si no; los eventos del change stream no lo llevan.
+        """
+        if CHANGE_FEED_MODE != "inline":
+            return
+        change = {
+            "operationType": operation,
+            "ns": {"coll": collection},
+            "documentKey": {"_id": document.get("_id")},
+            "fullDocument": document,
+        }
+        if operation == "update":
+            change["updateDescription"] = {"updatedFields": updated_fields or {}, "removedFields": []}
+        if context is not None:
+            change["context"] = context
+        await self.dispatch(change, exclusive=False)
+        if self._matching(change, local=False, exclusive=True):
+            task = asyncio.create_task(self.dispatch(change, exclusive=True, local=False))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+
+    async def drain(self, timeout=None):
+        """Espera a los handlers exclusivos que written() dejó en curso (y a los que estos publiquen)"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self.pending:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                logger.warning("Handlers del change feed sin terminar", extra={"pending": len(self.pending)})
+                return
+            await asyncio.wait(set(self.pending), timeout=remaining)
+
+    # Lease y resume token (un documento por feed en change_feed_state)
+
+    def _acquire_lease(self):
+        """Toma o renueva el lease; devuelve el estado guardado o None si lo tiene otro proceso"""
+        now = datetime.now(timezone.utc)
+        try:
+            return self.database.change_feed_state.find_one_and_update(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=CHANGE_FEED_LEASE_SECONDS)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            return None
+
+    def _save_position(self, token):
+        """Guarda el resume token si el lease sigue siendo nuestro"""
+        result = self.database.change_feed_state.update_one(
+            {"_id": self.name, "owner": self.owner},
+            {"$set": {"resume_token": token, "checkpoint_at": datetime.now(timezone.utc)}},
+        )
+        return result.matched_count == 1
+
+    def _release_lease(self):
+        self.database.change_feed_state.update_one(
+            {"_id": self.name, "owner": self.owner},
+            {"$set": {"expires_at": datetime.now(timezone.utc)}},
+        )
+
+    def _reset_position(self):
+        self.database.change_feed_state.update_one({"_id": self.name}, {"$unset": {"resume_token": ""}})
+        if self.on_history_lost is not None:
+            self.on_history_lost()
+
+    # Consumo
+
+    async def run(self, leader=CHANGE_FEED_LEADER):
+        """Consume el change stream hasta stop(); reabre el stream tras errores de Mongo"""
+        backoff = 1
+        while not self._stopping:
+            try:
+                state = await asyncio.to_thread(self._acquire_lease) if leader else None
+                await self._consume(state, leader)
+                backoff = 1
+            except PyMongoError as e:
+                if isinstance(e, OperationFailure) and e.code in RESUME_LOST_CODES:
+                    logger.error("Resume token caducado: el change feed sigue desde el presente",
+                                 extra={"feed": self.name, "error": str(e)})
+                    await asyncio.to_thread(self._reset_position)
+                    continue
+                logger.warning("Change feed interrumpido, se reintenta",
+                               extra={"feed": self.name, "error": str(e), "retry_in": backoff})
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    async def _consume(self, state, leader):
+        exclusive = state is not None
+        stream = await asyncio.to_thread(
+            self.database.watch,
+            [{"$match": {"ns.coll": {"$in": self.collections}}}],
+            full_document="updateLookup",
+            resume_after=state.get("resume_token") if exclusive else None,
+            max_await_time_ms=CHANGE_FEED_MAX_AWAIT_MS,
+        )
+        metrics.CHANGE_FEED_LEADER.set(1 if exclusive else 0)
+        logger.info("Change feed abierto", extra={"feed": self.name, "exclusive": exclusive})
+        # Posición hasta la que todo está procesado: nunca la de un evento a medio despachar
+        position = saved = state.get("resume_token") if exclusive else None
+        next_checkpoint = next_renewal = time.monotonic()
+        try:
+            while not self._stopping:
+                change = await asyncio.to_thread(stream.try_next)
+                if change is not None:
+                    metrics.CHANGE_FEED_LAG.observe(max(0.0, time.time() - change["clusterTime"].time))
+                    await self.dispatch(change, exclusive)
+                    position = change["_id"]
+                else:
+                    position = stream.resume_token
+
+                now = time.monotonic()
+                if exclusive and position != saved and now >= next_checkpoint:
+                    if not await asyncio.to_thread(self._save_position, position):
+                        logger.warning("Lease perdido", extra={"feed": self.name})
+                        return
+                    saved, next_checkpoint = position, now + CHANGE_FEED_CHECKPOINT_SECONDS
+                if leader and now >= next_renewal:
+                    # Seguidor que consigue el lease, o líder que lo perdió: reabrir en el otro papel
+                    if (await asyncio.to_thread(self._acquire_lease) is not None) != exclusive:
+                        return
+                    next_renewal = now + CHANGE_FEED_LEASE_SECONDS / 3
+        finally:
+            metrics.CHANGE_FEED_LEADER.set(0)
+            stream.close()
+            if exclusive:
+                try:
+                    if position != saved:
+                        self._save_position(position)
+                    if self._stopping:
+                        self._release_lease()  # el siguiente líder no espera a que caduque
+                except PyMongoError as e:
+                    logger.warning("No se pudo guardar la posición del change feed", extra={"error": str(e)})
+
+    def start(self, leader=CHANGE_FEED_LEADER):
+        self._stopping = False
+        self._task = asyncio.create_task(self.run(leader))
+        return self._task
+
+    async def stop(self, timeout=None):
+        """Termina el evento en curso, guarda la posición y suelta el lease (o espera a los de written())"""
+        self._stopping = True
+        if self._task is not None:
+            await asyncio.wait({self._task}, timeout=timeout)
+            self._task = None
+        await self.drain(timeout)
+
+
+async def run_standalone():
+    import server
+
+    if CHANGE_FEED_MODE != "stream":
+        raise SystemExit("Ejecutar con CHANGE_FEED_MODE=stream (requiere replica set)")
+    server.db.open()
+    task = server.changes.start(leader=True)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, lambda: asyncio.ensure_future(server.changes.stop()))
+    try:
+        await task
+    finally:
+        server.db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_standalone())
@@ -0,0 +1,404 @@
+"""
+Circuit breaker sobre MongoDB y modo degradado de solo lectura
+
+Un listener de pymongo alimenta el breaker con cada comando (fallo o
+lentitud) y con los heartbeats de los servidores; los errores que no llegan a
+ser comandos (sin servidor disponible, pool agotado) se anotan desde el
+manejador de excepciones de la app.
+
+    cerrado    todo pasa; se abre si en la ventana hay suficientes llamadas y
+               la proporción de fallos o de llamadas lentas supera el umbral,
+               o si ningún servidor responde al heartbeat
+    abierto    nada llega a la base de datos: los GET cacheables se sirven
+               desde la última respuesta buena (marcada como antigua) y el
+               resto recibe 503 con Retry-After
+    semiabierto pasado CIRCUIT_BREAKER_OPEN_SECONDS deja pasar unas pocas
+               peticiones de prueba: se cierra cuando todas llegan a Mongo sin
+               fallos y vuelve a abrirse si falla un comando. Una prueba que no
+               envía comandos (401, caché, 404) deja su hueco a otra petición,
+               y si las pruebas no terminan en CIRCUIT_BREAKER_OPEN_SECONDS
+               vuelve a abrirse con el contador a cero
+
+Configuración por entorno:
+    CIRCUIT_BREAKER_ENABLED        0 para desactivarlo (por defecto 1)
+    CIRCUIT_BREAKER_WINDOW_SECONDS ventana de observación (30)
+    CIRCUIT_BREAKER_MIN_CALLS      llamadas mínimas en la ventana para decidir (20)
+    CIRCUIT_BREAKER_FAILURE_RATE   proporción de fallos que lo abre (0.5)
+    CIRCUIT_BREAKER_SLOW_CALL_MS   a partir de cuántos ms una llamada es lenta (2000)
+    CIRCUIT_BREAKER_SLOW_CALL_RATE proporción de llamadas lentas que lo abre (0.8)
+    CIRCUIT_BREAKER_OPEN_SECONDS   tiempo abierto antes de probar de nuevo (15)
+    CIRCUIT_BREAKER_PROBES         peticiones de prueba en semiabierto (3)
+    STALE_CACHE_MAX_ENTRIES        respuestas guardadas para el modo degradado (5000)
+    STALE_CACHE_MAX_BYTES          bytes totales de esas respuestas (32 MiB)
+    STALE_CACHE_MAX_ENTRY_BYTES    respuestas más grandes no se guardan (256 KiB)
+    STALE_CACHE_MAX_AGE_SECONDS    antigüedad máxima de una respuesta servida (86400)
+"""
+
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from pymongo import monitoring
+
+import metrics
+
+logger = logging.getLogger("loveacts.circuit_breaker")
+
+CIRCUIT_BREAKER_ENABLED = os.environ.get("CIRCUIT_BREAKER_ENABLED", "1") == "1"
+CIRCUIT_BREAKER_WINDOW_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_WINDOW_SECONDS", "30"))
+CIRCUIT_BREAKER_MIN_CALLS = int(os.environ.get("CIRCUIT_BREAKER_MIN_CALLS", "20"))
+CIRCUIT_BREAKER_FAILURE_RATE = float(os.environ.get("CIRCUIT_BREAKER_FAILURE_RATE", "0.5"))
+CIRCUIT_BREAKER_SLOW_CALL_MS = float(os.environ.get("CIRCUIT_BREAKER_SLOW_CALL_MS", "2000"))
+CIRCUIT_BREAKER_SLOW_CALL_RATE = float(os.environ.get("CIRCUIT_BREAKER_SLOW_CALL_RATE", "0.8"))
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_OPEN_SECONDS", "15"))
+CIRCUIT_BREAKER_PROBES = int(os.environ.get("CIRCUIT_BREAKER_PROBES", "3"))
+STALE_CACHE_MAX_ENTRIES = int(os.environ.get("STALE_CACHE_MAX_ENTRIES", "5000"))
+STALE_CACHE_MAX_BYTES = int(os.environ.get("STALE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+STALE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("STALE_CACHE_MAX_ENTRY_BYTES", str(256 * 1024)))
+STALE_CACHE_MAX_AGE_SECONDS = float(os.environ.get("STALE_CACHE_MAX_AGE_SECONDS", "86400"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Rutas que nunca pasan por el breaker
+EXEMPT_PATHS = ("/metrics", "/api/health")
+
+
+class Probe:
+    """Petición de prueba en semiabierto; succeeded si alguno de sus comandos salió bien"""
+
+    __slots__ = ("epoch", "succeeded")
+
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self.succeeded = False
+
+
+# Prueba de la petición en curso: los comandos de pymongo corren en su contexto (también en to_thread)
+current_probe = contextvars.ContextVar("circuit_breaker_probe", default=None)
+
+
+class CircuitBreaker:
+    def __init__(self, window_seconds=CIRCUIT_BREAKER_WINDOW_SECONDS, min_calls=CIRCUIT_BREAKER_MIN_CALLS,
+                 failure_rate=CIRCUIT_BREAKER_FAILURE_RATE, slow_call_ms=CIRCUIT_BREAKER_SLOW_CALL_MS,
+                 slow_call_rate=CIRCUIT_BREAKER_SLOW_CALL_RATE, open_seconds=CIRCUIT_BREAKER_OPEN_SECONDS,
+                 probes=CIRCUIT_BREAKER_PROBES):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_ms = slow_call_ms
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.state = CLOSED
+        self._lock = threading.Lock()
+        self._calls = deque()  # (instante, falló, lenta)
+        self._opened_at = 0.0
+        self._half_opened_at = 0.0
+        self._epoch = 0  # cambia en cada paso a semiabierto: invalida las pruebas anteriores
+        self._probes_started = 0
+        self._probes_succeeded = 0
+        metrics.CIRCUIT_BREAKER_STATE.set(STATE_VALUES[CLOSED])
+
+    def _transition(self, state, reason):
+        # Con el lock tomado
+        if state == self.state:
+            return
+        logger.warning("Circuit breaker %s -> %s", self.state, state, extra={"reason": reason})
+        self.state = state
+        metrics.CIRCUIT_BREAKER_STATE.set(STATE_VALUES[state])
+        metrics.CIRCUIT_BREAKER_TRANSITIONS.labels(state).inc()
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        elif state == HALF_OPEN:
+            self._half_opened_at = time.monotonic()
+            self._epoch += 1
+            self._probes_started = self._probes_succeeded = 0
+        else:
+            self._calls.clear()
+
+    def allow(self):
+        """False si la petición no puede llegar a la base de datos
+
+        En semiabierto devuelve una Probe: la petición debe correr con ella en
+        current_probe y llamar a finish_probe() al terminar.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN and now - self._half_opened_at >= self.open_seconds:
+                self._transition(OPEN, "probe_timeout")
+            if self.state == OPEN and now - self._opened_at >= self.open_seconds:
+                self._transition(HALF_OPEN, "timeout")
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and self._probes_started < self.probes:
+                self._probes_started += 1
+                return Probe(self._epoch)
+            return False
+
+    def finish_probe(self, probe):
+        """Cuenta una prueba que llegó a Mongo; si no envió comandos, libera su hueco"""
+        with self._lock:
+            if self.state != HALF_OPEN or probe.epoch != self._epoch:
+                return
+            if not probe.succeeded:
+                self._probes_started -= 1
+                return
+            self._probes_succeeded += 1
+            if self._probes_succeeded >= self.probes:
+                self._transition(CLOSED, "probes_succeeded")
+
+    def retry_after(self):
+        """Segundos hasta el próximo intento (cabecera Retry-After)"""
+        with self._lock:
+            if self.state != OPEN:
+                return 1
+            return max(1, math.ceil(self.open_seconds - (time.monotonic() - self._opened_at)))
+
+    def record(self, failed, duration_ms=0.0):
+        now = time.monotonic()
+        slow = duration_ms >= self.slow_call_ms
+        probe = current_probe.get()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed or slow:
+                    self._transition(OPEN, "probe_failed")
+                elif probe is not None and probe.epoch == self._epoch:
+                    probe.succeeded = True  # se cuenta al terminar la petición (finish_probe)
+                return
+            if self.state == OPEN:
+                return  # llamadas que ya estaban en curso al abrirse
+
+            self._calls.append((now, failed, slow))
+            while self._calls and now - self._calls[0][0] > self.window_seconds:
+                self._calls.popleft()
+            calls = len(self._calls)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for _, call_failed, _ in self._calls if call_failed)
+            slow_calls = sum(1 for _, _, call_slow in self._calls if call_slow)
+            if failures / calls >= self.failure_rate:
+                self._transition(OPEN, "failure_rate")
+            elif slow_calls / calls >= self.slow_call_rate:
+                self._transition(OPEN, "slow_call_rate")
+
+    def trip(self, reason):
+        with self._lock:
+            if self.state != OPEN:
+                self._transition(OPEN, reason)
+
+
+# Códigos de error del servidor que indican un problema de disponibilidad (no de la consulta)
+UNAVAILABLE_CODES = {
+    6,      # HostUnreachable
+    7,      # HostNotFound
+    50,     # MaxTimeMSExpired
+    89,     # NetworkTimeout
+    91,     # ShutdownInProgress
+    189,    # PrimarySteppedDown
+    262,    # ExceededTimeLimit
+    10107,  # NotWritablePrimary
+    11600,  # InterruptedAtShutdown
+    11602,  # InterruptedDueToReplStateChange
+    13435,  # NotPrimaryNoSecondaryOk
+}
+
+
+def is_unavailable(failure):
+    """Un DuplicateKey o un filtro inválido es una respuesta del servidor, no un fallo de disponibilidad"""
+    if "errtype" in failure:
+        return True  # error de red o timeout del lado del cliente (pymongo no recibió respuesta)
+    return failure.get("code") in UNAVAILABLE_CODES
+
+
+class CircuitBreakerListener(monitoring.CommandListener, monitoring.ServerHeartbeatListener):
+    """Comandos y heartbeats de pymongo hacia el breaker"""
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self._heartbeats = {}  # dirección -> último heartbeat correcto
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if isinstance(event, monitoring.CommandSucceededEvent):
+            self.breaker.record(False, event.duration_micros / 1000)
+        else:
+            self._heartbeat(event.connection_id, True)
+
+    def failed(self, event):
+        if isinstance(event, monitoring.CommandFailedEvent):
+            self.breaker.record(is_unavailable(event.failure), event.duration_micros / 1000)
+        else:
+            self._heartbeat(event.connection_id, False)
+
+    def _heartbeat(self, address, ok):
+        with self._lock:
+            self._heartbeats[address] = ok
+            unreachable = not any(self._heartbeats.values())
+        if unreachable:
+            self.breaker.trip("heartbeat")
+
+
+class StaleCache:
+    """Últimas respuestas buenas por (usuario, ruta, query), LRU acotada por entradas y por bytes"""
+
+    def __init__(self, max_entries=STALE_CACHE_MAX_ENTRIES, max_age=STALE_CACHE_MAX_AGE_SECONDS,
+                 max_bytes=STALE_CACHE_MAX_BYTES, max_entry_bytes=STALE_CACHE_MAX_ENTRY_BYTES):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.used_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(key, headers, body):
+        # Aproximado: lo que domina es el cuerpo (en /api/me, la foto en base64)
+        return len(body) + len(key[1]) + len(key[2]) + sum(len(name) + len(value) for name, value in headers)
+
+    def _remove(self, key):
+        # Con el lock tomado
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.used_bytes -= entry[3]
+
+    def put(self, key, headers, body):
+        size = self._size(key, headers, body)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_entry_bytes:
+                return  # tampoco se conserva la versión anterior: ya no es la última buena
+            self._entries[key] = (time.time(), headers, body, size)
+            self.used_bytes += size
+            while len(self._entries) > self.max_entries or self.used_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.max_age:
+                self._remove(key)
+                return None
+            return entry
+
+
+breaker = CircuitBreaker()
+listener = CircuitBreakerListener(breaker)
+stale_cache = StaleCache()
+
+
+class CircuitBreakerMiddleware:
+    """Corta las peticiones con el breaker abierto y guarda las respuestas de los GET cacheables
+
+    identify(scope) devuelve el usuario verificado de la petición (o None);
+    cacheable_routes son plantillas de ruta ("/api/activities/daily/{date}").
+    """
+
+    def __init__(self, app, identify, cacheable_routes):
+        self.app = app
+        self.identify = identify
+        self.cacheable_routes = set(cacheable_routes)
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or not CIRCUIT_BREAKER_ENABLED
+                or scope["path"].startswith(EXEMPT_PATHS)):
+            await self.app(scope, receive, send)
+            return
+
+        key = None
+        if scope["method"] == "GET":
+            user_id = self.identify(scope)
+            if user_id is not None:
+                key = (user_id, scope["path"], scope.get("query_string", b""))
+
+        allowed = breaker.allow()
+        if not allowed:
+            entry = stale_cache.get(key) if key is not None else None
+            if entry is not None:
+                metrics.CIRCUIT_BREAKER_REJECTED.labels("stale").inc()
+                await self._send_stale(send, entry)
+            else:
+                metrics.CIRCUIT_BREAKER_REJECTED.labels("unavailable").inc()
+                await self._send_unavailable(send)
+            return
+
+        if isinstance(allowed, Probe):
+            token = current_probe.set(allowed)
+            try:
+                await self._forward(scope, receive, send, key)
+            finally:
+                current_probe.reset(token)
+                breaker.finish_probe(allowed)
+            return
+        await self._forward(scope, receive, send, key)
+
+    async def _forward(self, scope, receive, send, key):
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = None  # solo se guardan las respuestas 200 de rutas cacheables
+        chunks = []
+        size = 0
+
+        async def capture(message):
+            nonlocal headers, chunks, size
+            if message["type"] == "http.response.start":
+                # El router ya resolvió la ruta cuando empieza la respuesta
+                route = scope.get("route")
+                if message["status"] == 200 and route is not None and route.path in self.cacheable_routes:
+                    headers = [(name, value) for name, value in message["headers"]
+                               if name.lower() in (b"content-type", b"content-encoding")]
+            elif message["type"] == "http.response.body" and headers is not None:
+                chunks.append(message.get("body", b""))
+                size += len(chunks[-1])
+                if size > stale_cache.max_entry_bytes:
+                    # Demasiado grande para el modo degradado: se deja de acumular
+                    headers, chunks = None, []
+                    stale_cache.discard(key)
+                elif not message.get("more_body", False):
+                    stale_cache.put(key, headers, b"".join(chunks))
+            await send(message)
+
+        await self.app(scope, receive, capture)
+
+    async def _send_stale(self, send, entry):
+        stored_at, headers, body, _ = entry
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": headers + [
+                (b"content-length", str(len(body)).encode()),
+                (b"age", str(int(time.time() - stored_at)).encode()),
+                (b"x-data-stale", b"true"),
+                (b"warning", b'110 - "Response is Stale"'),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def _send_unavailable(self, send):
+        body = b'{"detail":"Servicio degradado: la base de datos no responde, reintenta en unos segundos"}'
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(breaker.retry_after()).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,198 @@
+"""
+Logging estructurado y no bloqueante
+
+Los handlers de la aplicación solo encolan el registro (QueueHandler); un hilo
+(QueueListener) lo formatea como JSON y lo escribe en stdout. Si stdout va
+lento, la cola se llena y se descartan registros en lugar de bloquear el
+event loop.
+
+Cada registro lleva request_id (cabecera X-Request-ID o generado) y, si hay
+traza activa, trace_id.
+
+Configuración por entorno:
+    LOG_LEVEL          nivel raíz (por defecto INFO)
+    LOG_LEVELS         niveles por módulo: "loveacts.query_budget=WARNING,uvicorn.access=WARNING"
+    LOG_SAMPLE_RATES   fracción de registros INFO/DEBUG a conservar por logger:
+                       "loveacts.notifications=0.1"
+    LOG_FORMAT         json (por defecto) o text
+    LOG_QUEUE_SIZE     registros pendientes antes de descartar (por defecto 10000)
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import uuid
+from datetime import datetime, timezone
+
+from starlette.datastructures import MutableHeaders
+
+import tracing
+
+current_request_id = contextvars.ContextVar("current_request_id", default=None)
+
+# Atributos estándar de LogRecord; el resto son campos extra del registro
+STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "trace_id"}
+
+
+def parse_mapping(value):
+    """'a=1,b=2' -> {'a': '1', 'b': '2'}"""
+    mapping = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        key, _, setting = item.partition("=")
+        mapping[key.strip()] = setting.strip()
+    return mapping
+
+
+class ContextFilter(logging.Filter):
+    """Añade request_id y trace_id en el hilo que emite el registro"""
+
+    def filter(self, record):
+        record.request_id = current_request_id.get()
+        trace = tracing.current_trace.get()
+        record.trace_id = f"{trace.trace_id:032x}" if trace is not None else None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Conserva solo una fracción de los mensajes INFO/DEBUG de loggers ruidosos"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = getattr(record, "sample_rate", None)
+        if rate is None:
+            name = record.name
+            while name and name not in self.rates:
+                name = name.rpartition(".")[0]
+            rate = self.rates.get(name)
+        return rate is None or random.random() < rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que descarta registros si la cola está llena"""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+    def prepare(self, record):
+        # Se resuelve el mensaje aquí (los args pueden cambiar) pero el formato JSON se hace en el listener
+        record = logging.makeLogRecord(record.__dict__)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if getattr(record, "trace_id", None):
+            entry["trace_id"] = record.trace_id
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_ATTRIBUTES and key != "sample_rate":
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+
+queue_listener = None
+queue_listener_pid = None
+
+
+def setup_logging():
+    """Instala el QueueHandler en el logger raíz y arranca el hilo que escribe
+
+    Tras un fork el hilo del padre no existe en el hijo: se vuelve a instalar.
+    """
+    global queue_listener, queue_listener_pid
+    if queue_listener is not None and queue_listener_pid == os.getpid():
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(TextFormatter() if os.environ.get("LOG_FORMAT") == "text" else JsonFormatter())
+
+    log_queue = queue.Queue(maxsize=int(os.environ.get("LOG_QUEUE_SIZE", "10000")))
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter(
+        {name: float(rate) for name, rate in parse_mapping(os.environ.get("LOG_SAMPLE_RATES", "")).items()}
+    ))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    for name, level in parse_mapping(os.environ.get("LOG_LEVELS", "")).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    queue_listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    queue_listener.start()
+    queue_listener_pid = os.getpid()
+
+
+def shutdown_logging():
+    """Vacía la cola pendiente; llamar al apagar el proceso"""
+    global queue_listener
+    if queue_listener is not None:
+        if queue_listener_pid == os.getpid():
+            queue_listener.stop()
+        queue_listener = None
+
+
+class RequestIdMiddleware:
+    """Asigna un request_id por petición (respeta X-Request-ID) y lo devuelve en la respuesta"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for key, value in scope["headers"]:
+            if key == b"x-request-id":
+                request_id = value.decode("latin-1")[:128]
+                break
+        request_id = request_id or uuid.uuid4().hex
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Request-ID", request_id)
+            await send(message)
+
+        token = current_request_id.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            current_request_id.reset(token)
@@ -0,0 +1,319 @@
+"""
+Métricas Prometheus de LoveActs
+
+- Latencia por ruta y peticiones en curso (middleware ASGI)
+- Duración de cada comando de Mongo por colección y comando (CommandListener)
+- Espera al obtener una conexión del pool de Mongo (ConnectionPoolListener)
+- Estado del circuit breaker de MongoDB y peticiones que corta
+- Peticiones rechazadas por límite de tasa o descartadas por sobrecarga, por ruta
+- Lecturas coalescidas (single-flight) por endpoint
+- Aciertos de la caché de vistas calculadas y memoria que ocupa
+- Eventos del change feed, su retraso y qué proceso tiene el lease
+- Notificaciones no leídas archivadas por antigüedad y contadores de no leídas corregidos
+- Retraso del event loop (tarea en segundo plano)
+
+Con varios workers, definir PROMETHEUS_MULTIPROC_DIR para agregar las
+métricas de todos los procesos en /metrics.
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+from pymongo import common, monitoring
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Buckets pensados para una API con respuestas de milisegundos
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "loveacts_http_request_duration_seconds",
+    "Latencia de las peticiones HTTP por ruta",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUESTS = Counter(
+    "loveacts_http_requests_total",
+    "Peticiones HTTP por ruta y código de estado",
+    ["method", "route", "status"],
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "loveacts_http_requests_in_flight",
+    "Peticiones HTTP en curso",
+    ["method"],
+    multiprocess_mode="livesum",
+)
+
+MONGO_COMMAND_DURATION = Histogram(
+    "loveacts_mongo_command_duration_seconds",
+    "Duración de los comandos de MongoDB",
+    ["collection", "command"],
+    buckets=LATENCY_BUCKETS,
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "loveacts_mongo_command_failures_total",
+    "Comandos de MongoDB fallidos",
+    ["collection", "command"],
+)
+
+MONGO_POOL_CHECKOUT_WAIT = Histogram(
+    "loveacts_mongo_pool_checkout_wait_seconds",
+    "Tiempo de espera para obtener una conexión del pool",
+    buckets=LATENCY_BUCKETS,
+)
+MONGO_POOL_CHECKOUT_FAILURES = Counter(
+    "loveacts_mongo_pool_checkout_failures_total",
+    "Intentos fallidos de obtener una conexión del pool",
+    ["reason"],
+)
+MONGO_POOL_CHECKED_OUT = Gauge(
+    "loveacts_mongo_pool_checked_out_connections",
+    "Conexiones del pool en uso",
+    multiprocess_mode="livesum",
+)
+
+CIRCUIT_BREAKER_STATE = Gauge(
+    "loveacts_circuit_breaker_state",
+    "Estado del circuit breaker de MongoDB (0 cerrado, 1 semiabierto, 2 abierto)",
+    multiprocess_mode="max",
+)
+CIRCUIT_BREAKER_TRANSITIONS = Counter(
+    "loveacts_circuit_breaker_transitions_total",
+    "Cambios de estado del circuit breaker",
+    ["state"],
+)
+CIRCUIT_BREAKER_REJECTED = Counter(
+    "loveacts_circuit_breaker_rejected_total",
+    "Peticiones atendidas sin base de datos con el breaker abierto (stale: desde caché, unavailable: 503)",
+    ["outcome"],
+)
+
+ADMISSION_REJECTED = Counter(
+    "loveacts_admission_rejected_total",
+    "Peticiones rechazadas por límite de tasa (429) o descartadas por sobrecarga (503)",
+    ["route", "reason"],
+)
+ADMISSION_OVERLOAD = Gauge(
+    "loveacts_admission_overload_ratio",
+    "Nivel de carga del worker usado para descartar peticiones (1 = capacidad máxima)",
+    multiprocess_mode="max",
+)
+
+SINGLE_FLIGHT = Counter(
+    "loveacts_single_flight_total",
+    "Lecturas coalescidas por endpoint (computed: consulta propia, joined: esperó otra en curso, cached: micro-caché)",
+    ["endpoint", "outcome"],
+)
+
+VIEW_CACHE = Counter(
+    "loveacts_view_cache_total",
+    "Consultas a la caché de vistas por vista (hit, miss, error: almacén no disponible)",
+    ["view", "outcome"],
+)
+VIEW_CACHE_BYTES = Gauge(
+    "loveacts_view_cache_bytes",
+    "Memoria usada por el almacén de la caché de vistas",
+    multiprocess_mode="liveall",
+)
+
+CHANGE_FEED_EVENTS = Counter(
+    "loveacts_change_feed_events_total",
+    "Eventos de cambio despachados por colección y operación",
+    ["collection", "operation"],
+)
+CHANGE_FEED_LAG = Histogram(
+    "loveacts_change_feed_lag_seconds",
+    "Tiempo entre la escritura en Mongo y su despacho en el change feed",
+    buckets=LATENCY_BUCKETS,
+)
+CHANGE_FEED_LEADER = Gauge(
+    "loveacts_change_feed_leader",
+    "Procesos con el lease del change feed (debería ser 1 con CHANGE_FEED_MODE=stream)",
+    multiprocess_mode="livesum",
+)
+
+NOTIFICATIONS_ARCHIVED = Counter(
+    "loveacts_notifications_archived_total",
+    "Notificaciones no leídas movidas a notifications_archive por antigüedad",
+)
+NOTIFICATION_COUNTERS_FIXED = Counter(
+    "loveacts_notification_counters_fixed_total",
+    "Contadores de no leídas que no coincidían con las notificaciones y se corrigieron",
+)
+
+EVENT_LOOP_LAG = Histogram(
+    "loveacts_event_loop_lag_seconds",
+    "Retraso del event loop respecto al intervalo esperado",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+def command_collection(event):
+    """Colección objetivo de un CommandStartedEvent ('-' para comandos de administración)"""
+    if event.command_name == "getMore":
+        return event.command.get("collection", "-")
+    target = event.command.get(event.command_name)
+    return target if isinstance(target, str) else "-"
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    def __init__(self):
+        # (connection_id, request_id) -> colección; succeeded/failed no traen el comando
+        self._pending = {}
+
+    def started(self, event):
+        self._pending[(event.connection_id, event.request_id)] = command_collection(event)
+
+    def succeeded(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), "-")
+        MONGO_COMMAND_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), "-")
+        MONGO_COMMAND_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(collection, event.command_name).inc()
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        # El inicio y el fin de un checkout ocurren en el mismo hilo
+        self._local = threading.local()
+        # Estado de cada pool (uno por servidor) de este proceso, para la sonda de readiness
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def _pool(self, address):
+        return self._pools.setdefault(address, {"max_size": None, "checked_out": 0, "waiting": 0})
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+        with self._lock:
+            self._pool(event.address)["waiting"] += 1
+
+    def _observe_wait(self, address):
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            MONGO_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+            self._local.started = None
+        with self._lock:
+            pool = self._pool(address)
+            pool["waiting"] = max(0, pool["waiting"] - 1)
+
+    def connection_checked_out(self, event):
+        self._observe_wait(event.address)
+        with self._lock:
+            self._pool(event.address)["checked_out"] += 1
+        MONGO_POOL_CHECKED_OUT.inc()
+
+    def connection_check_out_failed(self, event):
+        self._observe_wait(event.address)
+        MONGO_POOL_CHECKOUT_FAILURES.labels(str(event.reason)).inc()
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool["checked_out"] = max(0, pool["checked_out"] - 1)
+        MONGO_POOL_CHECKED_OUT.dec()
+
+    def pool_created(self, event):
+        with self._lock:
+            # options solo trae lo que difiere del valor por defecto del driver
+            self._pool(event.address)["max_size"] = event.options.get("maxPoolSize", common.MAX_POOL_SIZE)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        with self._lock:
+            self._pools.pop(event.address, None)
+
+    def saturation(self):
+        """Uso del pool más cargado: conexiones en uso / maxPoolSize y peticiones esperando"""
+        with self._lock:
+            pools = [dict(pool, address=f"{host}:{port}") for (host, port), pool in self._pools.items()]
+        busiest = {"address": None, "max_size": None, "checked_out": 0, "waiting": 0, "saturation": 0.0}
+        for pool in pools:
+            pool["saturation"] = pool["checked_out"] / pool["max_size"] if pool["max_size"] else 0.0
+            if (pool["saturation"], pool["waiting"]) > (busiest["saturation"], busiest["waiting"]):
+                busiest = pool
+        return busiest
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+
+class MetricsMiddleware:
+    """Middleware ASGI que mide cada petición etiquetada con la plantilla de la ruta"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.labels(method).inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.labels(method).dec()
+            # El router deja la ruta resuelta en el scope; sin ella no se etiqueta con la URL cruda
+            route = scope.get("route")
+            route_path = route.path if route is not None else "unmatched"
+            HTTP_REQUEST_DURATION.labels(method, route_path).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(method, route_path, str(status_code)).inc()
+
+
+# Media móvil del retraso del event loop de este proceso (la usa el control de admisión):
+# un pico aislado, como un hash de bcrypt, no cuenta como sobrecarga
+event_loop_lag = 0.0
+EVENT_LOOP_LAG_SMOOTHING = 0.2
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    global event_loop_lag
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        EVENT_LOOP_LAG.observe(lag)
+        event_loop_lag += EVENT_LOOP_LAG_SMOOTHING * (lag - event_loop_lag)
+
+
+def render_metrics():
+    """Devuelve (cuerpo, content-type) en formato de texto de Prometheus"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
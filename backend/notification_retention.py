@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Retención de notificaciones y contador de no leídas por usuario
+
+- Al marcarse como leídas se guarda read_at; un índice TTL las borra
+  NOTIFICATIONS_READ_TTL_DAYS después.
+- Las no leídas con más de NOTIFICATIONS_ARCHIVE_DAYS se mueven por lotes a
+  notifications_archive (archive_unread). También pasa a tener read_at cada
+  leída que no lo tenga (anteriores a este módulo), para que caduque.
+- notification_counters guarda {_id: user_id, unread, version, synced}. Lo
+  actualizan con $inc (upsert) quien crea notificaciones, quien las marca como
+  leídas y el archivado, siempre después de escribirlas. Un contador nuevo solo
+  tiene ese cambio: se fija contando las no leídas, y solo si ningún $inc subió
+  version mientras se contaba (si no, se repite).
+- reconcile_counters corrige los contadores que no coinciden con las no leídas
+  reales (un $inc que llegó entre la escritura de la notificación y el conteo).
+
+Cada NOTIFICATIONS_ARCHIVE_INTERVAL_SECONDS (0 lo desactiva) archiva y
+reconcilia un solo worker: el que toma el lease "notification_archiver" de
+job_leases, que dura el intervalo. También se puede lanzar a mano:
+
+    python notification_retention.py   (desde backend/)
+
+Varios procesos archivando a la vez no descuentan de más. Cada uno borra
+por _id solo las que siguen sin leer y descuenta lo que borró él.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import socket
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, OperationFailure, PyMongoError
+
+import metrics
+
+logger = logging.getLogger("loveacts.notifications")
+
+NOTIFICATIONS_READ_TTL_DAYS = float(os.environ.get("NOTIFICATIONS_READ_TTL_DAYS", "30"))
+NOTIFICATIONS_ARCHIVE_DAYS = float(os.environ.get("NOTIFICATIONS_ARCHIVE_DAYS", "90"))
+NOTIFICATIONS_ARCHIVE_BATCH = int(os.environ.get("NOTIFICATIONS_ARCHIVE_BATCH", "1000"))
+NOTIFICATIONS_ARCHIVE_INTERVAL_SECONDS = float(os.environ.get("NOTIFICATIONS_ARCHIVE_INTERVAL_SECONDS", "3600"))
+
+READ_TTL_INDEX = "read_at_ttl"
+ARCHIVER_LEASE = "notification_archiver"
+INDEX_OPTIONS_CONFLICT = 85
+
+
+def _create_index(db, keys, **options):
+    try:
+        db.notifications.create_index(keys, **options)
+        return True
+    except ConnectionFailure:
+        raise
+    except PyMongoError as e:
+        logger.error("Error creando índice", extra={"collection": "notifications", "keys": str(keys), "error": str(e)})
+        return False
+
+
+def ensure_indexes(db):
+    """Crea los índices de notificaciones; si uno falla se siguen creando los demás
+
+    Devuelve si se crearon todos. Sin conexión a Mongo lanza ConnectionFailure.
+    """
+    ttl = int(NOTIFICATIONS_READ_TTL_DAYS * 86400)
+    created = True
+    try:
+        try:
+            db.notifications.create_index("read_at", expireAfterSeconds=ttl, name=READ_TTL_INDEX)
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            # El índice ya existía con otro NOTIFICATIONS_READ_TTL_DAYS: se cambia sin reconstruirlo
+            db.command("collMod", "notifications", index={"name": READ_TTL_INDEX, "expireAfterSeconds": ttl})
+    except ConnectionFailure:
+        raise
+    except PyMongoError as e:
+        logger.error("Error creando índice", extra={"collection": "notifications", "keys": "read_at", "error": str(e)})
+        created = False
+    # Listado de la API: las últimas del usuario
+    created = _create_index(db, [("user_id", ASCENDING), ("created_at", DESCENDING)]) and created
+    # Archivado: las no leídas más antiguas
+    created = _create_index(db, [("read", ASCENDING), ("created_at", ASCENDING)]) and created
+    return created
+
+
+# Contador de no leídas
+
+def _sync_counter(db, user_id, attempts=3):
+    """Fija el contador a las no leídas reales; devuelve el valor o None si otras escrituras lo movían"""
+    for _ in range(attempts):
+        counter = db.notification_counters.find_one({"_id": user_id})
+        unread = db.notifications.count_documents({"user_id": user_id, "read": False})
+        if counter is None:
+            try:
+                db.notification_counters.insert_one({"_id": user_id, "unread": unread, "version": 0, "synced": True})
+                return unread
+            except DuplicateKeyError:
+                continue  # lo creó a la vez un $inc
+        # version: ningún $inc llegó mientras se contaba (la base ya incluye los anteriores)
+        result = db.notification_counters.update_one(
+            {"_id": user_id, "version": counter.get("version")},
+            {"$set": {"unread": unread, "synced": True}, "$inc": {"version": 1}},
+        )
+        if result.modified_count:
+            return unread
+    return None
+
+
+def add_unread(db, user_id, amount):
+    """Suma amount (negativo al leer o archivar) al contador; llamar después de escribir las notificaciones"""
+    result = db.notification_counters.update_one(
+        {"_id": user_id}, {"$inc": {"unread": amount, "version": 1}}, upsert=True
+    )
+    if result.upserted_id is not None:
+        _sync_counter(db, user_id)  # contador nuevo: le falta lo que había antes de este cambio
+
+
+def unread_count(db, user_id):
+    counter = db.notification_counters.find_one({"_id": user_id})
+    if counter is None or not counter.get("synced"):
+        unread = _sync_counter(db, user_id)
+        if unread is None:
+            unread = db.notifications.count_documents({"user_id": user_id, "read": False})
+        return unread
+    # Un negativo solo puede ser momentáneo (entre una escritura y su $inc); reconcile_counters lo corrige
+    return max(0, counter["unread"])
+
+
+def _reconcile_batch(db, counters):
+    counts = {
+        row["_id"]: row["unread"]
+        for row in db.notifications.aggregate([
+            {"$match": {"user_id": {"$in": [counter["_id"] for counter in counters]}, "read": False}},
+            {"$group": {"_id": "$user_id", "unread": {"$sum": 1}}},
+        ])
+    }
+    fixed = 0
+    for counter in counters:
+        unread = counts.get(counter["_id"], 0)
+        if counter.get("unread") == unread and counter.get("synced"):
+            continue
+        # Si un $inc llegó después de leer el contador, se deja para la próxima pasada
+        result = db.notification_counters.update_one(
+            {"_id": counter["_id"], "version": counter.get("version")},
+            {"$set": {"unread": unread, "synced": True}, "$inc": {"version": 1}},
+        )
+        fixed += result.modified_count
+    return fixed
+
+
+def reconcile_counters(db, batch_size=NOTIFICATIONS_ARCHIVE_BATCH):
+    """Corrige los contadores que no coinciden con las no leídas reales; devuelve cuántos cambió"""
+    fixed = 0
+    batch = []
+    for counter in db.notification_counters.find({}).sort("_id", ASCENDING):
+        batch.append(counter)
+        if len(batch) >= batch_size:
+            fixed += _reconcile_batch(db, batch)
+            batch = []
+    if batch:
+        fixed += _reconcile_batch(db, batch)
+    metrics.NOTIFICATION_COUNTERS_FIXED.inc(fixed)
+    return fixed
+
+
+def mark_read(db, user_id, notification_id=None):
+    """Marca como leída una notificación, o todas las del usuario; devuelve cuántas estaban sin leer"""
+    query = {"user_id": user_id, "read": False}
+    update = {"$set": {"read": True, "read_at": datetime.now(timezone.utc)}}
+    if notification_id is None:
+        result = db.notifications.update_many(query, update)
+    else:
+        result = db.notifications.update_one({**query, "id": notification_id}, update)
+    if result.modified_count:
+        add_unread(db, user_id, -result.modified_count)
+    return result.modified_count
+
+
+# Archivado
+
+def archive_unread(db, older_than_days=NOTIFICATIONS_ARCHIVE_DAYS, batch_size=NOTIFICATIONS_ARCHIVE_BATCH):
+    """Mueve a notifications_archive las no leídas más antiguas que older_than_days; devuelve cuántas"""
+    now = datetime.now(timezone.utc)
+    db.notifications.update_many({"read": True, "read_at": {"$exists": False}}, {"$set": {"read_at": now}})
+
+    cutoff = now - timedelta(days=older_than_days)
+    archived = 0
+    while True:
+        batch = list(db.notifications.find({"read": False, "created_at": {"$lt": cutoff}})
+                     .sort("created_at", ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        try:
+            db.notifications_archive.insert_many([{**doc, "archived_at": now} for doc in batch], ordered=False)
+        except BulkWriteError as e:
+            # Duplicadas: ya las copió otro proceso o un intento anterior que no llegó a borrarlas
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+        by_user = defaultdict(list)
+        for doc in batch:
+            by_user[doc["user_id"]].append(doc["_id"])
+        for user_id, ids in by_user.items():
+            deleted = db.notifications.delete_many({"_id": {"$in": ids}, "read": False}).deleted_count
+            if deleted:
+                add_unread(db, user_id, -deleted)
+                archived += deleted
+        if len(batch) < batch_size:
+            break
+
+    metrics.NOTIFICATIONS_ARCHIVED.inc(archived)
+    return archived
+
+
+def claim_archiver_run(db, interval, owner):
+    """Toma el lease del archivado para este intervalo; False si otro worker ya lo tiene"""
+    now = datetime.now(timezone.utc)
+    try:
+        return db.job_leases.find_one_and_update(
+            {"_id": ARCHIVER_LEASE, "expires_at": {"$lt": now}},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=interval)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        ) is not None
+    except DuplicateKeyError:
+        return False
+
+
+async def run_archiver(db, interval=NOTIFICATIONS_ARCHIVE_INTERVAL_SECONDS):
+    """Archiva y reconcilia periódicamente en un hilo, solo en el worker que toma el lease
+
+    El primer intervalo es aleatorio para que los workers no compitan a la vez por el lease.
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    delay = random.uniform(0, interval)
+    while True:
+        await asyncio.sleep(delay)
+        delay = interval
+        try:
+            if not await asyncio.to_thread(claim_archiver_run, db, interval, owner):
+                continue
+            archived = await asyncio.to_thread(archive_unread, db)
+            fixed = await asyncio.to_thread(reconcile_counters, db)
+        except PyMongoError as e:
+            logger.warning("No se pudieron archivar notificaciones", extra={"error": str(e)})
+            continue
+        if archived or fixed:
+            logger.info("Notificaciones archivadas", extra={"archived": archived, "counters_fixed": fixed})
+
+
+if __name__ == "__main__":
+    import server
+
+    server.db.open()
+    try:
+        ensure_indexes(server.db)
+        print(f"Archivadas: {archive_unread(server.db)}")
+        print(f"Contadores corregidos: {reconcile_counters(server.db)}")
+    finally:
+        server.db.close()
@@ -0,0 +1,115 @@
+"""
+Perfilado bajo demanda del worker en ejecución
+
+- CPU: muestreo de las pilas de todos los hilos (sys._current_frames) durante
+  un tiempo acotado. El resultado está en formato "collapsed stacks"
+  (una línea "marco;marco;marco conteo"), listo para flamegraph.pl o speedscope.
+- Memoria: tracemalloc con instantáneas y diferencias respecto a una base.
+
+Sin perfil activo no hay hilos, hooks ni trazas: el coste es cero.
+"""
+
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+MAX_CPU_PROFILE_SECONDS = 60
+
+# Funciones hoja en las que un hilo está esperando, no usando CPU
+IDLE_FUNCTIONS = {"select", "poll", "wait", "_worker", "accept", "sleep"}
+
+cpu_profile_lock = threading.Lock()
+memory_lock = threading.Lock()
+memory_baseline = None
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_cpu(seconds: float, interval: float, include_idle: bool = False) -> str:
+    """Muestrea las pilas de todos los hilos y devuelve las pilas colapsadas
+
+    Bloquea durante `seconds`: llamarlo desde un hilo, nunca desde el event loop.
+    """
+    own_thread = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            if not include_idle and frame.f_code.co_name in IDLE_FUNCTIONS:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(thread_names.get(thread_id, str(thread_id)))
+            stacks[";".join(reversed(labels))] += 1
+        time.sleep(interval)
+
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def start_memory_tracing(frames: int = 10):
+    global memory_baseline
+    with memory_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        memory_baseline = tracemalloc.take_snapshot()
+
+
+def stop_memory_tracing():
+    global memory_baseline
+    with memory_lock:
+        tracemalloc.stop()
+        memory_baseline = None
+
+
+def _filtered(snapshot):
+    return snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+
+
+def _stat_entry(stat, group_by):
+    frames = stat.traceback.format() if group_by == "traceback" else [str(stat.traceback[0])]
+    return {
+        "location": frames,
+        "size_bytes": stat.size,
+        "count": stat.count,
+        "size_diff_bytes": getattr(stat, "size_diff", None),
+        "count_diff": getattr(stat, "count_diff", None),
+    }
+
+
+def memory_snapshot(limit: int = 25, group_by: str = "lineno", reset_baseline: bool = False) -> dict:
+    """Mayores asignaciones actuales y crecimiento desde la base. Costoso: llamarlo en un hilo"""
+    global memory_baseline
+    with memory_lock:
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc no está activo")
+
+        snapshot = _filtered(tracemalloc.take_snapshot())
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            "traced_current_bytes": current,
+            "traced_peak_bytes": peak,
+            "top": [_stat_entry(stat, group_by) for stat in snapshot.statistics(group_by)[:limit]],
+            "growth": [],
+        }
+        if memory_baseline is not None:
+            diff = snapshot.compare_to(_filtered(memory_baseline), group_by)
+            result["growth"] = [_stat_entry(stat, group_by) for stat in diff[:limit] if stat.size_diff > 0]
+        if reset_baseline or memory_baseline is None:
+            memory_baseline = snapshot
+        return result
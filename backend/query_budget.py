@@ -0,0 +1,172 @@
+"""
+Presupuesto de consultas a MongoDB por petición y detector de N+1
+
+Un CommandListener cuenta y cronometra cada comando dentro del contexto de
+la petición que lo emite. Al terminar la petición se registra un log con el
+número de consultas y el tiempo en la base de datos, y se avisa si la ruta
+supera su presupuesto o repite la misma forma de consulta muchas veces
+(síntoma típico de consultas dentro de un bucle).
+
+Configuración por entorno:
+    QUERY_BUDGET_DEFAULT   consultas permitidas por petición (por defecto 15)
+    QUERY_BUDGETS          JSON {"GET /api/stats/correlation": 70, "/api/achievements": 10}
+    QUERY_BUDGET_MODE      warn (por defecto), raise (para tests) u off
+    N_PLUS_ONE_THRESHOLD   repeticiones de una misma forma para avisar (por defecto 5)
+    QUERY_DEBUG_HEADERS    1 para añadir X-DB-Query-Count y X-DB-Time-Ms a las respuestas
+"""
+
+import contextvars
+import json
+import logging
+import os
+
+from pymongo import monitoring
+from starlette.datastructures import MutableHeaders
+
+logger = logging.getLogger("loveacts.query_budget")
+
+QUERY_BUDGET_DEFAULT = int(os.environ.get("QUERY_BUDGET_DEFAULT", "15"))
+QUERY_BUDGETS = json.loads(os.environ.get("QUERY_BUDGETS", "{}"))
+QUERY_BUDGET_MODE = os.environ.get("QUERY_BUDGET_MODE", "warn")
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("N_PLUS_ONE_THRESHOLD", "5"))
+QUERY_DEBUG_HEADERS = os.environ.get("QUERY_DEBUG_HEADERS", "0") == "1"
+
+# Dónde está el filtro de cada comando, para calcular la forma de la consulta
+FILTER_FIELDS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+}
+
+
+class QueryBudgetExceeded(Exception):
+    """Se lanza en modo raise para que los tests fallen ante regresiones"""
+
+
+class QueryStats:
+    __slots__ = ("count", "time_micros", "shapes", "pending", "scope")
+
+    def __init__(self, scope=None):
+        self.scope = scope  # scope ASGI de la petición (la ruta se resuelve al enrutar)
+        self.count = 0
+        self.time_micros = 0
+        self.shapes = {}
+        self.pending = {}
+
+    @property
+    def time_ms(self):
+        return self.time_micros / 1000
+
+
+current_query_stats = contextvars.ContextVar("current_query_stats", default=None)
+
+
+def query_shape(command_name, command):
+    """Comando, colección y campos filtrados, sin valores: 'find activities [date,user_id]'"""
+    target = command.get(command_name)
+    collection = target if isinstance(target, str) else command.get("collection", "-")
+
+    query = None
+    if command_name in FILTER_FIELDS:
+        query = command.get(FILTER_FIELDS[command_name])
+    elif command_name == "aggregate":
+        pipeline = command.get("pipeline") or [{}]
+        query = pipeline[0].get("$match")
+    elif command_name in ("update", "delete"):
+        statements = command.get("updates") or command.get("deletes") or [{}]
+        query = statements[0].get("q")
+
+    keys = ",".join(sorted(query)) if isinstance(query, dict) else ""
+    return f"{command_name} {collection} [{keys}]"
+
+
+class QueryBudgetListener(monitoring.CommandListener):
+    """Acumula los comandos en las QueryStats de la petición en curso"""
+
+    def started(self, event):
+        stats = current_query_stats.get()
+        if stats is not None:
+            stats.pending[(event.connection_id, event.request_id)] = query_shape(event.command_name, event.command)
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        stats = current_query_stats.get()
+        if stats is None:
+            return
+        shape = stats.pending.pop((event.connection_id, event.request_id), None)
+        if shape is None:
+            return
+        stats.count += 1
+        stats.time_micros += event.duration_micros
+        stats.shapes[shape] = stats.shapes.get(shape, 0) + 1
+
+
+def route_budget(method, route_path):
+    return QUERY_BUDGETS.get(f"{method} {route_path}", QUERY_BUDGETS.get(route_path, QUERY_BUDGET_DEFAULT))
+
+
+class QueryBudgetMiddleware:
+    """Middleware ASGI que abre unas QueryStats por petición y evalúa el presupuesto"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or QUERY_BUDGET_MODE == "off":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats(scope)
+        token = current_query_stats.set(stats)
+
+        async def send_with_headers(message):
+            if QUERY_DEBUG_HEADERS and message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("X-DB-Query-Count", str(stats.count))
+                headers.append("X-DB-Time-Ms", f"{stats.time_ms:.2f}")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            current_query_stats.reset(token)
+
+        self.report(scope, stats)
+
+    def report(self, scope, stats):
+        route = scope.get("route")
+        if route is None:
+            return
+        method = scope["method"]
+        fields = {
+            "route": route.path,
+            "method": method,
+            "query_count": stats.count,
+            "db_time_ms": round(stats.time_ms, 2),
+        }
+        logger.info(
+            "db_queries %s %s count=%d db_time_ms=%.2f",
+            method, route.path, stats.count, stats.time_ms, extra=fields
+        )
+
+        problems = []
+        budget = route_budget(method, route.path)
+        if stats.count > budget:
+            problems.append(f"{stats.count} consultas superan el presupuesto de {budget}")
+        for shape, repeats in stats.shapes.items():
+            if repeats >= N_PLUS_ONE_THRESHOLD:
+                problems.append(f"posible N+1: '{shape}' repetida {repeats} veces")
+
+        for problem in problems:
+            logger.warning(
+                "query_budget %s %s: %s", method, route.path, problem,
+                extra={**fields, "budget": budget, "problem": problem}
+            )
+        if problems and QUERY_BUDGET_MODE == "raise":
+            raise QueryBudgetExceeded(f"{method} {route.path}: " + "; ".join(problems))
@@ -0,0 +1,108 @@
+"""
+Lecturas de análisis en secundarios con read-your-writes
+
+Los endpoints de análisis (recuerdos, correlación, logros) toleran datos algo
+atrasados y leen con ANALYTICS_READ_PREFERENCE (secondaryPreferred por
+defecto) y ANALYTICS_MAX_STALENESS_SECONDS; el resto de endpoints sigue
+leyendo del primario.
+
+Para que cada uno vea sus propias escrituras aunque la lectura vaya a un
+secundario, las escrituras que alimentan esas vistas se hacen en una sesión
+causal (write_session) y su clusterTime/operationTime se guarda para el
+usuario y su pareja. La siguiente lectura de análisis de cualquiera de los
+dos abre una sesión causal avanzada hasta ese punto (read_session): el
+secundario espera a haber replicado la escritura antes de responder
+(afterClusterTime).
+
+Los tokens viven en el proceso y caducan tras CAUSAL_TOKEN_TTL_SECONDS (por
+defecto, el máximo retraso permitido). Con varios workers, una escritura
+atendida por otro worker solo queda acotada por maxStalenessSeconds.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from pymongo import read_preferences
+
+ANALYTICS_READ_PREFERENCE = os.environ.get("ANALYTICS_READ_PREFERENCE", "secondaryPreferred")
+# Mongo exige al menos 90 s; 0 desactiva el límite
+ANALYTICS_MAX_STALENESS_SECONDS = int(os.environ.get("ANALYTICS_MAX_STALENESS_SECONDS", "90"))
+CAUSAL_TOKEN_TTL_SECONDS = float(os.environ.get(
+    "CAUSAL_TOKEN_TTL_SECONDS", str(ANALYTICS_MAX_STALENESS_SECONDS or 300)
+))
+
+READ_PREFERENCES = {
+    "primaryPreferred": read_preferences.PrimaryPreferred,
+    "secondary": read_preferences.Secondary,
+    "secondaryPreferred": read_preferences.SecondaryPreferred,
+    "nearest": read_preferences.Nearest,
+}
+
+
+def analytics_read_preference():
+    if ANALYTICS_READ_PREFERENCE == "primary":
+        return read_preferences.Primary()
+    if ANALYTICS_READ_PREFERENCE not in READ_PREFERENCES:
+        raise ValueError(f"ANALYTICS_READ_PREFERENCE desconocida: {ANALYTICS_READ_PREFERENCE}")
+    return READ_PREFERENCES[ANALYTICS_READ_PREFERENCE](max_staleness=ANALYTICS_MAX_STALENESS_SECONDS or -1)
+
+
+class CausalTokens:
+    """Último (clusterTime, operationTime) escrito que afecta a cada usuario"""
+
+    def __init__(self, ttl=CAUSAL_TOKEN_TTL_SECONDS):
+        self.ttl = ttl
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def record(self, session, *user_ids):
+        if session.operation_time is None:
+            return  # standalone o motor en memoria: no hay secundarios que esperar
+        token = (session.cluster_time, session.operation_time, time.monotonic() + self.ttl)
+        with self._lock:
+            for user_id in user_ids:
+                if user_id:
+                    self._tokens[user_id] = token
+
+    def get(self, user_id):
+        with self._lock:
+            token = self._tokens.get(user_id)
+            if token is not None and token[2] <= time.monotonic():
+                del self._tokens[user_id]
+                token = None
+            # Limpieza ocasional para que no crezca con usuarios que no vuelven a leer
+            if len(self._tokens) > 10_000:
+                now = time.monotonic()
+                self._tokens = {key: value for key, value in self._tokens.items() if value[2] > now}
+        return token
+
+
+tokens = CausalTokens()
+
+
+@contextmanager
+def write_session(database, *user_ids):
+    """Sesión causal para una escritura; al terminar sin error, registra su punto para user_ids"""
+    with database.client.start_session(causal_consistency=True) as session:
+        yield session
+        tokens.record(session, *user_ids)
+
+
+@contextmanager
+def read_session(database, user_id):
+    """Sesión causal que no lee nada anterior a la última escritura registrada para user_id
+
+    Sin escrituras recientes devuelve None: la lectura va al secundario sin esperar.
+    """
+    token = tokens.get(user_id)
+    if token is None:
+        yield None
+        return
+    cluster_time, operation_time, _ = token
+    with database.client.start_session(causal_consistency=True) as session:
+        if cluster_time is not None:
+            session.advance_cluster_time(cluster_time)
+        session.advance_operation_time(operation_time)
+        yield session
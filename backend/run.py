@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Arranque de producción de la API con varios workers
+
+Cada worker importa la app después del fork y abre en su lifespan el cliente
+de Mongo, los monitores y los hilos de exportación; al apagar deja de aceptar
+conexiones, termina las peticiones y notificaciones en curso y cierra el pool.
+
+Con gunicorn instalado se usa como supervisor (workers UvicornWorker):
+    kill -HUP <pid del master>    recarga sin cortes: arranca workers con el código
+                                  nuevo y apaga los viejos de forma ordenada
+Sin gunicorn, o con --server uvicorn, se usa el supervisor de uvicorn.
+
+Configuración por entorno:
+    HOST, PORT               dirección de escucha (0.0.0.0:8001)
+    WEB_CONCURRENCY          número de workers (por defecto, núcleos disponibles)
+    GRACEFUL_TIMEOUT         segundos para terminar lo que está en curso al apagar (30)
+    KEEPALIVE                segundos de keep-alive HTTP (5)
+    PROMETHEUS_MULTIPROC_DIR directorio de métricas compartido; se crea uno
+                             temporal si hay varios workers y no se define
+
+Uso (desde backend/):
+    python run.py
+    WEB_CONCURRENCY=8 python run.py --server uvicorn
+"""
+
+import argparse
+import glob
+import logging
+import math
+import os
+import tempfile
+
+import logging_config
+
+logger = logging.getLogger("loveacts.run")
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def available_cpus():
+    """Núcleos utilizables: afinidad del proceso y cuota de CPU del cgroup (contenedores)"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def worker_count():
+    workers = int(os.environ.get("WEB_CONCURRENCY", "0")) or available_cpus()
+    if workers > 1 and os.environ.get("STORAGE_BACKEND") == "memory":
+        # Cada worker tendría su propia base en memoria
+        logger.warning("STORAGE_BACKEND=memory solo admite un worker")
+        return 1
+    return workers
+
+
+def check_view_cache(workers):
+    """La caché de vistas en memoria de cada worker solo la invalidan sus propias escrituras
+    (o su change stream con CHANGE_FEED_MODE=stream): con varios workers se desactiva"""
+    if (workers > 1 and os.environ.get("VIEW_CACHE_ENABLED", "1") == "1"
+            and os.environ.get("VIEW_CACHE_BACKEND", "memory") == "memory"
+            and os.environ.get("CHANGE_FEED_MODE", "inline") != "stream"):
+        logger.warning("Caché de vistas desactivada: VIEW_CACHE_BACKEND=memory con varios workers "
+                       "serviría vistas antiguas (usar VIEW_CACHE_BACKEND=redis o CHANGE_FEED_MODE=stream)")
+        os.environ["VIEW_CACHE_ENABLED"] = "0"  # los workers heredan el entorno
+
+
+def prepare_metrics_dir(workers):
+    """Las métricas de Prometheus se agregan entre workers a través de un directorio"""
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path is None:
+        if workers == 1:
+            return
+        path = tempfile.mkdtemp(prefix="loveacts-metrics-")
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    os.makedirs(path, exist_ok=True)
+    for stale in glob.glob(os.path.join(path, "*.db")):
+        os.remove(stale)  # restos de una ejecución anterior
+
+
+def run_gunicorn(host, port, workers, graceful_timeout, keepalive):
+    from gunicorn.app.base import BaseApplication
+
+    def child_exit(server, worker):
+        if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(worker.pid)
+
+    options = {
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "chdir": BACKEND_DIR,
+        "preload_app": False,  # la app (y su cliente de Mongo) se importa en cada worker
+        "reuse_port": True,  # permite levantar otra instancia en el mismo puerto durante un despliegue
+        "graceful_timeout": graceful_timeout,
+        "timeout": graceful_timeout + 30,
+        "keepalive": keepalive,
+        "child_exit": child_exit,
+    }
+
+    class LoveActsApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            import server
+            return server.app
+
+    LoveActsApplication().run()
+
+
+def run_uvicorn(host, port, workers, graceful_timeout, keepalive):
+    import uvicorn
+
+    os.chdir(BACKEND_DIR)
+    uvicorn.run(
+        "server:app",
+        host=host,
+        port=port,
+        workers=workers,
+        log_config=None,
+        timeout_graceful_shutdown=graceful_timeout,
+        timeout_keep_alive=keepalive,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Arranca la API de LoveActs con varios workers")
+    parser.add_argument("--server", choices=["auto", "gunicorn", "uvicorn"], default="auto")
+    args = parser.parse_args()
+
+    logging_config.setup_logging()
+    host = os.environ.get("HOST", "0.0.0.0")
+    port = int(os.environ.get("PORT", "8001"))
+    graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+    keepalive = int(os.environ.get("KEEPALIVE", "5"))
+    workers = worker_count()
+    check_view_cache(workers)
+    prepare_metrics_dir(workers)
+
+    server = args.server
+    if server == "auto":
+        try:
+            import gunicorn  # noqa: F401
+            server = "gunicorn"
+        except ImportError:
+            server = "uvicorn"
+
+    logger.info("Arrancando API", extra={"server": server, "workers": workers, "bind": f"{host}:{port}"})
+    try:
+        if server == "gunicorn":
+            run_gunicorn(host, port, workers, graceful_timeout, keepalive)
+        else:
+            run_uvicorn(host, port, workers, graceful_timeout, keepalive)
+    finally:
+        logging_config.shutdown_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,113 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, status, Header, BackgroundTasks
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, Response, PlainTextResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List
+from contextlib import asynccontextmanager
 import os
-from pymongo import MongoClient
+import logging
+import time
+import pymongo
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import (
+    ConnectionFailure, DuplicateKeyError, ExecutionTimeout, PyMongoError, ServerSelectionTimeoutError,
+    WaitQueueTimeoutError
+)
+from bson import ObjectId
+from bson.errors import InvalidId
 from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
 import jwt
 import bcrypt
 import uuid
 import random
 from dotenv import load_dotenv
 import json
-import requests  # Para enviar notificaciones push
+import csv
+import io
+import base64
+import zlib
+import hmac
+import hashlib
+import threading
+import asyncio
+import metrics
+import query_budget
+import slow_queries
+import profiling
+import tracing
+import logging_config
+import storage
+import read_routing
+import circuit_breaker
+import admission
+import single_flight
+import view_cache
+import change_feed
+import notification_retention
+
+# Cargar variables de entorno (ruta explícita: evita buscar el .env recorriendo directorios)
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
+
+# Logs JSON escritos desde un hilo aparte (nunca bloquean el event loop)
+logging_config.setup_logging()
+logger = logging.getLogger("loveacts.server")
+notifications_logger = logging.getLogger("loveacts.notifications")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Recursos por worker: se abren después del fork y se cierran al apagar (ver startup/shutdown)"""
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
 
-# Cargar variables de entorno
-load_dotenv()
+app = FastAPI(title="LoveActs API Expandida", version="2.0.0", lifespan=lifespan)
 
-app = FastAPI(title="LoveActs API Expandida", version="2.0.0")
+# Con Mongo caído o lento: GET cacheables desde la última respuesta buena, el resto 503
+# (antes que CORS para que las respuestas degradadas también lleven sus cabeceras)
+app.add_middleware(
+    circuit_breaker.CircuitBreakerMiddleware,
+    identify=lambda scope: request_user_id(scope),
+    cacheable_routes=[
+        "/api/me",
+        "/api/activities/daily/{date}",
+        "/api/memories/special",
+        "/api/memories/filter",
+        "/api/achievements",
+    ],
+)
+
+# Límites de tasa por usuario e IP; con el worker sobrecargado se descarta primero el análisis
+app.add_middleware(
+    admission.AdmissionMiddleware,
+    identify=lambda scope: request_user_id(scope),
+    priorities={
+        "POST /api/login": admission.CRITICAL,
+        "POST /api/token/refresh": admission.CRITICAL,
+        "POST /api/activities": admission.CRITICAL,
+        "POST /api/activities/{activity_id}/rate": admission.CRITICAL,
+        "POST /api/mood": admission.CRITICAL,
+        "GET /api/memories/special": admission.LOW,
+        "GET /api/memories/filter": admission.LOW,
+        "GET /api/stats/correlation": admission.LOW,
+        "GET /api/stats/total": admission.LOW,
+        "GET /api/achievements": admission.LOW,
+        "GET /api/export": admission.LOW,
+    },
+    auth_routes=["POST /api/login", "POST /api/register", "POST /api/token/refresh"],
+    analytics_routes=[
+        "GET /api/memories/special",
+        "GET /api/memories/filter",
+        "GET /api/stats/correlation",
+        "GET /api/stats/total",
+        "GET /api/achievements",
+        "GET /api/export",
+    ],
+)
 
 # Configuración de CORS
 app.add_middleware(
@@ -28,19 +118,151 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Métricas de latencia por ruta (expuestas en /metrics)
+app.add_middleware(metrics.MetricsMiddleware)
+# Conteo de consultas por petición y detección de N+1
+app.add_middleware(query_budget.QueryBudgetMiddleware)
+# Trazas por petición (TRACING_ENABLED=1)
+app.add_middleware(tracing.TracingMiddleware)
+# request_id para los logs (cabecera X-Request-ID)
+app.add_middleware(logging_config.RequestIdMiddleware)
+
 # Configuración de MongoDB
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 DB_NAME = os.environ.get('DB_NAME', 'loveacts_expanded_db')
+# mongo (por defecto) o memory: motor en proceso para tests y benchmarks sin Mongo
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+# development o production: valores por defecto del pool y los timeouts (ver storage.mongo_options)
+APP_ENV = os.environ.get('APP_ENV', 'development')
+
+slow_query_recorder = slow_queries.SlowQueryRecorder()
+pool_listener = metrics.PoolMetricsListener()  # también alimenta /api/health/ready
+
+def connect_database():
+    client = storage.create_client(
+        STORAGE_BACKEND,
+        MONGO_URL,
+        **storage.mongo_options(APP_ENV),
+        event_listeners=[
+            metrics.CommandMetricsListener(),
+            pool_listener,
+            query_budget.QueryBudgetListener(),
+            slow_query_recorder,
+            tracing.TracingListener(),
+            circuit_breaker.listener
+        ]
+    )
+    return client, client[DB_NAME]
 
-client = MongoClient(MONGO_URL)
-db = client[DB_NAME]
+# El cliente se abre en cada worker (lifespan), nunca se hereda por fork
+db = storage.DatabaseProxy(connect_database)
+# Mismo cliente, lecturas en secundarios: solo para endpoints de análisis (ver read_routing)
+analytics_db = storage.DatabaseView(db, read_preference=read_routing.analytics_read_preference())
 
 # Configuración JWT
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-this-in-production')
 JWT_ALGORITHM = 'HS256'
+ACCESS_TOKEN_MINUTES = int(os.environ.get('ACCESS_TOKEN_MINUTES', '15'))
+REFRESH_TOKEN_DAYS = int(os.environ.get('REFRESH_TOKEN_DAYS', '30'))
+# Cuánto puede usar get_current_claims la token_version leída de un usuario sin volver a leerla
+TOKEN_VERSION_CACHE_SECONDS = float(os.environ.get('TOKEN_VERSION_CACHE_SECONDS', '30'))
+TOKEN_VERSION_CACHE_MAX_ENTRIES = int(os.environ.get('TOKEN_VERSION_CACHE_MAX_ENTRIES', '100000'))
 
 security = HTTPBearer()
 
+# Claves de idempotencia para POST reintentados (cabecera Idempotency-Key)
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+IDEMPOTENCY_LOCK_SECONDS = 30  # tras esto, una clave "in_progress" se considera abandonada
+IDEMPOTENCY_WAIT_SECONDS = 10
+
+# Administración: los endpoints /api/admin/* requieren la cabecera X-Admin-Token
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Configuración de exportación
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '500'))
+EXPORT_CHUNK_BYTES = 64 * 1024
+ANALYTICS_EXPORT_DIR = os.environ.get('ANALYTICS_EXPORT_DIR', 'analytics_data')
+
+# Apagado: tiempo máximo esperando notificaciones pendientes
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get('SHUTDOWN_DRAIN_SECONDS', '10'))
+
+# Sonda de readiness: tiempo máximo del ping y uso del pool a partir del cual el worker deja de estar listo
+READINESS_TIMEOUT_SECONDS = float(os.environ.get('READINESS_TIMEOUT_SECONDS', '2'))
+READINESS_MAX_POOL_SATURATION = float(os.environ.get('READINESS_MAX_POOL_SATURATION', '0.9'))
+
+def create_index(collection, keys, **options):
+    """Crea un índice; si falla se registra y se siguen creando los demás (salvo sin conexión a Mongo)"""
+    try:
+        db[collection].create_index(keys, **options)
+        return True
+    except ConnectionFailure:
+        raise
+    except Exception as e:
+        logger.error("Error creando índice", extra={"collection": collection, "keys": str(keys), "error": str(e)})
+        return False
+
+def dedupe_moods():
+    """Deja el estado de ánimo más reciente de cada usuario y día (el código anterior a
+    create_mood con upsert podía guardar dos); devuelve cuántos borró"""
+    duplicates, previous = [], None
+    moods = db.moods.find({}, {"user_id": 1, "date": 1, "created_at": 1}).sort(
+        [("user_id", ASCENDING), ("date", ASCENDING), ("created_at", pymongo.DESCENDING)]
+    )
+    for mood in moods:
+        key = (mood.get("user_id"), mood.get("date"))
+        if key == previous:
+            duplicates.append(mood["_id"])
+        previous = key
+    for start in range(0, len(duplicates), 1000):
+        db.moods.delete_many({"_id": {"$in": duplicates[start:start + 1000]}})
+    return len(duplicates)
+
+def ensure_indexes():
+    """Crea los índices que necesitan las consultas de la API
+
+    Lanza ConnectionFailure si Mongo no responde: ensure_indexes_with_retry lo vuelve a intentar.
+    """
+    # Autenticación: usuario por id en cada petición con pareja
+    create_index("users", "id")
+    # Exportación: filtro por usuario y recorrido ordenado por _id
+    create_index("activities", [("user_id", ASCENDING), ("_id", ASCENDING)])
+    create_index("moods", [("user_id", ASCENDING), ("_id", ASCENDING)])
+    create_index("notifications", [("user_id", ASCENDING), ("_id", ASCENDING)])
+    # Un solo estado de ánimo por usuario y día (create_mood hace upsert sobre esta clave)
+    try:
+        db.moods.create_index([("user_id", ASCENDING), ("date", ASCENDING)], unique=True)
+    except DuplicateKeyError:
+        logger.warning("Estados de ánimo duplicados por usuario y día: se conserva el más reciente",
+                       extra={"removed": dedupe_moods()})
+        create_index("moods", [("user_id", ASCENDING), ("date", ASCENDING)], unique=True)
+    except ConnectionFailure:
+        raise
+    except Exception as e:
+        logger.error("Error creando índice", extra={"collection": "moods", "keys": "user_id, date", "error": str(e)})
+    # Las respuestas guardadas por Idempotency-Key caducan solas
+    create_index("idempotency_keys", "created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+    # Los refresh tokens revocados se borran cuando habrían expirado igualmente
+    create_index("revoked_tokens", "expires_at", expireAfterSeconds=0)
+    # Notificaciones: TTL de las leídas, listado y archivado de las antiguas
+    notification_retention.ensure_indexes(db)
+
+indexes_ready = False  # /api/health/ready no da el worker por listo hasta crearlos
+
+async def ensure_indexes_with_retry():
+    """Crea los índices en un hilo, reintentando con backoff mientras Mongo no responda"""
+    global indexes_ready
+    backoff = 1
+    while True:
+        try:
+            await asyncio.to_thread(ensure_indexes)
+            indexes_ready = True
+            return
+        except ConnectionFailure as e:
+            logger.warning("Mongo no responde al crear los índices, se reintenta",
+                           extra={"error": str(e), "retry_in": backoff})
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 60)
+
 # Modelos Pydantic Originales
 class UserCreate(BaseModel):
     name: str
@@ -62,6 +284,9 @@ class UserResponse(BaseModel):
     partner_photo: Optional[str] = None  # Nuevo: foto de pareja (base64)
     created_at: datetime
 
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
+
 class LinkPartnerRequest(BaseModel):
     partner_code: str
 
@@ -152,35 +377,148 @@ def hash_password(password: str) -> str:
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
-def create_access_token(user_id: str) -> str:
+def create_access_token(user) -> str:
+    """Token de acceso de corta duración con los datos que necesitan los endpoints de lectura"""
     payload = {
-        'user_id': user_id,
-        'exp': datetime.now(timezone.utc) + timedelta(days=7)
+        'type': 'access',
+        'user_id': user["id"],
+        'name': user["name"],
+        'partner_id': user.get("partner_id"),
+        'ver': user.get("token_version", 0),
+        'exp': datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_MINUTES)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def create_refresh_token(user) -> str:
+    payload = {
+        'type': 'refresh',
+        'user_id': user["id"],
+        'jti': str(uuid.uuid4()),
+        'exp': datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_DAYS)
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+def issue_tokens(user) -> dict:
+    return {
+        "token": create_access_token(user),
+        "refresh_token": create_refresh_token(user),
+        "expires_in": ACCESS_TOKEN_MINUTES * 60
+    }
+
+def decode_token(credentials: HTTPAuthorizationCredentials) -> dict:
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload.get('user_id')
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Token inválido")
-        
-        user = db.users.find_one({"id": user_id})
-        if user is None:
-            raise HTTPException(status_code=401, detail="Usuario no encontrado")
-        
-        return user
+        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expirado")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Token inválido")
+    
+    # Los refresh tokens solo sirven para /api/token/refresh
+    if payload.get('user_id') is None or payload.get('type') == 'refresh':
+        raise HTTPException(status_code=401, detail="Token inválido")
+    return payload
+
+@tracing.traced("auth.get_current_user")
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Usuario completo desde la base de datos (escrituras y datos de perfil)"""
+    payload = decode_token(credentials)
+    
+    user = db.users.find_one({"id": payload['user_id']})
+    if user is None:
+        raise HTTPException(status_code=401, detail="Usuario no encontrado")
+    
+    # La vinculación de pareja cambia la versión y obliga a renovar el token
+    if 'ver' in payload and payload['ver'] != user.get("token_version", 0):
+        raise HTTPException(status_code=401, detail="Token desactualizado")
+    
+    return user
+
+token_versions = OrderedDict()  # user_id -> (caduca, token_version o None si no existe)
+token_versions_lock = threading.Lock()  # get_current_claims corre en el threadpool
+
+def current_token_version(user_id):
+    """token_version del usuario, leída como mucho una vez cada TOKEN_VERSION_CACHE_SECONDS por worker"""
+    now = time.monotonic()
+    with token_versions_lock:
+        entry = token_versions.get(user_id)
+        if entry is not None and entry[0] > now:
+            token_versions.move_to_end(user_id)
+            return entry[1]
+    user = db.users.find_one({"id": user_id}, {"token_version": 1, "_id": 0})
+    version = None if user is None else user.get("token_version", 0)
+    with token_versions_lock:
+        token_versions[user_id] = (now + TOKEN_VERSION_CACHE_SECONDS, version)
+        token_versions.move_to_end(user_id)
+        while len(token_versions) > TOKEN_VERSION_CACHE_MAX_ENTRIES:
+            token_versions.popitem(last=False)
+    return version
+
+def forget_token_version(user_id):
+    with token_versions_lock:
+        token_versions.pop(user_id, None)
+
+@tracing.traced("auth.get_current_claims")
+def get_current_claims(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Identidad del usuario desde el token
+    
+    Devuelve id, name y partner_id. Los tokens antiguos sin esos datos
+    se resuelven por la vía lenta de get_current_user. Con pareja en el
+    token se comprueba su versión (current_token_version): tras desvincular,
+    el token anterior deja de dar acceso a los datos de la ex pareja en
+    seguida en el worker que desvinculó (y en todos con change stream) y en
+    como mucho TOKEN_VERSION_CACHE_SECONDS en los demás.
+    """
+    payload = decode_token(credentials)
+    if payload.get('type') != 'access':
+        return get_current_user(credentials)
+    
+    if payload.get('partner_id') and payload.get('ver', 0) != current_token_version(payload['user_id']):
+        raise HTTPException(status_code=401, detail="Token desactualizado")
+    
+    return {
+        "id": payload['user_id'],
+        "name": payload['name'],
+        "partner_id": payload.get('partner_id')
+    }
+
+def request_user_id(scope):
+    """Usuario (token verificado) de una petición ASGI, para los middlewares; se calcula una vez por petición"""
+    if "loveacts.user_id" not in scope:
+        user_id = None
+        authorization = dict(scope["headers"]).get(b"authorization", b"").decode("latin-1")
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() == "bearer" and token:
+            try:
+                user_id = decode_token(HTTPAuthorizationCredentials(scheme=scheme, credentials=token))["user_id"]
+            except HTTPException:
+                pass
+        scope["loveacts.user_id"] = user_id
+    return scope["loveacts.user_id"]
+
+def revoke_refresh_token(payload) -> bool:
+    """Añade el jti a la lista de revocación. Devuelve False si ya estaba revocado"""
+    try:
+        db.revoked_tokens.insert_one({
+            "_id": payload['jti'],
+            "user_id": payload['user_id'],
+            "expires_at": datetime.fromtimestamp(payload['exp'], timezone.utc)
+        })
+        return True
+    except DuplicateKeyError:
+        return False
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Administración deshabilitada")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Token de administración inválido")
 
 def generate_partner_code() -> str:
     return str(uuid.uuid4())[:8].upper()
 
 # Función para enviar notificaciones push
+pending_notifications = set()  # tareas enviando notificaciones en este worker
+@tracing.traced("notifications.send_push")
 async def send_push_notification(user_id: str, notification: NotificationMessage):
     """Envía una notificación push a un usuario específico"""
     try:
@@ -204,19 +542,257 @@ async def send_push_notification(user_id: str, notification: NotificationMessage
                 }
                 
                 db.notifications.insert_one(notification_doc)
-                print(f"💌 Notificación guardada para usuario {user_id}: {notification.title}")
+                notification_retention.add_unread(db, user_id, 1)
+                notifications_logger.info(
+                    "Notificación guardada",
+                    extra={"user_id": user_id, "notification_tag": notification.tag}
+                )
                 
-            except Exception as e:
-                print(f"❌ Error enviando notificación individual: {e}")
+            except Exception:
+                notifications_logger.exception("Error enviando notificación individual", extra={"user_id": user_id})
                 continue
                 
-    except Exception as e:
-        print(f"❌ Error en send_push_notification: {e}")
+    except Exception:
+        notifications_logger.exception("Error en send_push_notification", extra={"user_id": user_id})
 
+@tracing.traced("notifications.notify_partner")
 async def notify_partner(current_user, notification: NotificationMessage):
     """Notifica a la pareja del usuario actual"""
     if current_user.get("partner_id"):
-        await send_push_notification(current_user["partner_id"], notification)
+        # Registrada para que el apagado del worker espere a que termine
+        task = asyncio.current_task()
+        pending_notifications.add(task)
+        try:
+            await send_push_notification(current_user["partner_id"], notification)
+        finally:
+            pending_notifications.discard(task)
+
+# Efectos de las escrituras: los corre el change feed, no los endpoints (ver change_feed)
+ACHIEVEMENT_CATEGORIES = ["physical", "emotional", "practical", "general"]
+MOOD_NOTIFY_FIELDS = {"mood_id", "mood_emoji", "note"}
+
+def load_user_stats(user_id):
+    """Resumen de actividades y estados de ánimo del usuario (user_stats)
+
+    Cada escritura que lo afecta sube "generation" (invalidate_user_stats); el
+    resumen se recalcula en la primera lectura con una generación más nueva que
+    la guardada. Solo se guarda si nadie subió la generación mientras tanto, así
+    que nunca queda uno viejo marcado como actual.
+    """
+    stats = db.user_stats.find_one({"_id": user_id}) or {"generation": 0}
+    generation = stats["generation"]
+    if stats.get("stats_generation") == generation:
+        return stats
+    
+    summary = {
+        "activities": 0,
+        "five_star_activities": 0,
+        "categories": dict.fromkeys(ACHIEVEMENT_CATEGORIES, 0),
+    }
+    for activity in db.activities.find(
+        {"user_id": user_id}, {"_id": 0, "category": 1, "rating": 1, "is_pending_rating": 1}
+    ):
+        summary["activities"] += 1
+        if activity.get("rating") == 5 and activity.get("is_pending_rating") is False:
+            summary["five_star_activities"] += 1
+        if activity.get("category") in summary["categories"]:
+            summary["categories"][activity["category"]] += 1
+    summary["moods"] = db.moods.count_documents({"user_id": user_id})
+    
+    try:
+        db.user_stats.update_one(
+            {"_id": user_id, "generation": generation},
+            {"$set": {**summary, "stats_generation": generation}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass  # otra escritura subió la generación mientras se calculaba: la próxima lectura recalcula
+    return summary
+
+def invalidate_user_stats(user_id):
+    db.user_stats.update_one({"_id": user_id}, {"$inc": {"generation": 1}}, upsert=True)
+
+def invalidate_all_user_stats():
+    db.user_stats.update_many({}, {"$inc": {"generation": 1}})
+
+changes = change_feed.ChangeFeed(
+    db, ["activities", "moods", "users", "user_stats"], on_history_lost=invalidate_all_user_stats
+)
+
+# Locales: cada worker invalida sus cachés
+@changes.on("activities", "insert", "update", "replace")
+async def invalidate_activity_views(change):
+    activity = change.get("fullDocument")  # None si se borró antes de leerlo (updateLookup)
+    if activity:
+        single_flight.coalescer.invalidate(activity["user_id"])
+        await view_cache.views.invalidate("activities", activity["user_id"])
+
+@changes.on("moods", "insert", "update", "replace")
+async def invalidate_mood_views(change):
+    mood = change.get("fullDocument")
+    if mood:
+        single_flight.coalescer.invalidate(mood["user_id"])
+        await view_cache.views.invalidate("moods", mood["user_id"])
+
+@changes.on("users", "update", "replace")
+async def invalidate_user_views(change):
+    user = change.get("fullDocument")
+    if user:
+        forget_token_version(user["id"])
+        single_flight.coalescer.invalidate(user["id"])
+        await view_cache.views.invalidate("users", user["id"])
+
+@changes.on("user_stats", "insert", "update", "replace")
+async def invalidate_stats_views(change):
+    await view_cache.views.invalidate("user_stats", change["documentKey"]["_id"])
+
+# Exclusivos: una sola vez por escritura (en modo inline, fuera de la petición que escribió)
+async def change_author(change, user_id):
+    """Autor de la escritura: en modo inline lo pasa el endpoint; desde el change stream se lee"""
+    author = change.get("context", {}).get("author")
+    if author is None:
+        author = await asyncio.to_thread(
+            db.users.find_one, {"id": user_id}, {"_id": 0, "name": 1, "partner_id": 1, "partner_custom_name": 1}
+        )
+    return author
+
+@changes.on("activities", "insert", "update", "replace", exclusive=True)
+@changes.on("moods", "insert", "update", "replace", exclusive=True)
+async def update_user_stats(change):
+    document = change.get("fullDocument")
+    if document:
+        # Solo sube la generación: nadie espera a recorrer el historial del usuario. En modo inline
+        # corre tras responder, así que una lectura inmediata puede ver aún el resumen anterior
+        await asyncio.to_thread(invalidate_user_stats, document["user_id"])
+        await changes.written("user_stats", "update", {"_id": document["user_id"]})
+
+@changes.on("activities", "insert", exclusive=True)
+async def notify_new_activity(change):
+    activity = change["fullDocument"]
+    author = await change_author(change, activity["user_id"])
+    if not author or not author.get("partner_id"):
+        return
+    partner_name = author.get("partner_custom_name") or author["name"]
+    notification = NotificationMessage(
+        title=f"💕 Nuevo acto de amor",
+        body=f"{partner_name} registró un acto especial para ti. ¡Ve a calificarlo!",
+        tag="new_activity",
+        data={"activity_id": activity["id"], "type": "new_activity"}
+    )
+    await notify_partner(author, notification)
+
+@changes.on("moods", "insert", "update", "replace", exclusive=True)
+async def notify_mood_update(change):
+    mood = change.get("fullDocument")
+    if not mood:
+        return
+    if change["operationType"] == "update" and not MOOD_NOTIFY_FIELDS & set(change["updateDescription"]["updatedFields"]):
+        return  # solo cambió created_at (mismo estado reenviado) o una corrección ajena al estado
+    author = await change_author(change, mood["user_id"])
+    if not author or not author.get("partner_id"):
+        return
+    notification = NotificationMessage(
+        title="💭 Nuevo estado de ánimo",
+        body=f"{author['name']} actualizó su estado de ánimo a {mood['mood_emoji']}",
+        tag="mood_update",
+        data={"mood_id": mood["id"], "type": "mood_update"}
+    )
+    await notify_partner(author, notification)
+
+# Idempotencia de POST
+in_flight_idempotent_requests = {}  # record_id -> asyncio.Future con el cuerpo de la respuesta
+
+def replay_idempotent_response(body):
+    return JSONResponse(content=body, headers={"Idempotent-Replayed": "true"})
+
+async def run_idempotent(idempotency_key: Optional[str], current_user, scope: str, payload: dict, handler):
+    """Ejecuta handler una sola vez por (usuario, scope, Idempotency-Key)
+    
+    Sin cabecera no hay coste extra. Con cabecera: una inserción reserva la clave,
+    los reintentos reciben la respuesta guardada y los duplicados concurrentes
+    esperan a que termine la primera petición.
+    """
+    if not idempotency_key:
+        return await handler()
+    if len(idempotency_key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key demasiado larga")
+    
+    record_id = f"{current_user['id']}:{scope}:{idempotency_key}"
+    fingerprint = hashlib.sha256(
+        json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+    
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        # Duplicado concurrente en este mismo proceso: compartir el resultado del primero
+        pending = in_flight_idempotent_requests.get(record_id)
+        if pending is not None:
+            try:
+                body = await asyncio.wait_for(asyncio.shield(pending), timeout=max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=409, detail="Hay una petición idéntica en curso, reintenta más tarde")
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise  # la cancelada es esta petición
+                continue  # se canceló la original y liberó la clave: intentarlo de nuevo
+            return replay_idempotent_response(body)
+        
+        now = datetime.now(timezone.utc)
+        try:
+            db.idempotency_keys.insert_one({
+                "_id": record_id,
+                "fingerprint": fingerprint,
+                "status": "in_progress",
+                "created_at": now,
+                "locked_at": now
+            })
+            break
+        except DuplicateKeyError:
+            pass
+        
+        stored = db.idempotency_keys.find_one({"_id": record_id})
+        if stored is None:
+            continue  # la petición original falló y liberó la clave
+        if stored["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key reutilizada con otra petición")
+        if stored["status"] == "completed":
+            return replay_idempotent_response(stored["response"])
+        
+        # En curso en otro proceso: tomar la clave si quedó abandonada, si no esperar
+        stale_before = now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+        if db.idempotency_keys.find_one_and_update(
+            {"_id": record_id, "status": "in_progress", "locked_at": {"$lt": stale_before}},
+            {"$set": {"locked_at": now}}
+        ):
+            break
+        if loop.time() > deadline:
+            raise HTTPException(status_code=409, detail="Hay una petición idéntica en curso, reintenta más tarde")
+        await asyncio.sleep(0.1)
+    
+    future = loop.create_future()
+    in_flight_idempotent_requests[record_id] = future
+    try:
+        result = await handler()
+        body = jsonable_encoder(result)
+        db.idempotency_keys.update_one(
+            {"_id": record_id},
+            {"$set": {"status": "completed", "response": body}}
+        )
+        future.set_result(body)
+        return result
+    except BaseException as e:
+        # No se guardan errores ni peticiones canceladas (desconexión, apagado):
+        # liberar la clave para que el cliente pueda reintentar
+        db.idempotency_keys.delete_one({"_id": record_id})
+        if not isinstance(e, asyncio.CancelledError):
+            future.set_exception(e)
+            future.exception()  # evita el aviso de excepción no recuperada si nadie esperaba
+        raise
+    finally:
+        in_flight_idempotent_requests.pop(record_id, None)
+        if not future.done():
+            future.cancel()  # los duplicados que esperaban vuelven a intentarlo
 
 def get_partner_info(user):
     """Obtiene información de la pareja del usuario"""
@@ -242,15 +818,15 @@ async def register(user_data: UserCreate):
         "password": hash_password(user_data.password),
         "partner_id": None,
         "partner_code": partner_code,
+        "token_version": 0,
         "created_at": datetime.now(timezone.utc)
     }
     
     db.users.insert_one(new_user)
-    token = create_access_token(user_id)
     
     return {
         "message": "Usuario registrado exitosamente",
-        "token": token,
+        **issue_tokens(new_user),
         "user": UserResponse(
             id=user_id,
             name=user_data.name,
@@ -266,12 +842,11 @@ async def login(user_data: UserLogin):
     if not user or not verify_password(user_data.password, user["password"]):
         raise HTTPException(status_code=401, detail="Email o contraseña incorrectos")
     
-    token = create_access_token(user["id"])
     partner = get_partner_info(user)
     
     return {
         "message": "Login exitoso",
-        "token": token,
+        **issue_tokens(user),
         "user": UserResponse(
             id=user["id"],
             name=user["name"],
@@ -283,6 +858,38 @@ async def login(user_data: UserLogin):
         )
     }
 
+@app.post("/api/token/refresh")
+async def refresh_access_token(request: RefreshTokenRequest):
+    """Canjea un refresh token por un par nuevo con los datos actuales del usuario"""
+    try:
+        payload = jwt.decode(request.refresh_token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Sesión expirada")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Token inválido")
+    if payload.get('type') != 'refresh':
+        raise HTTPException(status_code=401, detail="Token inválido")
+    
+    user = db.users.find_one({"id": payload['user_id']})
+    if user is None:
+        raise HTTPException(status_code=401, detail="Usuario no encontrado")
+    
+    # Rotación: cada refresh token se usa una sola vez
+    if not revoke_refresh_token(payload):
+        raise HTTPException(status_code=401, detail="Token revocado")
+    
+    return issue_tokens(user)
+
+@app.post("/api/logout")
+async def logout(request: RefreshTokenRequest):
+    try:
+        payload = jwt.decode(request.refresh_token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.InvalidTokenError:
+        return {"message": "Sesión cerrada"}
+    if payload.get('type') == 'refresh':
+        revoke_refresh_token(payload)
+    return {"message": "Sesión cerrada"}
+
 @app.get("/api/me")
 async def get_current_user_info(current_user = Depends(get_current_user)):
     partner = get_partner_info(current_user)
@@ -321,18 +928,27 @@ async def link_partner(request: LinkPartnerRequest, current_user = Depends(get_c
     if partner.get("partner_id"):
         raise HTTPException(status_code=400, detail="Esta persona ya tiene pareja vinculada")
     
+    # Subir token_version invalida los tokens con el partner_id anterior
     db.users.update_one(
         {"id": current_user["id"]},
-        {"$set": {"partner_id": partner["id"]}}
+        {"$set": {"partner_id": partner["id"]}, "$inc": {"token_version": 1}}
     )
     db.users.update_one(
         {"id": partner["id"]},
-        {"$set": {"partner_id": current_user["id"]}}
+        {"$set": {"partner_id": current_user["id"]}, "$inc": {"token_version": 1}}
     )
+    await changes.written("users", "update", {"id": current_user["id"]}, {"partner_id": partner["id"]})
+    await changes.written("users", "update", {"id": partner["id"]}, {"partner_id": current_user["id"]})
     
+    updated_user = {
+        **current_user,
+        "partner_id": partner["id"],
+        "token_version": current_user.get("token_version", 0) + 1
+    }
     return {
         "message": f"¡Vinculado exitosamente con {partner['name']}!",
-        "partner_name": partner["name"]
+        "partner_name": partner["name"],
+        **issue_tokens(updated_user)
     }
 @app.delete("/api/unlink-partner")
 async def unlink_partner(current_user = Depends(get_current_user)):
@@ -344,14 +960,32 @@ async def unlink_partner(current_user = Depends(get_current_user)):
     # Desvincular parejas y limpiar datos personalizados
     db.users.update_one(
         {"id": current_user["id"]},
-        {"$set": {"partner_id": None}, "$unset": {"partner_custom_name": "", "partner_photo": ""}}
+        {
+            "$set": {"partner_id": None},
+            "$unset": {"partner_custom_name": "", "partner_photo": ""},
+            "$inc": {"token_version": 1}
+        }
     )
     db.users.update_one(
         {"id": partner_id},
-        {"$set": {"partner_id": None}, "$unset": {"partner_custom_name": "", "partner_photo": ""}}
+        {
+            "$set": {"partner_id": None},
+            "$unset": {"partner_custom_name": "", "partner_photo": ""},
+            "$inc": {"token_version": 1}
+        }
     )
+    await changes.written("users", "update", {"id": current_user["id"]}, {"partner_id": None})
+    await changes.written("users", "update", {"id": partner_id}, {"partner_id": None})
     
-    return {"message": "Pareja desvinculada exitosamente"}
+    updated_user = {
+        **current_user,
+        "partner_id": None,
+        "token_version": current_user.get("token_version", 0) + 1
+    }
+    return {
+        "message": "Pareja desvinculada exitosamente",
+        **issue_tokens(updated_user)
+    }
 
 # Nuevos endpoints para personalización de pareja
 @app.put("/api/partner-info")
@@ -372,6 +1006,7 @@ async def update_partner_info(partner_info: UpdatePartnerInfo, current_user = De
         {"id": current_user["id"]},
         {"$set": update_data}
     )
+    await changes.written("users", "update", {"id": current_user["id"]}, update_data)
     
     return {
         "message": "Información de pareja actualizada exitosamente",
@@ -381,39 +1016,59 @@ async def update_partner_info(partner_info: UpdatePartnerInfo, current_user = De
 @app.get("/api/stats/total")
 async def get_total_stats(current_user = Depends(get_current_user)):
     """Obtiene estadísticas totales históricas del usuario y su pareja"""
+    partner_id = current_user.get("partner_id")
+    
+    def compute_total_stats():
+        # Actividades del usuario y de la pareja (si existe), desde user_stats
+        total_user_activities = load_user_stats(current_user["id"])["activities"]
+        total_partner_activities = 0
+        if partner_id:
+            total_partner_activities = load_user_stats(partner_id)["activities"]
+        
+        # Total juntos
+        total_activities_together = total_user_activities + total_partner_activities
+        
+        # Calcular días de relación (desde que se vincularon o se registraron)
+        relationship_start = current_user["created_at"]
+        if partner_id:
+            # Buscar cuándo se vincularon (aproximadamente cuando ambos se registraron)
+            partner = db.users.find_one({"id": partner_id})
+            if partner:
+                # Usar la fecha más reciente como inicio de la relación registrada
+                relationship_start = max(current_user["created_at"], partner["created_at"])
+        
+        # Mongo devuelve las fechas en UTC sin zona horaria
+        relationship_days = (datetime.now(timezone.utc).replace(tzinfo=None) - relationship_start).days + 1
+        
+        return TotalStatsResponse(
+            total_user_activities=total_user_activities,
+            total_partner_activities=total_partner_activities,
+            total_activities_together=total_activities_together,
+            relationship_days=relationship_days
+        )
     
-    # Contar actividades del usuario
-    total_user_activities = db.activities.count_documents({"user_id": current_user["id"]})
-    
-    # Contar actividades de la pareja (si existe)
-    total_partner_activities = 0
-    if current_user.get("partner_id"):
-        total_partner_activities = db.activities.count_documents({"user_id": current_user["partner_id"]})
-    
-    # Total juntos
-    total_activities_together = total_user_activities + total_partner_activities
-    
-    # Calcular días de relación (desde que se vincularon o se registraron)
-    relationship_start = current_user["created_at"]
-    if current_user.get("partner_id"):
-        # Buscar cuándo se vincularon (aproximadamente cuando ambos se registraron)
-        partner = db.users.find_one({"id": current_user["partner_id"]})
-        if partner:
-            # Usar la fecha más reciente como inicio de la relación registrada
-            relationship_start = max(current_user["created_at"], partner["created_at"])
-    
-    relationship_days = (datetime.now(timezone.utc) - relationship_start).days + 1
-    
-    return TotalStatsResponse(
-        total_user_activities=total_user_activities,
-        total_partner_activities=total_partner_activities,
-        total_activities_together=total_activities_together,
-        relationship_days=relationship_days
+    # relationship_days cambia con la fecha: forma parte de la clave
+    return await view_cache.views.get_or_compute(
+        "total_stats",
+        (current_user["id"], partner_id, datetime.now(timezone.utc).date().isoformat()),
+        [("user_stats", current_user["id"]), ("user_stats", partner_id),
+         ("users", current_user["id"]), ("users", partner_id)],
+        lambda: asyncio.to_thread(compute_total_stats)
     )
 
 # Endpoints de Actividades EXPANDIDOS
 @app.post("/api/activities")
-async def create_activity(activity: ActivityCreate, current_user = Depends(get_current_user)):
+async def create_activity(
+    activity: ActivityCreate,
+    current_user = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
+    return await run_idempotent(
+        idempotency_key, current_user, "create_activity", activity.model_dump(),
+        lambda: _create_activity(activity, current_user)
+    )
+
+async def _create_activity(activity: ActivityCreate, current_user):
     activity_id = str(uuid.uuid4())
     today = datetime.now(timezone.utc).date().isoformat()
     
@@ -432,18 +1087,10 @@ async def create_activity(activity: ActivityCreate, current_user = Depends(get_c
         "rated_at": None
     }
     
-    db.activities.insert_one(new_activity)
-    
-    # NUEVA: Enviar notificación a la pareja
-    if current_user.get("partner_id"):
-        partner_name = current_user.get("partner_custom_name") or current_user["name"]
-        notification = NotificationMessage(
-            title=f"💕 Nuevo acto de amor",
-            body=f"{partner_name} registró un acto especial para ti. ¡Ve a calificarlo!",
-            tag="new_activity",
-            data={"activity_id": activity_id, "type": "new_activity"}
-        )
-        await notify_partner(current_user, notification)
+    with read_routing.write_session(db, current_user["id"], current_user.get("partner_id")) as session:
+        db.activities.insert_one(new_activity, session=session)
+    # La notificación a la pareja la envía el change feed (notify_new_activity)
+    await changes.written("activities", "insert", new_activity, context={"author": current_user})
     
     return {
         "message": "Actividad registrada exitosamente. Tu pareja podrá calificarla.",
@@ -451,7 +1098,18 @@ async def create_activity(activity: ActivityCreate, current_user = Depends(get_c
     }
 
 @app.post("/api/activities/{activity_id}/rate")
-async def rate_activity(activity_id: str, rating_data: ActivityRating, current_user = Depends(get_current_user)):
+async def rate_activity(
+    activity_id: str,
+    rating_data: ActivityRating,
+    current_user = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
+    return await run_idempotent(
+        idempotency_key, current_user, f"rate_activity:{activity_id}", rating_data.model_dump(),
+        lambda: _rate_activity(activity_id, rating_data, current_user)
+    )
+
+async def _rate_activity(activity_id: str, rating_data: ActivityRating, current_user):
     if not (1 <= rating_data.rating <= 5):
         raise HTTPException(status_code=400, detail="La calificación debe estar entre 1 y 5")
     
@@ -470,17 +1128,15 @@ async def rate_activity(activity_id: str, rating_data: ActivityRating, current_u
         raise HTTPException(status_code=400, detail="Esta actividad ya ha sido calificada")
     
     # Actualizar la actividad con la calificación
-    db.activities.update_one(
-        {"id": activity_id},
-        {
-            "$set": {
-                "rating": rating_data.rating,
-                "partner_comment": rating_data.comment,
-                "is_pending_rating": False,
-                "rated_at": datetime.now(timezone.utc)
-            }
-        }
-    )
+    rating_fields = {
+        "rating": rating_data.rating,
+        "partner_comment": rating_data.comment,
+        "is_pending_rating": False,
+        "rated_at": datetime.now(timezone.utc)
+    }
+    with read_routing.write_session(db, current_user["id"], activity["user_id"]) as session:
+        db.activities.update_one({"id": activity_id}, {"$set": rating_fields}, session=session)
+    await changes.written("activities", "update", {**activity, **rating_fields}, rating_fields)
     
     return {
         "message": "Actividad calificada exitosamente",
@@ -488,38 +1144,45 @@ async def rate_activity(activity_id: str, rating_data: ActivityRating, current_u
         "comment": rating_data.comment
     }
 
+def load_daily_couple(couple, date):
+    """Actividades y estados de ánimo del día y pendientes de calificar de cada miembro de la pareja"""
+    members = list(couple)
+    activities = list(db.activities.find({"user_id": {"$in": members}, "date": date}))
+    moods = {mood["user_id"]: mood for mood in db.moods.find({"user_id": {"$in": members}, "date": date})}
+    pending = {
+        member: db.activities.count_documents({"user_id": member, "is_pending_rating": True})
+        for member in members
+    }
+    return activities, moods, pending
+
 @app.get("/api/activities/daily/{date}")
-async def get_daily_activities(date: str, current_user = Depends(get_current_user)):
+async def get_daily_activities(date: str, current_user = Depends(get_current_claims)):
     try:
         datetime.fromisoformat(date)
     except ValueError:
         raise HTTPException(status_code=400, detail="Formato de fecha inválido (usar YYYY-MM-DD)")
     
-    # Actividades del usuario
-    user_activities = list(db.activities.find({
-        "user_id": current_user["id"],
-        "date": date
-    }))
-    user_activities_response = [ActivityResponse(**activity) for activity in user_activities]
+    # Los dos miembros de la pareja piden lo mismo: una sola lectura compartida
+    couple = single_flight.couple_key(current_user)
+    activities, moods, pending = await single_flight.coalescer.run(
+        "daily", couple, (date,), lambda: load_daily_couple(couple, date)
+    )
     
-    # Actividades de la pareja
+    user_activities_response = [
+        ActivityResponse(**activity) for activity in activities if activity["user_id"] == current_user["id"]
+    ]
     partner_activities_response = []
     if current_user.get("partner_id"):
-        partner_activities = list(db.activities.find({
-            "user_id": current_user["partner_id"],
-            "date": date
-        }))
-        partner_activities_response = [ActivityResponse(**activity) for activity in partner_activities]
-    
-    # Contar actividades pendientes de calificar
-    pending_ratings = db.activities.count_documents({
-        "user_id": current_user.get("partner_id", ""),
-        "is_pending_rating": True
-    })
+        partner_activities_response = [
+            ActivityResponse(**activity) for activity in activities
+            if activity["user_id"] == current_user["partner_id"]
+        ]
     
-    # Obtener estados de ánimo
-    user_mood = db.moods.find_one({"user_id": current_user["id"], "date": date})
-    partner_mood = db.moods.find_one({"user_id": current_user.get("partner_id", ""), "date": date})
+    # Actividades de la pareja pendientes de calificar por el usuario
+    pending_ratings = pending.get(current_user.get("partner_id"), 0)
+    
+    user_mood = moods.get(current_user["id"])
+    partner_mood = moods.get(current_user.get("partner_id"))
     
     # Calcular puntaje solo de actividades calificadas
     completed_score = sum(
@@ -539,7 +1202,7 @@ async def get_daily_activities(date: str, current_user = Depends(get_current_use
     )
 
 @app.get("/api/activities/pending-ratings")
-async def get_pending_ratings(current_user = Depends(get_current_user)):
+async def get_pending_ratings(current_user = Depends(get_current_claims)):
     """Obtiene actividades de la pareja que están pendientes de calificar"""
     if not current_user.get("partner_id"):
         return {"activities": [], "count": 0}
@@ -558,54 +1221,64 @@ async def get_pending_ratings(current_user = Depends(get_current_user)):
 
 # Endpoints para Estado de Ánimo
 @app.post("/api/mood")
-async def create_mood(mood_data: MoodCreate, current_user = Depends(get_current_user)):
+async def create_mood(
+    mood_data: MoodCreate,
+    current_user = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
+    return await run_idempotent(
+        idempotency_key, current_user, "create_mood", mood_data.model_dump(),
+        lambda: _create_mood(mood_data, current_user)
+    )
+
+async def _create_mood(mood_data: MoodCreate, current_user):
     # Validar que el mood_id no esté vacío
     if not mood_data.mood_id:
         raise HTTPException(status_code=400, detail="El ID del estado de ánimo es requerido")
     
     today = datetime.now(timezone.utc).date().isoformat()
     
-    # Verificar si ya existe un estado de ánimo para hoy
-    existing_mood = db.moods.find_one({"user_id": current_user["id"], "date": today})
-    
-    mood_id = str(uuid.uuid4())
-    mood_doc = {
-        "id": mood_id,
-        "user_id": current_user["id"],
-        "mood_id": mood_data.mood_id,
-        "mood_emoji": mood_data.mood_emoji,
-        "note": mood_data.note,
-        "date": today,
-        "created_at": datetime.now(timezone.utc)
+    # Un único upsert sobre (user_id, date): crea el estado de hoy o lo reemplaza
+    mood_filter = {"user_id": current_user["id"], "date": today}
+    mood_update = {
+        "$set": {
+            "mood_id": mood_data.mood_id,
+            "mood_emoji": mood_data.mood_emoji,
+            "note": mood_data.note,
+            "created_at": datetime.now(timezone.utc)
+        },
+        "$setOnInsert": {"id": str(uuid.uuid4())}
     }
     
-    if existing_mood:
-        # Actualizar el estado existente
-        db.moods.update_one(
-            {"user_id": current_user["id"], "date": today},
-            {"$set": {
-                "mood_id": mood_data.mood_id,
-                "mood_emoji": mood_data.mood_emoji,
-                "note": mood_data.note,
-                "created_at": datetime.now(timezone.utc)
-            }}
-        )
-        mood_doc["id"] = existing_mood["id"]
-    else:
-        # Crear nuevo estado
-        db.moods.insert_one(mood_doc)
+    def upsert_mood():
+        with read_routing.write_session(db, current_user["id"], current_user.get("partner_id")) as session:
+            return db.moods.find_one_and_update(
+                mood_filter,
+                mood_update,
+                projection={"_id": 0},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE,
+                session=session
+            )
     
-    # Enviar notificación a la pareja si está vinculada
-    if current_user.get("partner_id"):
-        partner = db.users.find_one({"id": current_user["partner_id"]})
-        if partner:
-            # Aquí se podría enviar una notificación push
-            print(f"💕 {current_user['name']} actualizó su estado de ánimo a {mood_data.mood_emoji}")
+    try:
+        previous = upsert_mood()
+    except DuplicateKeyError:
+        # Dos envíos simultáneos: el índice único deja pasar uno, el otro actualiza ese documento
+        previous = upsert_mood()
+    # La notificación a la pareja la envía el change feed (notify_mood_update), solo si cambió el estado
+    if previous is None:
+        mood_doc = {**mood_filter, **mood_update["$set"], **mood_update["$setOnInsert"]}
+        await changes.written("moods", "insert", mood_doc, context={"author": current_user})
+    else:
+        mood_doc = {**previous, **mood_update["$set"]}
+        changed = {field: value for field, value in mood_update["$set"].items() if previous.get(field) != value}
+        await changes.written("moods", "update", mood_doc, changed, context={"author": current_user})
     
     return MoodResponse(**mood_doc)
 
 @app.get("/api/mood/weekly/{start_date}")
-async def get_weekly_moods(start_date: str, current_user = Depends(get_current_user)):
+async def get_weekly_moods(start_date: str, current_user = Depends(get_current_claims)):
     try:
         start_dt = datetime.fromisoformat(start_date).date()
     except ValueError:
@@ -613,18 +1286,24 @@ async def get_weekly_moods(start_date: str, current_user = Depends(get_current_u
     
     week_dates = [(start_dt + timedelta(days=i)).isoformat() for i in range(7)]
     
+    # Estados de ánimo de la semana de ambos en una sola consulta, compartida por la pareja
+    couple = single_flight.couple_key(current_user)
+    moods = await single_flight.coalescer.run(
+        "weekly_moods", couple, (start_dt.isoformat(),), lambda: {
+            (mood["user_id"], mood["date"]): mood
+            for mood in db.moods.find({"user_id": {"$in": list(couple)}, "date": {"$in": week_dates}})
+        }
+    )
+    
     user_moods = []
     partner_moods = []
     
     for date in week_dates:
-        user_mood = db.moods.find_one({"user_id": current_user["id"], "date": date})
+        user_mood = moods.get((current_user["id"], date))
         user_moods.append(MoodResponse(**user_mood) if user_mood else None)
         
-        if current_user.get("partner_id"):
-            partner_mood = db.moods.find_one({"user_id": current_user["partner_id"], "date": date})
-            partner_moods.append(MoodResponse(**partner_mood) if partner_mood else None)
-        else:
-            partner_moods.append(None)
+        partner_mood = moods.get((current_user.get("partner_id"), date))
+        partner_moods.append(MoodResponse(**partner_mood) if partner_mood else None)
     
     return {
         "start_date": start_date,
@@ -635,24 +1314,30 @@ async def get_weekly_moods(start_date: str, current_user = Depends(get_current_u
 
 # Endpoints para Recuerdos Especiales
 @app.get("/api/memories/special")
-async def get_special_memories(current_user = Depends(get_current_user)):
+async def get_special_memories(current_user = Depends(get_current_claims)):
     """Obtiene recuerdos aleatorios de actividades con 5 estrellas"""
     if not current_user.get("partner_id"):
         return {"memories": [], "message": "Necesitas tener pareja vinculada para ver recuerdos"}
     
-    # Buscar actividades de ambos con 5 estrellas
-    five_star_activities = list(db.activities.find({
-        "$and": [
-            {
-                "$or": [
-                    {"user_id": current_user["id"]},
-                    {"user_id": current_user["partner_id"]}
+    # Buscar actividades de ambos con 5 estrellas (misma lectura para los dos miembros)
+    def load_five_star_activities():
+        with read_routing.read_session(analytics_db, current_user["id"]) as session:
+            return list(analytics_db.activities.find({
+                "$and": [
+                    {
+                        "$or": [
+                            {"user_id": current_user["id"]},
+                            {"user_id": current_user["partner_id"]}
+                        ]
+                    },
+                    {"rating": 5},
+                    {"is_pending_rating": False}
                 ]
-            },
-            {"rating": 5},
-            {"is_pending_rating": False}
-        ]
-    }))
+            }, session=session))
+    
+    five_star_activities = await single_flight.coalescer.run(
+        "memories_special", single_flight.couple_key(current_user), (), load_five_star_activities
+    )
     
     if not five_star_activities:
         return {
@@ -694,7 +1379,7 @@ async def get_special_memories(current_user = Depends(get_current_user)):
 async def get_filtered_memories(
     days_back: int = 30,
     category: Optional[str] = None,
-    current_user = Depends(get_current_user)
+    current_user = Depends(get_current_claims)
 ):
     """Obtiene recuerdos filtrados por período y categoría"""
     if not current_user.get("partner_id"):
@@ -721,37 +1406,52 @@ async def get_filtered_memories(
     if category and category != "all":
         filters["$and"].append({"category": category})
     
-    activities = list(db.activities.find(filters).sort("date", -1))
+    def load_activities():
+        with read_routing.read_session(analytics_db, current_user["id"]) as session:
+            return list(analytics_db.activities.find(filters, session=session).sort("date", -1))
     
-    memories = []
-    for activity in activities:
-        activity_date = datetime.fromisoformat(activity["date"]).date()
-        today = datetime.now(timezone.utc).date()
-        days_ago = (today - activity_date).days
+    async def build_memories():
+        activities = await single_flight.coalescer.run(
+            "memories_filter", single_flight.couple_key(current_user), (days_back, category or "all"), load_activities
+        )
         
-        if activity["user_id"] == current_user["id"]:
-            memory_message = f"Tu gesto especial hace {days_ago} días"
-        else:
-            memory_message = f"Gesto especial de tu pareja hace {days_ago} días"
+        memories = []
+        for activity in activities:
+            activity_date = datetime.fromisoformat(activity["date"]).date()
+            today = datetime.now(timezone.utc).date()
+            days_ago = (today - activity_date).days
+            
+            if activity["user_id"] == current_user["id"]:
+                memory_message = f"Tu gesto especial hace {days_ago} días"
+            else:
+                memory_message = f"Gesto especial de tu pareja hace {days_ago} días"
+            
+            memories.append(MemoryResponse(
+                activity=ActivityResponse(**activity),
+                days_ago=days_ago,
+                memory_message=memory_message
+            ))
         
-        memories.append(MemoryResponse(
-            activity=ActivityResponse(**activity),
-            days_ago=days_ago,
-            memory_message=memory_message
-        ))
+        return {
+            "memories": memories,
+            "filter_applied": {
+                "days_back": days_back,
+                "category": category or "all"
+            },
+            "total_found": len(memories)
+        }
     
-    return {
-        "memories": memories,
-        "filter_applied": {
-            "days_back": days_back,
-            "category": category or "all"
-        },
-        "total_found": len(memories)
-    }
+    # Por usuario: los mensajes dependen de quién mira
+    return await view_cache.views.get_or_compute(
+        "memories_filter",
+        (current_user["id"], current_user["partner_id"], days_back, category or "all", limit_date),
+        [("activities", current_user["id"]), ("activities", current_user["partner_id"])],
+        build_memories
+    )
 
 # Endpoints de estadísticas expandidas
 @app.get("/api/stats/correlation")
-async def get_mood_activity_correlation(current_user = Depends(get_current_user)):
+async def get_mood_activity_correlation(current_user = Depends(get_current_claims)):
     """Correlaciona actividades con mejoras en el estado de ánimo"""
     if not current_user.get("partner_id"):
         return {"correlation": [], "message": "Necesitas pareja vinculada para ver correlaciones"}
@@ -760,40 +1460,51 @@ async def get_mood_activity_correlation(current_user = Depends(get_current_user)
     end_date = datetime.now(timezone.utc).date()
     start_date = end_date - timedelta(days=30)
     
-    correlation_data = []
-    for i in range(30):
-        date = (start_date + timedelta(days=i)).isoformat()
-        
-        # Estado de ánimo de la pareja ese día
-        partner_mood = db.moods.find_one({"user_id": current_user["partner_id"], "date": date})
-        
-        # Actividades del usuario hacia la pareja ese día
-        user_activities = list(db.activities.find({
-            "user_id": current_user["id"],
-            "date": date,
-            "rating": {"$exists": True, "$ne": None}
-        }))
+    def compute_correlation():
+        correlation_data = []
+        with read_routing.read_session(analytics_db, current_user["id"]) as session:
+            for i in range(30):
+                date = (start_date + timedelta(days=i)).isoformat()
+                
+                # Estado de ánimo de la pareja ese día
+                partner_mood = analytics_db.moods.find_one(
+                    {"user_id": current_user["partner_id"], "date": date}, session=session
+                )
+                
+                # Actividades del usuario hacia la pareja ese día
+                user_activities = list(analytics_db.activities.find({
+                    "user_id": current_user["id"],
+                    "date": date,
+                    "rating": {"$exists": True, "$ne": None}
+                }, session=session))
+                
+                if partner_mood and user_activities:
+                    avg_activity_rating = sum(act["rating"] for act in user_activities) / len(user_activities)
+                    
+                    correlation_data.append({
+                        "date": date,
+                        "partner_mood_id": partner_mood["mood_id"],
+                        "partner_mood_emoji": partner_mood["mood_emoji"],
+                        "your_activities_avg_rating": avg_activity_rating,
+                        "activities_count": len(user_activities)
+                    })
         
-        if partner_mood and user_activities:
-            avg_activity_rating = sum(act["rating"] for act in user_activities) / len(user_activities)
-            
-            correlation_data.append({
-                "date": date,
-                "partner_mood_id": partner_mood["mood_id"],
-                "partner_mood_emoji": partner_mood["mood_emoji"],
-                "your_activities_avg_rating": avg_activity_rating,
-                "activities_count": len(user_activities)
-            })
+        return {
+            "correlation_data": correlation_data,
+            "period_days": 30,
+            "message": f"Datos de correlación de los últimos 30 días ({len(correlation_data)} días con datos)"
+        }
     
-    return {
-        "correlation_data": correlation_data,
-        "period_days": 30,
-        "message": f"Datos de correlación de los últimos 30 días ({len(correlation_data)} días con datos)"
-    }
+    return await view_cache.views.get_or_compute(
+        "correlation",
+        (current_user["id"], current_user["partner_id"], end_date.isoformat()),
+        [("activities", current_user["id"]), ("moods", current_user["partner_id"]), ("users", current_user["id"])],
+        lambda: asyncio.to_thread(compute_correlation)
+    )
 
 # Nuevos endpoints para notificaciones
 @app.post("/api/notifications/subscribe")
-async def subscribe_to_notifications(subscription: NotificationSubscription, current_user = Depends(get_current_user)):
+async def subscribe_to_notifications(subscription: NotificationSubscription, current_user = Depends(get_current_claims)):
     """Suscribir usuario a notificaciones push"""
     
     # Verificar si ya existe la suscripción
@@ -822,7 +1533,7 @@ async def subscribe_to_notifications(subscription: NotificationSubscription, cur
     }
 
 @app.get("/api/notifications")
-async def get_user_notifications(current_user = Depends(get_current_user)):
+async def get_user_notifications(current_user = Depends(get_current_claims)):
     """Obtiene las notificaciones del usuario"""
     
     notifications = list(db.notifications.find({
@@ -835,102 +1546,388 @@ async def get_user_notifications(current_user = Depends(get_current_user)):
     
     return {
         "notifications": notifications,
-        "unread_count": db.notifications.count_documents({
-            "user_id": current_user["id"],
-            "read": False
-        })
+        "unread_count": notification_retention.unread_count(db, current_user["id"])
     }
 
+@app.put("/api/notifications/read-all")
+async def mark_all_notifications_as_read(current_user = Depends(get_current_claims)):
+    """Marca como leídas todas las notificaciones del usuario"""
+    
+    marked = notification_retention.mark_read(db, current_user["id"])
+    
+    return {"message": "Notificaciones marcadas como leídas", "marked": marked}
+
 @app.put("/api/notifications/{notification_id}/read")
-async def mark_notification_as_read(notification_id: str, current_user = Depends(get_current_user)):
+async def mark_notification_as_read(notification_id: str, current_user = Depends(get_current_claims)):
     """Marca una notificación como leída"""
     
-    result = db.notifications.update_one(
-        {
-            "id": notification_id,
-            "user_id": current_user["id"]
-        },
-        {"$set": {"read": True}}
-    )
+    marked = notification_retention.mark_read(db, current_user["id"], notification_id)
     
-    if result.matched_count == 0:
+    # Ya leída: mismo resultado que antes; solo es 404 si no existe
+    if not marked and db.notifications.count_documents(
+        {"id": notification_id, "user_id": current_user["id"]}, limit=1
+    ) == 0:
         raise HTTPException(status_code=404, detail="Notificación no encontrada")
     
     return {"message": "Notificación marcada como leída"}
 
 # Endpoints de gamificación expandida
 @app.get("/api/achievements")
-async def get_user_achievements(current_user = Depends(get_current_user)):
+async def get_user_achievements(current_user = Depends(get_current_claims)):
     """Obtiene logros y insignias del usuario"""
-    # Calcular estadísticas para insignias
-    total_activities = db.activities.count_documents({"user_id": current_user["id"]})
-    five_star_activities = db.activities.count_documents({
-        "user_id": current_user["id"],
-        "rating": 5,
-        "is_pending_rating": False
-    })
-    
-    # Actividades por categoría
-    categories = ["physical", "emotional", "practical", "general"]
-    category_counts = {}
-    for cat in categories:
-        category_counts[cat] = db.activities.count_documents({
-            "user_id": current_user["id"],
-            "category": cat
-        })
-    
-    # Verificar recuerdos revisados (simulado)
-    memories_viewed = db.moods.count_documents({"user_id": current_user["id"]})
+    def compute_achievements():
+        # Estadísticas para insignias (resumen mantenido por el change feed)
+        stats = load_user_stats(current_user["id"])
+        total_activities = stats["activities"]
+        five_star_activities = stats["five_star_activities"]
+        
+        # Actividades por categoría
+        category_counts = dict(stats["categories"])
+        
+        # Verificar recuerdos revisados (simulado)
+        memories_viewed = stats["moods"]
+        
+        # Generar insignias
+        achievements = []
+        
+        if total_activities >= 10:
+            achievements.append({
+                "id": "first_steps",
+                "name": "Primeros Pasos",
+                "description": "Has registrado 10 actos de amor",
+                "icon": "🎯",
+                "unlocked_at": datetime.now(timezone.utc)
+            })
+        
+        if five_star_activities >= 5:
+            achievements.append({
+                "id": "five_star_lover",
+                "name": "Amante 5 Estrellas",
+                "description": "Has recibido 5 calificaciones de 5 estrellas",
+                "icon": "⭐",
+                "unlocked_at": datetime.now(timezone.utc)
+            })
+        
+        if category_counts["emotional"] >= 5:
+            achievements.append({
+                "id": "emotional_master",
+                "name": "Maestro Emocional",
+                "description": "Has registrado 5 actos emocionales",
+                "icon": "💝",
+                "unlocked_at": datetime.now(timezone.utc)
+            })
+        
+        if memories_viewed >= 10:
+            achievements.append({
+                "id": "nostalgic_year",
+                "name": "Nostálgico del Año",
+                "description": "Has revisado muchos recuerdos especiales",
+                "icon": "📸",
+                "unlocked_at": datetime.now(timezone.utc)
+            })
+        
+        return {
+            "achievements": achievements,
+            "stats": {
+                "total_activities": total_activities,
+                "five_star_activities": five_star_activities,
+                "category_distribution": category_counts,
+                "memories_engagement": memories_viewed
+            }
+        }
     
-    # Generar insignias
-    achievements = []
+    return await view_cache.views.get_or_compute(
+        "achievements",
+        (current_user["id"],),
+        [("user_stats", current_user["id"])],
+        lambda: asyncio.to_thread(compute_achievements)
+    )
+
+# Endpoints de exportación
+# Secciones en el orden en que se exportan: (nombre, colección, filtro extra, campos)
+# (tipo, colección, filtro extra, campos, incluye a la pareja)
+EXPORT_SECTIONS = [
+    ("activity", "activities", {}, [
+        "id", "user_id", "user_name", "description", "category", "time_of_day",
+        "rating", "partner_comment", "is_pending_rating", "date", "created_at", "rated_at"
+    ], True),
+    ("rating", "activities", {"is_pending_rating": False}, [
+        "id", "user_id", "rating", "partner_comment", "date", "rated_at"
+    ], True),
+    ("mood", "moods", {}, [
+        "id", "user_id", "mood_id", "mood_emoji", "note", "date", "created_at"
+    ], True),
+    # Las notificaciones son de quien las recibe: nunca se exportan las de la pareja
+    ("notification", "notifications", {}, [
+        "id", "user_id", "title", "body", "tag", "read", "created_at"
+    ], False),
+]
+
+EXPORT_CSV_COLUMNS = ["type", "cursor"] + list(dict.fromkeys(
+    field for _, _, _, fields, _ in EXPORT_SECTIONS for field in fields
+))
+
+def encode_export_cursor(section: int, last_id: ObjectId) -> str:
+    """Token opaco para reanudar la exportación después de un documento"""
+    raw = json.dumps({"s": section, "a": str(last_id)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip("=")
+
+def decode_export_cursor(token: str):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        section = int(data["s"])
+        last_id = ObjectId(data["a"])
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Cursor de exportación inválido")
+    if not (0 <= section < len(EXPORT_SECTIONS)):
+        raise HTTPException(status_code=400, detail="Cursor de exportación inválido")
+    return section, last_id
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def iter_export_records(user_id: str, partner_id: Optional[str] = None, start_section: int = 0,
+                        after_id: Optional[ObjectId] = None):
+    """Recorre las colecciones de la pareja directamente desde los cursores de Mongo"""
+    for section in range(start_section, len(EXPORT_SECTIONS)):
+        record_type, collection, extra_filter, fields, shared = EXPORT_SECTIONS[section]
+        user_ids = [user_id, partner_id] if shared and partner_id else [user_id]
+        query = {"user_id": {"$in": user_ids}, **extra_filter}
+        if section == start_section and after_id is not None:
+            query["_id"] = {"$gt": after_id}
+        
+        projection = {field: 1 for field in fields}
+        cursor = db[collection].find(query, projection).sort("_id", ASCENDING).batch_size(EXPORT_BATCH_SIZE)
+        try:
+            for doc in cursor:
+                record = {field: _export_value(doc.get(field)) for field in fields}
+                yield record_type, encode_export_cursor(section, doc["_id"]), record
+        finally:
+            cursor.close()
+
+def iter_export_ndjson(records):
+    for record_type, cursor_token, record in records:
+        line = json.dumps({"type": record_type, "cursor": cursor_token, "data": record}, ensure_ascii=False)
+        yield line + "\n"
+    yield json.dumps({"type": "end"}) + "\n"
+
+def iter_export_csv(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_CSV_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    for record_type, cursor_token, record in records:
+        writer.writerow({"type": record_type, "cursor": cursor_token, **record})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+def iter_export_chunks(lines, compress: bool):
+    """Agrupa las líneas en bloques de tamaño acotado y opcionalmente los comprime"""
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 -> formato gzip
+    pending = []
+    pending_size = 0
+    for line in lines:
+        data = line.encode('utf-8')
+        pending.append(data)
+        pending_size += len(data)
+        if pending_size >= EXPORT_CHUNK_BYTES:
+            chunk = b"".join(pending)
+            pending = []
+            pending_size = 0
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    
+    chunk = b"".join(pending)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+@app.get("/api/export")
+async def export_couple_data(
+    format: str = "ndjson",
+    gzip: bool = False,
+    cursor: Optional[str] = None,
+    current_user = Depends(get_current_claims)
+):
+    """Exporta en streaming actividades, calificaciones y estados de ánimo de la pareja, y las notificaciones propias"""
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Formato no soportado (usar ndjson o csv)")
     
-    if total_activities >= 10:
-        achievements.append({
-            "id": "first_steps",
-            "name": "Primeros Pasos",
-            "description": "Has registrado 10 actos de amor",
-            "icon": "🎯",
-            "unlocked_at": datetime.now(timezone.utc)
-        })
+    start_section, after_id = decode_export_cursor(cursor) if cursor else (0, None)
     
-    if five_star_activities >= 5:
-        achievements.append({
-            "id": "five_star_lover",
-            "name": "Amante 5 Estrellas",
-            "description": "Has recibido 5 calificaciones de 5 estrellas",
-            "icon": "⭐",
-            "unlocked_at": datetime.now(timezone.utc)
-        })
+    records = iter_export_records(current_user["id"], current_user.get("partner_id"), start_section, after_id)
+    if format == "ndjson":
+        lines = iter_export_ndjson(records)
+        media_type = "application/x-ndjson"
+    else:
+        lines = iter_export_csv(records)
+        media_type = "text/csv"
+    
+    filename = f"loveacts-export.{format}"
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+    
+    # El generador es síncrono: Starlette lo recorre en el threadpool sin bloquear el event loop
+    return StreamingResponse(
+        iter_export_chunks(lines, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# Endpoints de administración
+@app.post("/api/admin/profile/cpu", dependencies=[Depends(require_admin)])
+async def profile_cpu(seconds: float = 10, interval_ms: float = 5, include_idle: bool = False):
+    """Perfil de CPU por muestreo de este worker, en formato collapsed stacks (flamegraph)"""
+    if not (0 < seconds <= profiling.MAX_CPU_PROFILE_SECONDS):
+        raise HTTPException(status_code=400, detail=f"seconds debe estar entre 0 y {profiling.MAX_CPU_PROFILE_SECONDS}")
+    if not profiling.cpu_profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Ya hay un perfil de CPU en curso")
     
-    if category_counts["emotional"] >= 5:
-        achievements.append({
-            "id": "emotional_master",
-            "name": "Maestro Emocional",
-            "description": "Has registrado 5 actos emocionales",
-            "icon": "💝",
-            "unlocked_at": datetime.now(timezone.utc)
-        })
+    try:
+        # El muestreo corre en otro hilo para poder observar al event loop trabajando
+        collapsed = await asyncio.to_thread(
+            profiling.sample_cpu, seconds, max(interval_ms, 1) / 1000, include_idle
+        )
+    finally:
+        profiling.cpu_profile_lock.release()
     
-    if memories_viewed >= 10:
-        achievements.append({
-            "id": "nostalgic_year",
-            "name": "Nostálgico del Año",
-            "description": "Has revisado muchos recuerdos especiales",
-            "icon": "📸",
-            "unlocked_at": datetime.now(timezone.utc)
-        })
+    return PlainTextResponse(
+        collapsed,
+        headers={"Content-Disposition": 'attachment; filename="cpu-profile.collapsed"'}
+    )
+
+@app.post("/api/admin/profile/memory/start", dependencies=[Depends(require_admin)])
+async def start_memory_profile(frames: int = 10):
+    """Activa tracemalloc y toma la instantánea base"""
+    await asyncio.to_thread(profiling.start_memory_tracing, min(max(frames, 1), 50))
+    return {"message": "tracemalloc activado", "frames": frames}
+
+@app.get("/api/admin/profile/memory/snapshot", dependencies=[Depends(require_admin)])
+async def get_memory_snapshot(limit: int = 25, group_by: str = "lineno", reset_baseline: bool = False):
+    """Mayores asignaciones vivas y crecimiento desde la instantánea base"""
+    if group_by not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="group_by debe ser lineno, filename o traceback")
+    try:
+        return await asyncio.to_thread(profiling.memory_snapshot, limit, group_by, reset_baseline)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.post("/api/admin/profile/memory/stop", dependencies=[Depends(require_admin)])
+async def stop_memory_profile():
+    await asyncio.to_thread(profiling.stop_memory_tracing)
+    return {"message": "tracemalloc desactivado"}
+
+analytics_export_lock = threading.Lock()
+last_analytics_export = {"status": "never_run"}
+
+def run_analytics_export_job(full: bool):
+    """Corre la exportación Parquet en el threadpool; solo una a la vez por proceso"""
+    global last_analytics_export
+    from analytics_export import run_export  # pyarrow solo se carga al usarse
     
+    try:
+        last_analytics_export = {"status": "running", "started_at": datetime.now(timezone.utc)}
+        summary = run_export(db, ANALYTICS_EXPORT_DIR, full=full)
+        last_analytics_export = {"status": "completed", "finished_at": datetime.now(timezone.utc), **summary}
+    except Exception as e:
+        logger.exception("Error en exportación analítica")
+        last_analytics_export = {"status": "failed", "error": str(e), "finished_at": datetime.now(timezone.utc)}
+    finally:
+        analytics_export_lock.release()
+
+@app.post("/api/admin/analytics-export", dependencies=[Depends(require_admin)])
+async def start_analytics_export(background_tasks: BackgroundTasks, full: bool = False):
+    """Lanza la exportación Parquet de activities y moods (incremental por defecto)"""
+    if not analytics_export_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Ya hay una exportación en curso")
+    
+    background_tasks.add_task(run_analytics_export_job, full)
+    return {"message": "Exportación analítica iniciada", "output_dir": ANALYTICS_EXPORT_DIR}
+
+@app.get("/api/admin/analytics-export", dependencies=[Depends(require_admin)])
+async def get_analytics_export_status():
+    return last_analytics_export
+
+@app.get("/api/admin/slow-queries", dependencies=[Depends(require_admin)])
+async def get_slow_queries(limit: int = 20, since_hours: int = 24):
+    """Formas de consulta más lentas, con su plan y si hicieron COLLSCAN"""
     return {
-        "achievements": achievements,
-        "stats": {
-            "total_activities": total_activities,
-            "five_star_activities": five_star_activities,
-            "category_distribution": category_counts,
-            "memories_engagement": memories_viewed
-        }
+        "threshold_ms": slow_queries.SLOW_QUERY_MS,
+        "slow_queries": slow_queries.worst_offenders(db, min(limit, 100), since_hours)
     }
 
+@app.post("/api/admin/notifications/archive", dependencies=[Depends(require_admin)])
+async def archive_old_notifications():
+    """Archiva ya las notificaciones no leídas más antiguas que NOTIFICATIONS_ARCHIVE_DAYS y corrige los contadores"""
+    archived = await asyncio.to_thread(notification_retention.archive_unread, db)
+    fixed = await asyncio.to_thread(notification_retention.reconcile_counters, db)
+    return {"archived": archived, "counters_fixed": fixed}
+
+@app.get("/api/admin/view-cache", dependencies=[Depends(require_admin)])
+async def get_view_cache_stats():
+    """Tasa de aciertos por vista (en este worker) y memoria de la caché de vistas"""
+    return await view_cache.views.stats()
+
+# Mongo no disponible o demasiado lento: 503 en lugar de 500
+@app.exception_handler(ConnectionFailure)
+@app.exception_handler(ExecutionTimeout)
+async def database_unavailable_handler(request, exc):
+    if isinstance(exc, (ServerSelectionTimeoutError, WaitQueueTimeoutError)):
+        # Sin comando enviado: el listener del breaker no lo vio
+        circuit_breaker.breaker.record(True)
+    logger.warning("Base de datos no disponible", extra={"error": str(exc), "path": request.url.path})
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "La base de datos no responde, reintenta en unos segundos"},
+        headers={"Retry-After": str(circuit_breaker.breaker.retry_after())}
+    )
+
+# Ciclo de vida del worker
+background_monitors = set()
+
+async def startup():
+    logging_config.setup_logging()  # solo hace algo si el proceso viene de un fork
+    db.open()  # no bloquea: pymongo conecta en segundo plano
+    # Los índices se crean en un hilo: el worker responde sin esperar a Mongo
+    background_monitors.add(asyncio.create_task(ensure_indexes_with_retry()))
+    background_monitors.add(asyncio.create_task(metrics.monitor_event_loop_lag()))
+    slow_query_recorder.start(db)
+    if notification_retention.NOTIFICATIONS_ARCHIVE_INTERVAL_SECONDS > 0:
+        background_monitors.add(asyncio.create_task(notification_retention.run_archiver(db)))
+    if change_feed.CHANGE_FEED_MODE == "stream":
+        changes.start()
+    logger.info("Worker listo", extra={"pid": os.getpid(), "storage": STORAGE_BACKEND})
+
+async def shutdown():
+    """Apagado ordenado: el servidor ya dejó de aceptar peticiones y esperó a las que estaban en curso"""
+    # Primero el change feed: termina el evento en curso (y sus notificaciones) y guarda su posición
+    await changes.stop(timeout=SHUTDOWN_DRAIN_SECONDS)
+    if pending_notifications:
+        logger.info("Esperando notificaciones pendientes", extra={"pending": len(pending_notifications)})
+        await asyncio.wait(set(pending_notifications), timeout=SHUTDOWN_DRAIN_SECONDS)
+    for task in background_monitors:
+        task.cancel()
+    await asyncio.gather(*background_monitors, return_exceptions=True)
+    background_monitors.clear()
+    slow_query_recorder.stop()
+    tracing.exporter.stop()
+    db.close()
+    logger.info("Worker detenido", extra={"pid": os.getpid()})
+    logging_config.shutdown_logging()
+
+# Métricas
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    body, content_type = metrics.render_metrics()
+    return Response(content=body, media_type=content_type)
+
 # Endpoint de salud
 @app.get("/api/health")
 async def health_check():
@@ -940,6 +1937,49 @@ async def health_check():
         "version": "2.0.0"
     }
 
+@app.get("/api/health/live")
+async def liveness_check():
+    """El proceso responde; no consulta dependencias"""
+    return {"status": "alive"}
+
+def ping_database():
+    with pymongo.timeout(READINESS_TIMEOUT_SECONDS):
+        db.command("ping")
+
+@app.get("/api/health/ready")
+async def readiness_check():
+    """Mongo responde, los índices están creados y el pool del worker no está agotado
+    (503 si no: el balanceador deja de enviarle tráfico)"""
+    ready = True
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(asyncio.to_thread(ping_database), READINESS_TIMEOUT_SECONDS)
+        mongo = {"status": "ok", "latency_ms": round((time.perf_counter() - start) * 1000, 1)}
+    except (asyncio.TimeoutError, PyMongoError) as e:
+        ready = False
+        mongo = {"status": "error", "error": str(e) or "timeout"}
+
+    indexes = {"status": "ok" if indexes_ready else "pending"}
+    if not indexes_ready:
+        ready = False
+
+    pool = pool_listener.saturation()
+    pool["status"] = "ok"
+    if pool["saturation"] >= READINESS_MAX_POOL_SATURATION:
+        ready = False
+        pool["status"] = "saturated"
+
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "not_ready",
+            # El breaker es informativo: abierto en todos los workers a la vez, sacarlos dejaría sin servicio
+            "checks": {"mongo": mongo, "indexes": indexes, "pool": pool, "circuit_breaker": circuit_breaker.breaker.state}
+        }
+    )
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    # Un solo proceso para desarrollo; en producción usar run.py (varios workers)
+    # log_config=None: los logs de uvicorn pasan por el logging estructurado
+    uvicorn.run(app, host="0.0.0.0", port=8001, log_config=None)
\ No newline at end of file
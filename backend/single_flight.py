@@ -0,0 +1,113 @@
+"""
+Coalescencia de lecturas idénticas por pareja (single-flight) con micro-caché
+
+Los dos miembros de una pareja suelen abrir la app a la vez (por ejemplo al
+tocar la notificación de new_activity) y piden los mismos datos: actividades
+y estados de ánimo del día, recuerdos... Las lecturas se identifican por
+(pareja, endpoint, parámetros): si ya hay una igual en curso, la petición
+espera su resultado en lugar de repetir las consultas, y el resultado se
+reutiliza durante SINGLE_FLIGHT_TTL_SECONDS.
+
+La consulta corre en un hilo (asyncio.to_thread) para que el event loop pueda
+atender mientras tanto a quien llega con la misma petición. El resultado es
+compartido: quien lo recibe no debe modificarlo.
+
+Las escrituras llaman a invalidate() con los miembros afectados: lo guardado
+deja de servirse y las lecturas posteriores no se unen a las que ya estaban
+en curso. Con varios workers cada uno tiene su propia caché, acotada por el TTL.
+La generación de un usuario se olvida cuando pasó el TTL desde su última
+escritura y no tiene lecturas en curso: ya no queda nada que invalidar.
+"""
+
+import asyncio
+import itertools
+import os
+import time
+from collections import OrderedDict
+
+import metrics
+
+SINGLE_FLIGHT_TTL_SECONDS = float(os.environ.get("SINGLE_FLIGHT_TTL_SECONDS", "1"))
+SINGLE_FLIGHT_MAX_ENTRIES = int(os.environ.get("SINGLE_FLIGHT_MAX_ENTRIES", "10000"))
+
+
+def couple_key(user):
+    """Miembros de la pareja del usuario (o solo él), en orden estable"""
+    return tuple(sorted(member for member in (user["id"], user.get("partner_id")) if member))
+
+
+class SingleFlight:
+    def __init__(self, ttl=SINGLE_FLIGHT_TTL_SECONDS, max_entries=SINGLE_FLIGHT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._inflight = {}  # (pareja, endpoint, params, generación) -> tarea
+        self._cache = OrderedDict()  # (pareja, endpoint, params) -> (caduca, generación, valor)
+        self._generations = OrderedDict()  # usuario -> (generación, instante), por última escritura
+        self._sequence = itertools.count(1)  # nunca repite una generación, aunque se olvide
+
+    def _generation(self, couple):
+        return tuple(self._generations.get(member, (0,))[0] for member in couple)
+
+    async def run(self, endpoint, couple, params, compute):
+        """Resultado de compute() (síncrona, en un hilo), compartido entre lecturas idénticas"""
+        key = (couple, endpoint, params)
+        generation = self._generation(couple)
+
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > time.monotonic() and entry[1] == generation:
+            metrics.SINGLE_FLIGHT.labels(endpoint, "cached").inc()
+            return entry[2]
+
+        flight_key = key + (generation,)
+        task = self._inflight.get(flight_key)
+        if task is None:
+            metrics.SINGLE_FLIGHT.labels(endpoint, "computed").inc()
+            task = asyncio.ensure_future(asyncio.to_thread(compute))
+            self._inflight[flight_key] = task
+            task.add_done_callback(lambda done: self._finish(flight_key, key, generation, done))
+        else:
+            metrics.SINGLE_FLIGHT.labels(endpoint, "joined").inc()
+        # shield: si quien lanzó la consulta se desconecta, los demás siguen esperándola
+        return await asyncio.shield(task)
+
+    def _finish(self, flight_key, key, generation, task):
+        del self._inflight[flight_key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        if generation != self._generation(key[0]):
+            return  # hubo una escritura mientras se leía
+        self._cache[key] = (time.monotonic() + self.ttl, generation, task.result())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        # Lo guardado con la generación anterior deja de servirse y sale por TTL o LRU
+        now = time.monotonic()
+        for user_id in user_ids:
+            if user_id:
+                self._generations[user_id] = (next(self._sequence), now)
+                self._generations.move_to_end(user_id)
+        self._forget_idle(now)
+
+    def _forget_idle(self, now):
+        """Olvida las generaciones que ya no distinguen nada guardado ni en curso
+
+        Lo guardado antes de la última escritura ya caducó, y lo guardado
+        después tiene una generación que no vuelve a darse.
+        """
+        idle = []
+        for user_id, (_, invalidated_at) in self._generations.items():
+            if now - invalidated_at <= self.ttl:
+                break
+            idle.append(user_id)
+        if not idle:
+            return
+        # Con una lectura en curso se conserva: pudo empezar antes de la escritura
+        reading = {member for couple, *_ in self._inflight for member in couple}
+        for user_id in idle:
+            if user_id not in reading:
+                del self._generations[user_id]
+
+
+coalescer = SingleFlight()
@@ -0,0 +1,248 @@
+"""
+Registro de consultas lentas con explain automático
+
+Los comandos de lectura que superan SLOW_QUERY_MS se encolan (sin bloquear la
+petición) y un hilo en segundo plano obtiene su plan con
+explain("executionStats"), detecta COLLSCAN y guarda el resultado en la
+colección capada `slow_queries`. Cada forma de consulta se explica como mucho
+una vez cada SLOW_QUERY_EXPLAIN_INTERVAL segundos.
+
+Configuración por entorno:
+    SLOW_QUERY_MS                  umbral en milisegundos (por defecto 100)
+    SLOW_QUERY_EXPLAIN_INTERVAL    segundos entre explains de una misma forma (por defecto 300)
+    SLOW_QUERIES_CAPPED_MB         tamaño de la colección capada (por defecto 16)
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo import monitoring
+from pymongo.errors import CollectionInvalid
+
+import query_budget
+
+logger = logging.getLogger("loveacts.slow_queries")
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.environ.get("SLOW_QUERY_EXPLAIN_INTERVAL", "300"))
+SLOW_QUERIES_CAPPED_MB = int(os.environ.get("SLOW_QUERIES_CAPPED_MB", "16"))
+SLOW_QUERIES_COLLECTION = "slow_queries"
+EXPLAIN_MAX_TIME_MS = 5000
+
+# Comandos que explain("executionStats") puede ejecutar sin escribir
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct"}
+# Campos que añade el driver y que no forman parte de la consulta
+DRIVER_FIELDS = {"lsid", "$db", "$clusterTime", "$readPreference", "txnNumber", "readConcern", "cursor"}
+
+
+def normalize_query(value):
+    """Sustituye los valores por '?' conservando campos y operadores"""
+    if isinstance(value, dict):
+        return {key: normalize_query(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        normalized = [normalize_query(item) for item in value]
+        # Listas de valores ($in, etc.) se colapsan para que su longitud no cambie la forma
+        if all(item == "?" for item in normalized):
+            return ["?"] if normalized else []
+        return normalized
+    return "?"
+
+
+def command_query(command_name, command):
+    if command_name == "find":
+        return {key: command.get(key) for key in ("filter", "sort", "projection") if command.get(key)}
+    if command_name == "aggregate":
+        return {"pipeline": command.get("pipeline", [])}
+    if command_name in ("count", "distinct"):
+        return {"query": command.get("query") or {}}
+    return {}
+
+
+def collect_plan_stages(plan, stages=None):
+    """Todas las etapas ('stage') de un documento explain, en cualquier profundidad"""
+    stages = [] if stages is None else stages
+    if isinstance(plan, dict):
+        if isinstance(plan.get("stage"), str):
+            stages.append(plan["stage"])
+        for value in plan.values():
+            collect_plan_stages(value, stages)
+    elif isinstance(plan, list):
+        for value in plan:
+            collect_plan_stages(value, stages)
+    return stages
+
+
+def find_first(document, key):
+    if isinstance(document, dict):
+        if key in document:
+            return document[key]
+        values = document.values()
+    elif isinstance(document, list):
+        values = document
+    else:
+        return None
+    for value in values:
+        found = find_first(value, key)
+        if found is not None:
+            return found
+    return None
+
+
+def reply_docs_returned(command_name, reply):
+    if command_name in ("find", "aggregate"):
+        return len(reply.get("cursor", {}).get("firstBatch", []))
+    if command_name == "count":
+        return reply.get("n")
+    if command_name == "distinct":
+        return len(reply.get("values", []))
+    return None
+
+
+class SlowQueryRecorder(monitoring.CommandListener):
+    def __init__(self, max_queue: int = 256):
+        self._pending = {}
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._last_explained = {}
+        self._thread = None
+        self.db = None
+
+    # Listener: solo registra el comando y encola; nunca consulta la base de datos
+    def started(self, event):
+        if event.command_name not in EXPLAINABLE_COMMANDS:
+            return
+        if event.command.get(event.command_name) == SLOW_QUERIES_COLLECTION:
+            return
+        stats = query_budget.current_query_stats.get()
+        route = stats.scope.get("route") if stats is not None and stats.scope is not None else None
+        self._pending[(event.connection_id, event.request_id)] = (event.command, route.path if route else None)
+
+    def succeeded(self, event):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None or event.duration_micros < SLOW_QUERY_MS * 1000:
+            return
+        command, route_path = pending
+        item = {
+            "command_name": event.command_name,
+            "database": event.database_name,
+            "command": {key: value for key, value in command.items() if key not in DRIVER_FIELDS},
+            "route": route_path,
+            "duration_ms": event.duration_micros / 1000,
+            "docs_returned": reply_docs_returned(event.command_name, event.reply),
+        }
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            pass  # bajo carga extrema se descartan muestras antes que frenar peticiones
+
+    def failed(self, event):
+        self._pending.pop((event.connection_id, event.request_id), None)
+
+    # Hilo en segundo plano
+    def start(self, db):
+        self.db = db
+        self._thread = threading.Thread(target=self._run, name="slow-query-recorder", daemon=True)
+        self._thread.start()
+
+    def _create_collection(self):
+        try:
+            self.db.create_collection(SLOW_QUERIES_COLLECTION, capped=True, size=SLOW_QUERIES_CAPPED_MB * 1024 * 1024)
+        except CollectionInvalid:
+            pass  # ya existe
+        except Exception as e:
+            logger.warning("No se pudo crear la colección %s: %s", SLOW_QUERIES_COLLECTION, e)
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        # En el hilo: el arranque del worker no espera a Mongo
+        self._create_collection()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._record(item)
+            except Exception as e:
+                logger.warning("Error registrando consulta lenta: %s", e)
+
+    def _record(self, item):
+        command_name = item["command_name"]
+        command = item["command"]
+        collection = command.get(command_name)
+        # Como texto: los operadores ($in, $gte...) no son nombres de campo válidos al guardar
+        normalized = json.dumps(normalize_query(command_query(command_name, command)), sort_keys=True, default=str)
+        shape = f"{command_name} {collection} {normalized}"
+
+        record = {
+            "shape": shape,
+            "command": command_name,
+            "collection": collection,
+            "query": normalized,
+            "route": item["route"],
+            "duration_ms": item["duration_ms"],
+            "docs_returned": item["docs_returned"],
+            "docs_examined": None,
+            "keys_examined": None,
+            "plan_stages": None,
+            "collscan": None,
+            "explained": False,
+            "created_at": datetime.now(timezone.utc),
+        }
+
+        now = time.monotonic()
+        if now - self._last_explained.get(shape, float("-inf")) >= SLOW_QUERY_EXPLAIN_INTERVAL:
+            self._last_explained[shape] = now
+            explain = self.db.client[item["database"]].command(
+                "explain", command, verbosity="executionStats", maxTimeMS=EXPLAIN_MAX_TIME_MS
+            )
+            stages = collect_plan_stages(find_first(explain, "queryPlanner") or explain)
+            record.update({
+                "docs_examined": find_first(explain, "totalDocsExamined"),
+                "keys_examined": find_first(explain, "totalKeysExamined"),
+                "plan_stages": stages,
+                "collscan": "COLLSCAN" in stages,
+                "explained": True,
+            })
+            if record["collscan"]:
+                logger.warning("COLLSCAN en %s (%.1f ms, ruta %s)", shape, item["duration_ms"], item["route"])
+
+        self.db[SLOW_QUERIES_COLLECTION].insert_one(record)
+
+
+def worst_offenders(db, limit: int = 20, since_hours: int = 24):
+    """Formas de consulta más lentas del período, agrupadas"""
+    since = datetime.now(timezone.utc) - timedelta(hours=since_hours)
+    pipeline = [
+        {"$match": {"created_at": {"$gte": since}}},
+        {"$sort": {"created_at": -1}},
+        {"$group": {
+            "_id": "$shape",
+            "collection": {"$first": "$collection"},
+            "command": {"$first": "$command"},
+            "routes": {"$addToSet": "$route"},
+            "count": {"$sum": 1},
+            "max_duration_ms": {"$max": "$duration_ms"},
+            "avg_duration_ms": {"$avg": "$duration_ms"},
+            "max_docs_examined": {"$max": "$docs_examined"},
+            "max_docs_returned": {"$max": "$docs_returned"},
+            "collscan": {"$max": "$collscan"},
+            "plan_stages": {"$first": "$plan_stages"},
+            "last_seen": {"$first": "$created_at"},
+        }},
+        {"$sort": {"max_duration_ms": -1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "shape": "$_id", "collection": 1, "command": 1, "routes": 1, "count": 1,
+                      "max_duration_ms": 1, "avg_duration_ms": 1, "max_docs_examined": 1,
+                      "max_docs_returned": 1, "collscan": 1, "plan_stages": 1, "last_seen": 1}},
+    ]
+    return list(db[SLOW_QUERIES_COLLECTION].aggregate(pipeline))
+
@@ -0,0 +1,1012 @@
+"""
+Backends de almacenamiento
+
+La app usa un subconjunto de la API de pymongo sobre sus colecciones
+(find/find_one con projection, sort, limit y batch_size; insert_one/many,
+update_one/many, delete_one/many, count_documents, find_one_and_update con
+upsert, create_index; sesiones y with_options). Ese subconjunto es la interfaz de almacenamiento, y
+STORAGE_BACKEND elige la implementación:
+
+    mongo   (por defecto) MongoClient real
+    memory  motor en proceso con índices, para tests y benchmarks sin Mongo
+
+El motor en memoria imita lo que verían los endpoints con Mongo: _id ObjectId
+asignado en la inserción, datetimes sin zona horaria y truncados a
+milisegundos, índices únicos que lanzan DuplicateKeyError, índices TTL
+purgados cada minuto y el mismo orden de tipos de BSON al comparar. Cada
+índice mantiene a la vez un hash (igualdad sobre la clave completa) y una
+lista ordenada (prefijos y rangos) sobre los mismos campos.
+
+aggregate admite las etapas $match, $sort, $group, $project, $skip y $limit
+(con referencias "$campo" como expresiones) y command, ping y collMod del TTL
+de un índice. create_index admite unique, expireAfterSeconds, name y
+partialFilterExpression; otra opción o comando lanza OperationFailure, como
+haría mongod con uno que no conoce, en lugar de ignorarse. No dispara los listeners de monitorización de pymongo:
+métricas, presupuesto de consultas, trazas y consultas lentas no ven nada.
+"""
+
+import itertools
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+from pymongo.results import DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+TTL_MONITOR_SECONDS = 60  # igual que el TTLMonitor de mongod
+
+# Pool y timeouts del MongoClient según APP_ENV; cada opción se puede cambiar con
+# su variable de entorno. 0 deja el valor por defecto del driver (sin límite en
+# los timeouts). timeoutMS limita cada operación completa (pymongo envía el
+# tiempo restante como maxTimeMS al servidor).
+MONGO_OPTION_DEFAULTS = {
+    "development": {
+        "maxPoolSize": 0,
+        "minPoolSize": 0,
+        "waitQueueTimeoutMS": 0,
+        "serverSelectionTimeoutMS": 5000,
+        "connectTimeoutMS": 0,
+        "socketTimeoutMS": 0,
+        "timeoutMS": 0,
+    },
+    "production": {
+        "maxPoolSize": 50,  # por worker
+        "minPoolSize": 5,
+        "waitQueueTimeoutMS": 2000,
+        "serverSelectionTimeoutMS": 5000,
+        "connectTimeoutMS": 5000,
+        "socketTimeoutMS": 0,
+        "timeoutMS": 10000,
+    },
+}
+MONGO_OPTION_ENV = {
+    "maxPoolSize": "MONGO_MAX_POOL_SIZE",
+    "minPoolSize": "MONGO_MIN_POOL_SIZE",
+    "waitQueueTimeoutMS": "MONGO_WAIT_QUEUE_TIMEOUT_MS",
+    "serverSelectionTimeoutMS": "MONGO_SERVER_SELECTION_TIMEOUT_MS",
+    "connectTimeoutMS": "MONGO_CONNECT_TIMEOUT_MS",
+    "socketTimeoutMS": "MONGO_SOCKET_TIMEOUT_MS",
+    "timeoutMS": "MONGO_TIMEOUT_MS",
+}
+
+
+def mongo_options(environment):
+    """kwargs de MongoClient para el entorno, con las variables MONGO_* aplicadas"""
+    if environment not in MONGO_OPTION_DEFAULTS:
+        raise ValueError(f"APP_ENV desconocido: {environment}")
+    options = {}
+    for option, default in MONGO_OPTION_DEFAULTS[environment].items():
+        value = int(os.environ.get(MONGO_OPTION_ENV[option], default))
+        if value:
+            options[option] = value
+    return options
+
+
+def create_client(backend, url, **kwargs):
+    """Cliente del backend configurado; kwargs solo se usan con Mongo"""
+    if backend == "mongo":
+        return MongoClient(url, **kwargs)
+    if backend == "memory":
+        return MemoryClient()
+    raise ValueError(f"STORAGE_BACKEND desconocido: {backend}")
+
+
+class DatabaseProxy:
+    """Base de datos a nivel de módulo que abre su cliente en el proceso que la usa
+
+    MongoClient no sobrevive a un fork: si el proxy detecta otro pid, abre un
+    cliente nuevo en lugar de heredar el del proceso padre. open()/close() se
+    llaman desde el lifespan de la app; cualquier uso anterior abre el cliente
+    bajo demanda (scripts, benchmarks).
+    """
+
+    def __init__(self, connect):
+        self._connect = connect  # () -> (cliente, base de datos)
+        self._client = None
+        self._database = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client, self._database = self._connect()
+                self._pid = os.getpid()
+        return self._database
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = self._database = self._pid = None
+
+    @property
+    def database(self):
+        if self._pid != os.getpid():
+            return self.open()
+        return self._database
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.database, name)
+
+    def __getitem__(self, name):
+        return self.database[name]
+
+
+class DatabaseView:
+    """La base de un DatabaseProxy con otras opciones (read_preference, read_concern...)
+
+    Sigue al cliente del proxy: si este se reabre (fork, lifespan), la vista se
+    reconstruye sobre el nuevo.
+    """
+
+    def __init__(self, proxy, **options):
+        self._proxy = proxy
+        self._options = options
+        self._source = None
+        self._database = None
+
+    @property
+    def database(self):
+        source = self._proxy.database
+        if source is not self._source:
+            self._database = source.with_options(**self._options)
+            self._source = source
+        return self._database
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.database, name)
+
+    def __getitem__(self, name):
+        return self.database[name]
+
+
+_MISSING = object()
+_MAX = (99,)
+
+
+def bson_key(value):
+    """Clave ordenable con el orden de tipos de BSON (null < números < texto < ... < fechas)"""
+    if value is None or value is _MISSING:
+        return (1,)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, dict):
+        return (4, repr(value))
+    if isinstance(value, list):
+        return (5, repr(value))
+    if isinstance(value, bytes):
+        return (6, value)
+    if isinstance(value, ObjectId):
+        return (7, value.binary)
+    if isinstance(value, datetime):
+        return (9, value)
+    return (10, repr(value))
+
+
+def _normalize(value):
+    """Ida y vuelta por BSON: copia profunda, tuplas a listas y datetimes UTC sin zona y en ms"""
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+def _get(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return _MISSING
+        doc = doc.get(part, _MISSING)
+        if doc is _MISSING:
+            return _MISSING
+    return doc
+
+
+def _set(doc, path, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def _unset(doc, path):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+
+# Consultas
+
+def _equals(value, target):
+    if isinstance(value, list) and not isinstance(target, list):
+        return any(_equals(item, target) for item in value)
+    if value is _MISSING:
+        return target is None
+    return bson_key(value) == bson_key(target)
+
+
+def _compare(value, target, test):
+    if value is _MISSING:
+        return False
+    if isinstance(value, list):
+        return any(_compare(item, target, test) for item in value)
+    value_key, target_key = bson_key(value), bson_key(target)
+    return value_key[0] == target_key[0] and test(value_key, target_key)
+
+
+def _regex(value, pattern):
+    if not isinstance(value, str):
+        return False
+    if not hasattr(pattern, "search"):
+        pattern = re.compile(pattern)
+    return pattern.search(value) is not None
+
+
+OPERATORS = {
+    "$eq": _equals,
+    "$ne": lambda value, target: not _equals(value, target),
+    "$in": lambda value, targets: any(_equals(value, target) for target in targets),
+    "$nin": lambda value, targets: not any(_equals(value, target) for target in targets),
+    "$gt": lambda value, target: _compare(value, target, lambda a, b: a > b),
+    "$gte": lambda value, target: _compare(value, target, lambda a, b: a >= b),
+    "$lt": lambda value, target: _compare(value, target, lambda a, b: a < b),
+    "$lte": lambda value, target: _compare(value, target, lambda a, b: a <= b),
+    "$exists": lambda value, flag: (value is not _MISSING) == bool(flag),
+    "$regex": _regex,
+}
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte"}
+
+
+def _is_operator_dict(condition):
+    return isinstance(condition, dict) and bool(condition) and next(iter(condition)).startswith("$")
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(doc, item) for item in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, item) for item in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(doc, item) for item in condition):
+                return False
+        else:
+            value = _get(doc, key)
+            if _is_operator_dict(condition):
+                for operator, argument in condition.items():
+                    if operator == "$options":
+                        continue
+                    if operator == "$regex" and "$options" in condition:
+                        argument = re.compile(argument, _regex_flags(condition["$options"]))
+                    if operator not in OPERATORS:
+                        raise OperationFailure(f"Operador no soportado en memoria: {operator}")
+                    if not OPERATORS[operator](value, argument):
+                        return False
+            elif not _equals(value, condition):
+                return False
+    return True
+
+
+def _regex_flags(options):
+    flags = 0
+    for option, flag in (("i", re.IGNORECASE), ("m", re.MULTILINE), ("s", re.DOTALL), ("x", re.VERBOSE)):
+        if option in options:
+            flags |= flag
+    return flags
+
+
+def _project(doc, projection):
+    if not projection:
+        return _copy(doc)
+    include_id = projection.get("_id", 1)
+    included = [field for field, flag in projection.items() if flag and field != "_id"]
+    if included:
+        result = {"_id": doc["_id"]} if include_id and "_id" in doc else {}
+        for field in included:
+            value = _get(doc, field)
+            if value is not _MISSING:
+                _set(result, field, _copy(value))
+        return result
+    result = _copy(doc)
+    for field, flag in projection.items():
+        if not flag:
+            _unset(result, field)
+    return result
+
+
+def _sort_documents(docs, sort):
+    for field, direction in reversed(sort):
+        docs.sort(key=lambda doc: bson_key(_get(doc, field)), reverse=direction < 0)
+    return docs
+
+
+def _sort_spec(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction if direction is not None else 1)]
+    return [(field, order) for field, order in key_or_list]
+
+
+# Agregación
+
+def _expression(doc, expression):
+    """Valor de una expresión de agregación: "$campo" o una constante"""
+    if isinstance(expression, str) and expression.startswith("$"):
+        return _get(doc, expression[1:])
+    return expression
+
+
+def _present(values):
+    return [value for value in values if value is not _MISSING and value is not None]
+
+
+def _numbers(values):
+    return [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+
+def _add_to_set(values):
+    result, seen = [], set()
+    for value in values:
+        if value is not _MISSING and bson_key(value) not in seen:
+            seen.add(bson_key(value))
+            result.append(value)
+    return result
+
+
+ACCUMULATORS = {
+    "$sum": lambda values: sum(_numbers(values)),
+    "$avg": lambda values: sum(_numbers(values)) / len(_numbers(values)) if _numbers(values) else None,
+    "$max": lambda values: max(_present(values), key=bson_key, default=None),
+    "$min": lambda values: min(_present(values), key=bson_key, default=None),
+    "$first": lambda values: None if values[0] is _MISSING else values[0],
+    "$last": lambda values: None if values[-1] is _MISSING else values[-1],
+    "$addToSet": _add_to_set,
+    "$push": lambda values: [value for value in values if value is not _MISSING],
+}
+
+
+def _group(docs, spec):
+    id_expression = spec["_id"]
+    groups = {}  # clave -> (_id, documentos), en orden de aparición
+    for doc in docs:
+        if isinstance(id_expression, dict):
+            group_id = {field: _expression(doc, expression) for field, expression in id_expression.items()}
+            group_id = {field: value for field, value in group_id.items() if value is not _MISSING}
+            key = tuple((field, bson_key(value)) for field, value in group_id.items())
+        else:
+            group_id = _expression(doc, id_expression)
+            group_id = None if group_id is _MISSING else group_id
+            key = bson_key(group_id)
+        groups.setdefault(key, (group_id, []))[1].append(doc)
+
+    results = []
+    for group_id, members in groups.values():
+        result = {"_id": group_id}
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            (operator, expression), = accumulator.items()
+            if operator not in ACCUMULATORS:
+                raise OperationFailure(f"Acumulador no soportado en memoria: {operator}")
+            result[field] = ACCUMULATORS[operator]([_expression(doc, expression) for doc in members])
+        results.append(result)
+    return results
+
+
+def _project_stage(doc, projection):
+    computed = {field: expression for field, expression in projection.items()
+                if isinstance(expression, str) and expression.startswith("$")}
+    plain = {field: flag for field, flag in projection.items() if field not in computed}
+    if computed and not any(flag for field, flag in plain.items() if field != "_id"):
+        result = {"_id": doc["_id"]} if plain.get("_id", 1) and "_id" in doc else {}
+    else:
+        result = _project(doc, plain)
+    for field, expression in computed.items():
+        value = _expression(doc, expression)
+        if value is not _MISSING:
+            _set(result, field, _copy(value))
+    return result
+
+
+def _run_pipeline(docs, pipeline):
+    for stage in pipeline:
+        (operator, argument), = stage.items()
+        if operator == "$match":
+            docs = [doc for doc in docs if matches(doc, argument)]
+        elif operator == "$sort":
+            docs = _sort_documents(list(docs), list(argument.items()))
+        elif operator == "$group":
+            docs = _group(docs, argument)
+        elif operator == "$project":
+            docs = [_project_stage(doc, argument) for doc in docs]
+        elif operator == "$skip":
+            docs = docs[argument:]
+        elif operator == "$limit":
+            docs = docs[:argument]
+        else:
+            raise NotImplementedError(f"Etapa de agregación no soportada por el motor en memoria: {operator}")
+    return docs
+
+
+# Actualizaciones
+
+def _apply_update(doc, update, inserting):
+    if not update or not all(key.startswith("$") for key in update):
+        raise OperationFailure("El motor en memoria solo admite actualizaciones con operadores ($set, $inc...)")
+    for operator, fields in update.items():
+        if operator == "$set" or (operator == "$setOnInsert" and inserting):
+            for path, value in fields.items():
+                _set(doc, path, _normalize(value))
+        elif operator == "$setOnInsert":
+            continue
+        elif operator == "$unset":
+            for path in fields:
+                _unset(doc, path)
+        elif operator == "$inc":
+            for path, amount in fields.items():
+                current = _get(doc, path)
+                _set(doc, path, (0 if current is _MISSING else current) + amount)
+        elif operator == "$push":
+            for path, value in fields.items():
+                current = _get(doc, path)
+                _set(doc, path, ([] if current is _MISSING else current) + [_normalize(value)])
+        else:
+            raise OperationFailure(f"Operador de actualización no soportado en memoria: {operator}")
+
+
+def _upsert_seed(query):
+    """Campos de igualdad del filtro, que Mongo copia al documento insertado"""
+    seed = {}
+    for key, condition in query.items():
+        if key == "$and":
+            for item in condition:
+                seed.update(_upsert_seed(item))
+        elif key.startswith("$"):
+            continue
+        elif _is_operator_dict(condition):
+            if "$eq" in condition:
+                _set(seed, key, condition["$eq"])
+        else:
+            _set(seed, key, condition)
+    return seed
+
+
+# Índices
+
+class _Index:
+    __slots__ = ("name", "fields", "unique", "expire_after", "partial", "hash", "sorted")
+
+    def __init__(self, name, fields, unique=False, expire_after=None, partial=None):
+        self.name = name
+        self.fields = fields
+        self.unique = unique
+        self.expire_after = expire_after
+        self.partial = partial  # partialFilterExpression: solo entran los documentos que lo cumplen
+        self.hash = {}  # clave completa -> {seq: None}, en orden de inserción
+        self.sorted = []  # (clave, seq) ordenado, para prefijos y rangos
+
+    def key(self, doc):
+        """Clave del documento, o None si un índice parcial no lo incluye"""
+        if self.partial is not None and not matches(doc, self.partial):
+            return None
+        return tuple(bson_key(_get(doc, field)) for field in self.fields)
+
+    def add(self, key, seq):
+        self.hash.setdefault(key, {})[seq] = None
+        insort(self.sorted, (key, seq))
+
+    def remove(self, key, seq):
+        bucket = self.hash[key]
+        del bucket[seq]
+        if not bucket:
+            del self.hash[key]
+        del self.sorted[bisect_left(self.sorted, (key, seq))]
+
+    def scan(self, low, high):
+        """seqs con low <= clave <= high (claves parciales: prefijos)"""
+        start = bisect_left(self.sorted, (low,))
+        end = bisect_left(self.sorted, (high + (_MAX,),))
+        return (seq for _, seq in self.sorted[start:end])
+
+
+def _collect_conditions(query, equalities, ranges, alternatives):
+    for key, condition in query.items():
+        if key == "$and":
+            for item in condition:
+                _collect_conditions(item, equalities, ranges, alternatives)
+        elif key == "$or":
+            alternatives.append(condition)
+        elif key.startswith("$") or key in equalities:
+            continue
+        elif _is_operator_dict(condition):
+            if "$eq" in condition:
+                equalities[key] = [condition["$eq"]]
+            elif "$in" in condition:
+                equalities[key] = list(condition["$in"])
+            elif RANGE_OPERATORS & condition.keys():
+                low = condition.get("$gte", condition.get("$gt", _MISSING))
+                high = condition.get("$lte", condition.get("$lt", _MISSING))
+                ranges[key] = (low, high)
+        elif not isinstance(condition, (list, dict)):
+            equalities[key] = [condition]
+
+
+class MemoryCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._docs = {}  # seq -> documento, en orden natural de inserción
+        self._seq = itertools.count()
+        self._indexes = {"_id_": _Index("_id_", ["_id"], unique=True)}
+        self._lock = threading.RLock()
+        self._next_ttl_check = 0.0
+
+    @property
+    def full_name(self):
+        return f"{self.database.name}.{self.name}"
+
+    # Planificación: usa el índice con más campos aprovechables o, si no hay, cada rama de un $or
+
+    def _candidates(self, query):
+        """seqs que pueden cumplir el filtro, o None para recorrer toda la colección"""
+        equalities, ranges, alternatives = {}, {}, []
+        _collect_conditions(query, equalities, ranges, alternatives)
+
+        best, best_score = None, 0
+        for index in self._indexes.values():
+            if index.partial is not None:
+                continue  # no tiene todos los documentos: no sirve para planificar
+            prefix = []
+            for field in index.fields:
+                if field not in equalities:
+                    break
+                prefix.append(equalities[field])
+            range_field = index.fields[len(prefix)] if len(prefix) < len(index.fields) else None
+            score = 2 * len(prefix) + (1 if range_field in ranges else 0) + (1 if len(prefix) == len(index.fields) else 0)
+            if score > best_score:
+                best, best_score = (index, prefix, ranges.get(range_field)), score
+
+        if best is not None:
+            index, prefix, bounds = best
+            seqs = {}
+            for values in itertools.product(*prefix):
+                key = tuple(bson_key(value) for value in values)
+                if len(key) == len(index.fields):
+                    seqs.update(index.hash.get(key, {}))
+                    continue
+                low, high = bounds if bounds else (_MISSING, _MISSING)
+                low_key = key + ((bson_key(low),) if low is not _MISSING else ())
+                high_key = key + ((bson_key(high),) if high is not _MISSING else ())
+                seqs.update(dict.fromkeys(index.scan(low_key, high_key)))
+            return seqs
+
+        for branches in alternatives:
+            union = {}
+            for branch in branches:
+                branch_seqs = self._candidates(branch)
+                if branch_seqs is None:
+                    break
+                union.update(branch_seqs)
+            else:
+                return union
+        return None
+
+    def _matching(self, query):
+        """(seq, documento) que cumplen el filtro, sin copiar"""
+        query = _normalize(query or {})
+        candidates = self._candidates(query)
+        if candidates is None:
+            items = self._docs.items()
+        else:
+            items = ((seq, self._docs[seq]) for seq in candidates if seq in self._docs)
+        return [(seq, doc) for seq, doc in items if matches(doc, query)]
+
+    def _expire(self):
+        now = time.monotonic()
+        if now < self._next_ttl_check:
+            return
+        self._next_ttl_check = now + TTL_MONITOR_SECONDS
+        utcnow = datetime.now(timezone.utc).replace(tzinfo=None)
+        for index in list(self._indexes.values()):
+            if index.expire_after is None:
+                continue
+            cutoff = utcnow - timedelta(seconds=index.expire_after)
+            for seq in list(index.scan((bson_key(datetime.min),), (bson_key(cutoff),))):
+                self._remove(seq)
+
+    # Escritura con mantenimiento de índices
+
+    def _add(self, doc):
+        keys = [(index, key) for index in self._indexes.values() if (key := index.key(doc)) is not None]
+        for index, key in keys:
+            if index.unique and index.hash.get(key):
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: {self.full_name} index: {index.name}", 11000
+                )
+        seq = next(self._seq)
+        self._docs[seq] = doc
+        for index, key in keys:
+            index.add(key, seq)
+
+    def _remove(self, seq):
+        doc = self._docs.pop(seq)
+        for index in self._indexes.values():
+            key = index.key(doc)
+            if key is not None:
+                index.remove(key, seq)
+
+    def _replace(self, seq, new_doc):
+        old_doc = self._docs[seq]
+        changes = []
+        for index in self._indexes.values():
+            old_key, new_key = index.key(old_doc), index.key(new_doc)
+            if old_key == new_key:
+                continue
+            if index.unique and new_key is not None and index.hash.get(new_key):
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: {self.full_name} index: {index.name}", 11000
+                )
+            changes.append((index, old_key, new_key))
+        for index, old_key, new_key in changes:
+            if old_key is not None:
+                index.remove(old_key, seq)
+            if new_key is not None:
+                index.add(new_key, seq)
+        self._docs[seq] = new_doc
+
+    def _prepare(self, document):
+        if "_id" not in document:
+            document["_id"] = ObjectId()  # como pymongo, también en el dict del llamador
+        return _normalize(document)
+
+    # API de pymongo
+
+    def insert_one(self, document, session=None):
+        with self._lock:
+            self._add(self._prepare(document))
+        return InsertOneResult(document["_id"], True)
+
+    def insert_many(self, documents, ordered=True):
+        inserted_ids, errors = [], []
+        with self._lock:
+            for position, document in enumerate(documents):
+                try:
+                    self._add(self._prepare(document))
+                    inserted_ids.append(document["_id"])
+                except DuplicateKeyError as e:
+                    errors.append({"index": position, "code": 11000, "errmsg": str(e), "op": document})
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(inserted_ids), "writeConcernErrors": [],
+                                  "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []})
+        return InsertManyResult(inserted_ids, True)
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0, batch_size=0, session=None):
+        cursor = MemoryCursor(self, filter, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    def find_one(self, filter=None, projection=None, sort=None, session=None):
+        for doc in self.find(filter, projection, sort=sort, limit=1):
+            return doc
+        return None
+
+    def count_documents(self, filter, **kwargs):
+        with self._lock:
+            self._expire()
+            return len(self._matching(filter))
+
+    def estimated_document_count(self):
+        return len(self._docs)
+
+    def _update(self, filter, update, upsert, many):
+        with self._lock:
+            self._expire()
+            matched = self._matching(filter)
+            if not many:
+                matched = matched[:1]
+            modified = 0
+            for seq, doc in matched:
+                new_doc = _copy(doc)
+                _apply_update(new_doc, update, inserting=False)
+                if new_doc != doc:
+                    self._replace(seq, new_doc)
+                    modified += 1
+            raw_result = {"n": len(matched), "nModified": modified}
+            if not matched and upsert:
+                new_doc = _normalize(_upsert_seed(filter or {}))
+                _apply_update(new_doc, update, inserting=True)
+                if "_id" not in new_doc:
+                    new_doc = {"_id": ObjectId(), **new_doc}
+                self._add(new_doc)
+                raw_result.update(n=1, upserted=new_doc["_id"])
+            return UpdateResult(raw_result, True)
+
+    def update_one(self, filter, update, upsert=False, session=None):
+        return self._update(filter, update, upsert, many=False)
+
+    def update_many(self, filter, update, upsert=False, session=None):
+        return self._update(filter, update, upsert, many=True)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, session=None):
+        with self._lock:
+            self._expire()
+            matched = self._matching(filter)
+            if sort and len(matched) > 1:
+                seqs = {id(doc): seq for seq, doc in matched}
+                first = _sort_documents([doc for _, doc in matched], _sort_spec(sort))[0]
+                matched = [(seqs[id(first)], first)]
+            if matched:
+                seq, doc = matched[0]
+                new_doc = _copy(doc)
+                _apply_update(new_doc, update, inserting=False)
+                self._replace(seq, new_doc)
+                return _project(new_doc if return_document == ReturnDocument.AFTER else doc, projection)
+            if not upsert:
+                return None
+            new_doc = _normalize(_upsert_seed(filter or {}))
+            _apply_update(new_doc, update, inserting=True)
+            if "_id" not in new_doc:
+                new_doc = {"_id": ObjectId(), **new_doc}
+            self._add(new_doc)
+            return _project(new_doc, projection) if return_document == ReturnDocument.AFTER else None
+
+    def _delete(self, filter, many):
+        with self._lock:
+            self._expire()
+            matched = self._matching(filter)
+            if not many:
+                matched = matched[:1]
+            for seq, _ in matched:
+                self._remove(seq)
+            return DeleteResult({"n": len(matched)}, True)
+
+    def delete_one(self, filter):
+        return self._delete(filter, many=False)
+
+    def delete_many(self, filter):
+        return self._delete(filter, many=True)
+
+    def create_index(self, keys, unique=False, expireAfterSeconds=None, name=None,
+                     partialFilterExpression=None, **kwargs):
+        if kwargs:
+            raise OperationFailure(f"Opciones de índice no soportadas por el motor en memoria: {sorted(kwargs)}", 197)
+        fields = [field for field, _ in _sort_spec(keys)]
+        name = name or "_".join(f"{field}_{direction}" for field, direction in _sort_spec(keys))
+        partial = _normalize(partialFilterExpression) if partialFilterExpression is not None else None
+        with self._lock:
+            existing = self._indexes.get(name)
+            if existing is not None:
+                # Como mongod: mismo nombre con otras claves u opciones es un error, no un no-op
+                if existing.fields != fields:
+                    raise OperationFailure(f"Índice {name} ya existe con otras claves", 86)
+                if (existing.unique != unique or existing.expire_after != expireAfterSeconds
+                        or existing.partial != partial):
+                    raise OperationFailure(f"Índice {name} ya existe con otras opciones", 85)
+                return name
+            index = _Index(name, fields, unique=unique, expire_after=expireAfterSeconds, partial=partial)
+            for seq, doc in self._docs.items():
+                key = index.key(doc)
+                if key is None:
+                    continue
+                if unique and index.hash.get(key):
+                    raise DuplicateKeyError(
+                        f"E11000 duplicate key error collection: {self.full_name} index: {name}", 11000
+                    )
+                index.add(key, seq)
+            self._indexes[name] = index
+        return name
+
+    def index_information(self):
+        information = {}
+        for name, index in self._indexes.items():
+            information[name] = {"key": [(field, 1) for field in index.fields], "unique": index.unique}
+            if index.expire_after is not None:
+                information[name]["expireAfterSeconds"] = index.expire_after
+            if index.partial is not None:
+                information[name]["partialFilterExpression"] = index.partial
+        return information
+
+    def aggregate(self, pipeline, **kwargs):
+        with self._lock:
+            self._expire()
+            # Un $match inicial usa los índices como find
+            first_match = pipeline[0]["$match"] if pipeline and "$match" in pipeline[0] else {}
+            docs = [doc for _, doc in self._matching(first_match)]
+            if first_match:
+                pipeline = pipeline[1:]
+            return iter([_copy(doc) for doc in _run_pipeline(docs, pipeline)])
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+
+class MemoryCursor:
+    """Cursor perezoso: el filtro se evalúa en la primera iteración"""
+
+    def __init__(self, collection, filter, projection):
+        self._collection = collection
+        self._filter = filter
+        self._projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def _execute(self):
+        collection = self._collection
+        with collection._lock:
+            collection._expire()
+            docs = [doc for _, doc in collection._matching(self._filter)]
+            if self._sort:
+                docs = _sort_documents(docs, self._sort)
+            docs = docs[self._skip:self._skip + self._limit if self._limit else None]
+            return iter([_project(doc, self._projection) for doc in docs])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._results is None:
+            self._results = self._execute()
+        return next(self._results)
+
+    def close(self):
+        self._results = iter(())
+
+
+class MemoryDatabase:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self, name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name):
+        return self[name]
+
+    def create_collection(self, name, **kwargs):
+        with self._lock:
+            if name in self._collections:
+                raise CollectionInvalid(f"collection {name} already exists")
+        return self[name]  # capped y demás opciones se ignoran
+
+    def list_collection_names(self):
+        return list(self._collections)
+
+    def drop_collection(self, name):
+        with self._lock:
+            self._collections.pop(name, None)
+
+    def command(self, command, value=None, **kwargs):
+        if command == "ping":
+            return {"ok": 1.0}
+        if command == "collMod" and set(kwargs) == {"index"}:
+            # Solo el cambio de TTL de un índice (expireAfterSeconds)
+            collection = self[value]
+            with collection._lock:
+                index = collection._indexes.get(kwargs["index"]["name"])
+                if index is None or index.expire_after is None:
+                    raise OperationFailure(f"Índice TTL no encontrado: {kwargs['index']['name']}", 27)
+                old = index.expire_after
+                index.expire_after = kwargs["index"]["expireAfterSeconds"]
+            return {"expireAfterSeconds_old": old, "expireAfterSeconds_new": index.expire_after, "ok": 1.0}
+        # CommandNotFound, como mongod: los llamadores lo tratan como cualquier PyMongoError
+        raise OperationFailure(f"Comando no soportado por el motor en memoria: {command}", 59)
+
+    def with_options(self, **kwargs):
+        return self  # un solo nodo: read_preference y demás no cambian nada
+
+
+class MemorySession:
+    """Sesión sin efecto: todas las lecturas ven ya todas las escrituras"""
+
+    cluster_time = None
+    operation_time = None
+
+    def __init__(self, client):
+        self.client = client
+
+    def advance_cluster_time(self, cluster_time):
+        pass
+
+    def advance_operation_time(self, operation_time):
+        pass
+
+    def end_session(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class MemoryClient:
+    def __init__(self):
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = MemoryDatabase(self, name)
+            return self._databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_database(self, name, **kwargs):
+        return self[name]
+
+    def start_session(self, **kwargs):
+        return MemorySession(self)
+
+    def drop_database(self, name):
+        with self._lock:
+            self._databases.pop(name if isinstance(name, str) else name.name, None)
+
+    def close(self):
+        pass
@@ -0,0 +1,318 @@
+"""
+Trazas ligeras en proceso
+
+Cada petición abre una traza con un span raíz; dentro se crean spans para la
+autenticación, cada comando de Mongo (CommandListener), la serialización de
+FastAPI y el envío de notificaciones. El contexto viaja en contextvars, así
+que llega a las tareas asyncio, a los hilos del threadpool y a las
+BackgroundTasks de la misma petición.
+
+Muestreo:
+    - por cabeza: TRACE_SAMPLE_RATE (0.0 - 1.0) o la bandera del traceparent entrante
+    - por cola: toda petición más lenta que TRACE_TAIL_THRESHOLD_MS se exporta igualmente
+
+Las trazas se exportan desde un hilo aparte en formato OTLP/JSON: una línea
+por traza en TRACE_EXPORT_FILE y, si se define, POST a TRACE_OTLP_ENDPOINT
+(p. ej. http://localhost:4318/v1/traces).
+
+Desactivado salvo TRACING_ENABLED=1.
+"""
+
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from pymongo import monitoring
+from starlette.datastructures import MutableHeaders
+
+logger = logging.getLogger("loveacts.tracing")
+
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "0") == "1"
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_TAIL_THRESHOLD_MS = float(os.environ.get("TRACE_TAIL_THRESHOLD_MS", "500"))
+TRACE_EXPORT_FILE = os.environ.get("TRACE_EXPORT_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT")
+SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "loveacts-api")
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name, parent_id, start_ns=None, attributes=None):
+        self.name = name
+        self.span_id = random.getrandbits(64)
+        self.parent_id = parent_id
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+
+
+class Trace:
+    __slots__ = ("trace_id", "sampled", "spans")
+
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Span hijo del span actual; no hace nada si la petición no se está trazando"""
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+
+    parent = current_span.get()
+    new_span = Span(name, parent.span_id if parent else None, attributes=attributes)
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except Exception as e:
+        new_span.error = repr(e)
+        raise
+    finally:
+        new_span.end_ns = time.time_ns()
+        current_span.reset(token)
+        trace.spans.append(new_span)
+
+
+def traced(name):
+    """Decorador: envuelve una función (síncrona o async) en un span"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracingListener(monitoring.CommandListener):
+    """Un span por comando de Mongo, colgado del span activo al emitirlo"""
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        trace = current_trace.get()
+        if trace is None:
+            return
+        parent = current_span.get()
+        target = event.command.get(event.command_name)
+        self._pending[(event.connection_id, event.request_id)] = (
+            trace,
+            Span(
+                f"mongo.{event.command_name}",
+                parent.span_id if parent else None,
+                attributes={
+                    "db.system": "mongodb",
+                    "db.operation": event.command_name,
+                    "db.mongodb.collection": target if isinstance(target, str) else "",
+                },
+            ),
+        )
+
+    def succeeded(self, event):
+        self._finish(event, None)
+
+    def failed(self, event):
+        self._finish(event, str(event.failure))
+
+    def _finish(self, event, error):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        trace, mongo_span = pending
+        mongo_span.end_ns = mongo_span.start_ns + event.duration_micros * 1000
+        mongo_span.error = error
+        trace.spans.append(mongo_span)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(trace):
+    spans = []
+    for item in trace.spans:
+        otlp_span = {
+            "traceId": f"{trace.trace_id:032x}",
+            "spanId": f"{item.span_id:016x}",
+            "name": item.name,
+            "kind": 2 if item.parent_id is None else 1,  # SERVER para la raíz, INTERNAL el resto
+            "startTimeUnixNano": str(item.start_ns),
+            "endTimeUnixNano": str(item.end_ns or item.start_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in item.attributes.items()],
+            "status": {"code": 2, "message": item.error} if item.error else {"code": 1},
+        }
+        if item.parent_id is not None:
+            otlp_span["parentSpanId"] = f"{item.parent_id:016x}"
+        spans.append(otlp_span)
+
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "loveacts.tracing"}, "spans": spans}],
+    }]}
+
+
+class TraceExporter:
+    """Exporta trazas desde un hilo para no bloquear el event loop con E/S"""
+
+    def __init__(self, path=TRACE_EXPORT_FILE, endpoint=TRACE_OTLP_ENDPOINT, max_queue=1000):
+        self.path = path
+        self.endpoint = endpoint
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+
+    def export(self, trace):
+        if self._thread is None or not self._thread.is_alive():  # no arrancado o perdido en un fork
+            self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            pass  # se descartan trazas antes que frenar peticiones
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            if trace is None:
+                return
+            payload = json.dumps(to_otlp(trace), separators=(",", ":"))
+            try:
+                if self.path:
+                    with open(self.path, "a") as f:
+                        f.write(payload + "\n")
+                if self.endpoint:
+                    import urllib.request  # solo con exportación OTLP por HTTP
+                    request = urllib.request.Request(
+                        self.endpoint, data=payload.encode("utf-8"),
+                        headers={"Content-Type": "application/json"}, method="POST"
+                    )
+                    urllib.request.urlopen(request, timeout=5).close()
+            except Exception as e:
+                logger.warning("Error exportando traza: %s", e)
+
+
+exporter = TraceExporter()
+
+
+def parse_traceparent(value):
+    """(trace_id, parent_span_id, sampled) de una cabecera W3C traceparent, o None"""
+    try:
+        version, trace_id, parent_id, flags = value.split("-")
+        if len(trace_id) != 32 or len(parent_id) != 16:
+            return None
+        return int(trace_id, 16), int(parent_id, 16), bool(int(flags, 16) & 1)
+    except (ValueError, AttributeError):
+        return None
+
+
+class TracingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        incoming = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                incoming = parse_traceparent(value.decode("latin-1"))
+                break
+
+        if incoming:
+            trace_id, parent_id, sampled = incoming
+            sampled = sampled or random.random() < TRACE_SAMPLE_RATE
+        else:
+            trace_id, parent_id, sampled = random.getrandbits(128), None, random.random() < TRACE_SAMPLE_RATE
+
+        trace = Trace(trace_id, sampled)
+        root = Span(f"{scope['method']} {scope['path']}", parent_id, attributes={"http.method": scope["method"]})
+        trace_token = current_trace.set(trace)
+        span_token = current_span.set(root)
+        status_code = 500
+
+        async def send_with_trace_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message).append("X-Trace-Id", f"{trace_id:032x}")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        except Exception as e:
+            root.error = repr(e)
+            raise
+        finally:
+            current_span.reset(span_token)
+            current_trace.reset(trace_token)
+            root.end_ns = time.time_ns()
+            route = scope.get("route")
+            if route is not None:
+                root.name = f"{scope['method']} {route.path}"
+                root.attributes["http.route"] = route.path
+            root.attributes["http.status_code"] = status_code
+            trace.spans.append(root)
+
+            duration_ms = (root.end_ns - root.start_ns) / 1e6
+            if trace.sampled or duration_ms >= TRACE_TAIL_THRESHOLD_MS:
+                exporter.export(trace)
+
+
+def instrument_fastapi_serialization():
+    """Añade un span alrededor de la serialización de respuestas de FastAPI"""
+    import fastapi.routing
+
+    original = fastapi.routing.serialize_response
+    if getattr(original, "_traced", False):
+        return
+
+    @functools.wraps(original)
+    async def serialize_response(*args, **kwargs):
+        with span("fastapi.serialize_response"):
+            return await original(*args, **kwargs)
+
+    serialize_response._traced = True
+    fastapi.routing.serialize_response = serialize_response
+
+
+if TRACING_ENABLED:
+    instrument_fastapi_serialization()
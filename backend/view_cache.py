@@ -0,0 +1,200 @@
+"""
+Caché de vistas calculadas (logros, correlación, estadísticas totales, recuerdos filtrados)
+
+Cada vista se guarda serializada en JSON bajo una clave que incluye sus
+parámetros y las etiquetas de los datos de los que depende, p. ej.
+("activities", user_id) o ("moods", partner_id). Cada etiqueta tiene un valor
+aleatorio guardado en la propia caché; los handlers del change feed llaman a
+invalidate(colección, *user_ids), que lo cambia, y las claves calculadas con
+el valor anterior dejan de encontrarse (salen por TTL o LRU). Solo se
+recalculan las vistas que dependen de lo escrito: un estado de ánimo nuevo no
+invalida las estadísticas de actividades.
+
+El almacén es cualquier cliente con la API de redis.asyncio (get, mget, set
+con ex/nx, info): un servidor compartido por todos los workers
+(VIEW_CACHE_BACKEND=redis, VIEW_CACHE_REDIS_URL) o MemoryCacheClient, en el
+proceso, acotado a VIEW_CACHE_MAX_BYTES y con los menos usados descartados
+primero. Si el almacén no responde, la vista se calcula sin caché. En memoria
+cada worker solo ve sus propias invalidaciones (o las de su change stream con
+CHANGE_FEED_MODE=stream): run.py desactiva la caché con varios workers en
+modo inline.
+
+Configuración por entorno:
+    VIEW_CACHE_ENABLED   0 para calcular siempre
+    VIEW_CACHE_TTLS      JSON con segundos por vista, p. ej. {"achievements": 60}
+"""
+
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+from fastapi.encoders import jsonable_encoder
+
+import metrics
+
+logger = logging.getLogger("loveacts.view_cache")
+
+VIEW_CACHE_ENABLED = os.environ.get("VIEW_CACHE_ENABLED", "1") == "1"
+VIEW_CACHE_BACKEND = os.environ.get("VIEW_CACHE_BACKEND", "memory")
+VIEW_CACHE_REDIS_URL = os.environ.get("VIEW_CACHE_REDIS_URL", "redis://localhost:6379/0")
+VIEW_CACHE_MAX_BYTES = int(os.environ.get("VIEW_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+VIEW_CACHE_TTL_DEFAULTS = {
+    "achievements": 300,
+    "correlation": 600,
+    "total_stats": 300,
+    "memories_filter": 120,
+}
+VIEW_CACHE_TTLS = {**VIEW_CACHE_TTL_DEFAULTS, **json.loads(os.environ.get("VIEW_CACHE_TTLS", "{}"))}
+# Las etiquetas duran más que cualquier vista: al caducar ya no queda nada que dependa de ellas
+TAG_TTL_SECONDS = 2 * max(VIEW_CACHE_TTLS.values())
+
+
+class MemoryCacheClient:
+    """Subconjunto de la API de redis.asyncio sobre un LRU en el proceso, acotado en bytes"""
+
+    def __init__(self, max_bytes=VIEW_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.evicted = 0
+        self._entries = OrderedDict()  # clave -> (valor, caduca o None)
+
+    def _size(self, key, value):
+        return len(key) + len(value)
+
+    def _pop(self, key):
+        value, _ = self._entries.pop(key)
+        self.used_bytes -= self._size(key, value)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            self._pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    async def get(self, key):
+        return self._get(key)
+
+    async def mget(self, *keys):
+        return [self._get(key) for key in keys]
+
+    async def set(self, key, value, ex=None, nx=False):
+        if isinstance(value, str):
+            value = value.encode()
+        if nx and self._get(key) is not None:
+            return None
+        if key in self._entries:
+            self._pop(key)
+        self._entries[key] = (value, time.monotonic() + ex if ex else None)
+        self.used_bytes += self._size(key, value)
+        while self.used_bytes > self.max_bytes and self._entries:
+            self._pop(next(iter(self._entries)))
+            self.evicted += 1
+        return True
+
+    async def info(self, section=None):
+        return {
+            "used_memory": self.used_bytes,
+            "maxmemory": self.max_bytes,
+            "keys": len(self._entries),
+            "evicted_keys": self.evicted,
+        }
+
+
+def create_client(backend=VIEW_CACHE_BACKEND):
+    if backend == "memory":
+        return MemoryCacheClient()
+    if backend == "redis":
+        import redis.asyncio  # dependencia opcional, solo con el backend compartido
+        return redis.asyncio.Redis.from_url(VIEW_CACHE_REDIS_URL)
+    raise ValueError(f"VIEW_CACHE_BACKEND desconocido: {backend}")
+
+
+def tag_key(collection, user_id):
+    return f"viewtag:{collection}:{user_id}"
+
+
+class ViewCache:
+    def __init__(self, client, ttls=VIEW_CACHE_TTLS):
+        self.client = client
+        self.ttls = ttls
+        self.hits = {}
+        self.misses = {}
+
+    async def _tag_values(self, tags):
+        keys = [tag_key(collection, user_id) for collection, user_id in tags]
+        values = await self.client.mget(*keys)
+        for index, value in enumerate(values):
+            if value is None:
+                # Etiqueta nueva (o caducada): si otra petición la creó a la vez, vale la suya
+                await self.client.set(keys[index], uuid.uuid4().hex, ex=TAG_TTL_SECONDS, nx=True)
+                values[index] = await self.client.get(keys[index])
+        return [value.decode() if isinstance(value, bytes) else str(value) for value in values]
+
+    async def get_or_compute(self, view, params, tags, compute):
+        """Vista (ya serializable) desde la caché o calculada con await compute()
+
+        params identifican la vista; tags son los (colección, user_id) de los que depende.
+        """
+        if not VIEW_CACHE_ENABLED:
+            return jsonable_encoder(await compute())
+
+        try:
+            versions = await self._tag_values([tag for tag in tags if tag[1]])
+            key = f"view:{view}:{':'.join(str(param) for param in params)}:{'.'.join(versions)}"
+            cached = await self.client.get(key)
+        except Exception as e:  # sin almacén se calcula sin caché
+            logger.warning("Caché de vistas no disponible", extra={"error": str(e)})
+            metrics.VIEW_CACHE.labels(view, "error").inc()
+            return jsonable_encoder(await compute())
+
+        if cached is not None:
+            self.hits[view] = self.hits.get(view, 0) + 1
+            metrics.VIEW_CACHE.labels(view, "hit").inc()
+            return json.loads(cached)
+
+        self.misses[view] = self.misses.get(view, 0) + 1
+        metrics.VIEW_CACHE.labels(view, "miss").inc()
+        value = jsonable_encoder(await compute())
+        try:
+            await self.client.set(key, json.dumps(value, separators=(",", ":")), ex=self.ttls[view])
+        except Exception as e:
+            logger.warning("No se pudo guardar la vista", extra={"view": view, "error": str(e)})
+        if isinstance(self.client, MemoryCacheClient):
+            # En Redis la memoria se consulta con INFO en stats(), no en cada escritura
+            metrics.VIEW_CACHE_BYTES.set(self.client.used_bytes)
+        return value
+
+    async def invalidate(self, collection, *user_ids):
+        """Descarta las vistas que dependen de lo escrito en collection para user_ids"""
+        for user_id in user_ids:
+            if not user_id:
+                continue
+            try:
+                await self.client.set(tag_key(collection, user_id), uuid.uuid4().hex, ex=TAG_TTL_SECONDS)
+            except Exception as e:
+                logger.warning("No se pudo invalidar la caché de vistas",
+                               extra={"collection": collection, "user_id": user_id, "error": str(e)})
+
+    async def stats(self):
+        """Aciertos por vista en este worker y memoria del almacén"""
+        views = {}
+        for view in sorted(set(self.hits) | set(self.misses)):
+            hits, misses = self.hits.get(view, 0), self.misses.get(view, 0)
+            views[view] = {"hits": hits, "misses": misses, "hit_ratio": round(hits / (hits + misses), 3)}
+        try:
+            info = await self.client.info("memory")
+            metrics.VIEW_CACHE_BYTES.set(info["used_memory"])
+            memory = {name: info.get(name) for name in ("used_memory", "maxmemory", "evicted_keys")}
+        except Exception as e:
+            memory = {"error": str(e)}
+        return {"backend": VIEW_CACHE_BACKEND, "views": views, "memory": memory}
+
+
+views = ViewCache(create_client())
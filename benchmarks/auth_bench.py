@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Benchmark de autenticación de LoveActs
+
+Compara peticiones autenticadas por segundo resolviendo el usuario con
+get_current_user (consulta a Mongo en cada petición) frente a
+get_current_claims (verifica el JWT y, con pareja, la token_version
+cacheada). Se mide con un miembro de una pareja vinculada, el caso de casi
+todas las peticiones, y con un usuario sin pareja. Corre la app en proceso
+con httpx + ASGITransport contra la base configurada en MONGO_URL/DB_NAME.
+
+Uso (desde la raíz del repo, con un mongod local):
+    python benchmarks/auth_bench.py --requests 5000 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+# Toda la carga sale de una IP y de pocos usuarios: sin límites de tasa ni descarte
+os.environ.setdefault("ADMISSION_ENABLED", "0")
+
+import httpx
+from fastapi import Depends, FastAPI
+
+import server
+
+
+def build_probe_app():
+    """Dos rutas idénticas salvo por la dependencia de autenticación"""
+    probe = FastAPI()
+
+    @probe.get("/db")
+    async def with_db_lookup(current_user=Depends(server.get_current_user)):
+        return {"id": current_user["id"]}
+
+    @probe.get("/claims")
+    async def with_claims(current_user=Depends(server.get_current_claims)):
+        return {"id": current_user["id"]}
+
+    return probe
+
+
+async def run_http(client, path, headers, total, concurrency):
+    latencies = []
+    remaining = total
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            response = await client.get(path, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "requests_per_second": round(total / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+    }
+
+
+def run_dependency(func, credentials, total):
+    start = time.perf_counter()
+    for _ in range(total):
+        func(credentials)
+    elapsed = time.perf_counter() - start
+    return {"calls": total, "calls_per_second": round(total / elapsed, 1)}
+
+
+def bench_user(label, partner_id=None):
+    user_id = f"bench-auth-{label}-{uuid.uuid4()}"
+    return {
+        "id": user_id,
+        "name": f"Bench {label}",
+        "email": f"{user_id}@example.com",
+        "password": "",
+        "partner_id": partner_id,
+        "partner_code": server.generate_partner_code(),
+        "token_version": 0,
+        "created_at": datetime.now(timezone.utc),
+    }
+
+
+async def bench_profile(client, user, args):
+    token = server.create_access_token(user)
+    headers = {"Authorization": f"Bearer {token}"}
+    credentials = server.HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+    results = {
+        "dependency": {
+            "get_current_user": run_dependency(server.get_current_user, credentials, args.requests),
+            "get_current_claims": run_dependency(server.get_current_claims, credentials, args.requests),
+        },
+        "http": {},
+    }
+    for name, path in (("get_current_user", "/db"), ("get_current_claims", "/claims")):
+        await run_http(client, path, headers, min(200, args.requests), args.concurrency)  # calentamiento
+        results["http"][name] = await run_http(client, path, headers, args.requests, args.concurrency)
+    return results
+
+
+async def main_async(args):
+    member = bench_user("a")
+    partner = bench_user("b", partner_id=member["id"])
+    member["partner_id"] = partner["id"]
+    single = bench_user("single")
+    users = [member, partner, single]
+    server.db.users.insert_many([dict(user) for user in users])
+    try:
+        transport = httpx.ASGITransport(app=build_probe_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            return {
+                "linked_couple": await bench_profile(client, member, args),
+                "single": await bench_profile(client, single, args),
+            }
+    finally:
+        server.db.users.delete_many({"id": {"$in": [user["id"] for user in users]}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peticiones autenticadas/s con y sin consulta a Mongo")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(main_async(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
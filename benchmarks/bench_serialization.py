@@ -0,0 +1,124 @@
+"""
+Micro-benchmarks de serialización y autenticación (pytest-benchmark)
+
+Miden los mismos caminos que recorren los endpoints: construir los modelos de
+respuesta desde documentos de Mongo, la codificación de FastAPI
+(jsonable_encoder + JSONResponse) y el JWT de create_access_token /
+get_current_claims / get_current_user.
+
+Uso (desde benchmarks/):
+    pytest --benchmark-save=baseline                        # en main
+    pytest --benchmark-compare=0001 --benchmark-compare-fail=mean:10%
+    pytest -k "not 100000"                                  # sin los tamaños grandes
+
+Los resultados se guardan en benchmarks/.benchmarks/ (uno por máquina y
+versión de Python; no se suben al repo).
+"""
+
+from datetime import datetime, timezone
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.security import HTTPAuthorizationCredentials
+
+import server
+from conftest import ROW_COUNTS
+
+
+def encode_response(content):
+    """Lo que hace FastAPI con lo que devuelve un endpoint sin response_model"""
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def build_daily(activities, moods):
+    half = len(activities) // 2
+    user_activities = [server.ActivityResponse(**activity) for activity in activities[:half]]
+    partner_activities = [server.ActivityResponse(**activity) for activity in activities[half:]]
+    return server.DailyStatsExpanded(
+        date=activities[0]["date"],
+        user_activities=user_activities,
+        partner_activities=partner_activities,
+        pending_ratings_count=3,
+        user_mood=server.MoodResponse(**moods[0]),
+        partner_mood=server.MoodResponse(**moods[1]),
+        completed_activities_score=sum(a.rating for a in user_activities + partner_activities if a.rating is not None),
+        total_activities=len(user_activities) + len(partner_activities),
+    )
+
+
+def build_memories(activities):
+    today = datetime.now(timezone.utc).date()
+    return [
+        server.MemoryResponse(
+            activity=server.ActivityResponse(**activity),
+            days_ago=(today - datetime.fromisoformat(activity["date"]).date()).days,
+            memory_message="¡Recuerda este hermoso gesto de tu pareja!",
+        )
+        for activity in activities
+    ]
+
+
+@pytest.mark.benchmark(group="construcción: ActivityResponse")
+@pytest.mark.parametrize("rows", ROW_COUNTS)
+def test_activity_response(benchmark, activity_rows, rows):
+    data = activity_rows[rows]
+    benchmark(lambda: [server.ActivityResponse(**activity) for activity in data])
+
+
+@pytest.mark.benchmark(group="construcción: MoodResponse")
+@pytest.mark.parametrize("rows", ROW_COUNTS)
+def test_mood_response(benchmark, mood_rows, rows):
+    data = mood_rows[rows]
+    benchmark(lambda: [server.MoodResponse(**mood) for mood in data])
+
+
+@pytest.mark.benchmark(group="construcción: MemoryResponse")
+@pytest.mark.parametrize("rows", ROW_COUNTS)
+def test_memory_response(benchmark, activity_rows, rows):
+    benchmark(build_memories, activity_rows[rows])
+
+
+@pytest.mark.benchmark(group="construcción: DailyStatsExpanded")
+@pytest.mark.parametrize("rows", ROW_COUNTS)
+def test_daily_stats_expanded(benchmark, activity_rows, mood_rows, rows):
+    benchmark(build_daily, activity_rows[rows], mood_rows[10])
+
+
+@pytest.mark.benchmark(group="codificación: actividades")
+@pytest.mark.parametrize("rows", ROW_COUNTS)
+def test_encode_activities(benchmark, activity_rows, rows):
+    activities = [server.ActivityResponse(**activity) for activity in activity_rows[rows]]
+    benchmark(encode_response, {"activities": activities, "count": len(activities)})
+
+
+@pytest.mark.benchmark(group="codificación: DailyStatsExpanded")
+@pytest.mark.parametrize("rows", ROW_COUNTS)
+def test_encode_daily(benchmark, activity_rows, mood_rows, rows):
+    benchmark(encode_response, build_daily(activity_rows[rows], mood_rows[10]))
+
+
+@pytest.mark.benchmark(group="codificación: MemoryResponse")
+@pytest.mark.parametrize("rows", ROW_COUNTS)
+def test_encode_memories(benchmark, activity_rows, rows):
+    memories = build_memories(activity_rows[rows])
+    benchmark(encode_response, {"memories": memories, "total_five_star_activities": len(memories)})
+
+
+@pytest.mark.benchmark(group="jwt")
+def test_create_access_token(benchmark, couple):
+    benchmark(server.create_access_token, couple[0])
+
+
+@pytest.mark.benchmark(group="jwt")
+def test_get_current_claims(benchmark, couple):
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=server.create_access_token(couple[0]))
+    claims = benchmark(server.get_current_claims, credentials)
+    assert claims["id"] == couple[0]["id"]
+
+
+@pytest.mark.benchmark(group="jwt")
+def test_get_current_user(benchmark, stored_user):
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=server.create_access_token(stored_user))
+    user = benchmark(server.get_current_user, credentials)
+    assert user["id"] == stored_user["id"]
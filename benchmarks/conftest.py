@@ -0,0 +1,75 @@
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+import generate_data
+import server
+
+ROW_COUNTS = [10, 1_000, 100_000]
+
+
+def _user(rng, label):
+    user = generate_data.user_document(rng, f"Bench {label}", f"{label}@bench.example.com", "hash",
+                                       datetime.now(timezone.utc))
+    user["_id"] = generate_data.random_uuid(rng)  # como lo devuelve find()
+    return user
+
+
+@pytest.fixture(scope="session")
+def couple():
+    rng = random.Random(7)
+    user, partner = _user(rng, "a"), _user(rng, "b")
+    user["partner_id"], partner["partner_id"] = partner["id"], user["id"]
+    return user, partner
+
+
+@pytest.fixture(scope="session")
+def activity_rows(couple):
+    """Actividades con la forma de Mongo (incluido _id), una lista por tamaño"""
+    rng = random.Random(11)
+    today = datetime.now(timezone.utc).date()
+    rows = []
+    for index in range(max(ROW_COUNTS)):
+        date = today - timedelta(days=rng.randrange(365))
+        created_at = datetime.combine(date, datetime.min.time(), timezone.utc)
+        row = generate_data.activity_document(rng, couple[index % 2], date, created_at, rng.random() < 0.1)
+        row["_id"] = index
+        rows.append(row)
+    return {count: rows[:count] for count in ROW_COUNTS}
+
+
+@pytest.fixture(scope="session")
+def mood_rows(couple):
+    rng = random.Random(13)
+    today = datetime.now(timezone.utc).date()
+    rows = []
+    for index in range(max(ROW_COUNTS)):
+        row = generate_data.mood_document(rng, couple[index % 2]["id"], today - timedelta(days=index // 2))
+        row["_id"] = index
+        rows.append(row)
+    return {count: rows[:count] for count in ROW_COUNTS}
+
+
+@pytest.fixture(scope="session")
+def stored_user(couple):
+    """Usuario guardado para get_current_user; con Mongo se omite si no está disponible"""
+    if server.STORAGE_BACKEND == "mongo":
+        probe = MongoClient(os.environ.get("MONGO_URL"), serverSelectionTimeoutMS=1000)
+        try:
+            probe.admin.command("ping")
+        except PyMongoError:
+            pytest.skip("Mongo no disponible (o usar STORAGE_BACKEND=memory)")
+        finally:
+            probe.close()
+
+    user = {key: value for key, value in couple[0].items() if key != "_id"}
+    server.db.users.insert_one(user)
+    yield user
+    server.db.users.delete_one({"id": user["id"]})
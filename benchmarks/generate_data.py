@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Generador de datos sintéticos de LoveActs para pruebas de escala
+
+Carga usuarios, parejas vinculadas, actividades (con distribuciones de
+categoría, momento del día y calificación), estados de ánimo, notificaciones y
+suscripciones en la base indicada. Los documentos tienen la misma forma que
+escriben register, create_activity, rate_activity, create_mood,
+send_push_notification y subscribe_to_notifications.
+
+Trabaja por fragmentos de parejas en varios procesos; cada pareja usa su
+propia semilla derivada de --seed y de su número, así que la misma --seed
+genera siempre los mismos datos con cualquier --workers (con fechas relativas
+al día en que se ejecuta).
+Los documentos se insertan con insert_many en lotes de --batch-size y nunca
+se acumula más de un lote por colección en memoria.
+
+Uso (desde la raíz del repo):
+    python benchmarks/generate_data.py --db loveacts_scale --activities 1000 --couples 10
+    python benchmarks/generate_data.py --db loveacts_scale --activities 10000000 --couples 20000 \\
+        --days 730 --workers 8 --drop
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import bcrypt
+from pymongo import MongoClient
+
+DEFAULT_PASSWORD = "loveacts-scale"
+EMAIL_DOMAIN = "scale.example.com"
+
+CATEGORIES = ["physical", "emotional", "practical", "general"]
+CATEGORY_WEIGHTS = [30, 30, 25, 15]
+TIMES_OF_DAY = ["morning", "afternoon", "evening", "night", None]
+TIME_OF_DAY_WEIGHTS = [20, 20, 30, 15, 15]
+RATINGS = [5, 4, 3, 2, 1]
+RATING_WEIGHTS = [40, 30, 15, 10, 5]
+MOODS = [("happy", "😊"), ("loved", "🥰"), ("tired", "😴"), ("stressed", "😰"), ("horny", "😏"), ("bored", "😐")]
+COMMENTS = [None, None, None, "¡Me encantó!", "Gracias, amor", "Lo necesitaba"]
+
+PENDING_PROBABILITY = 0.08
+MOOD_PROBABILITY = 0.6
+SUBSCRIPTION_PROBABILITY = 0.7
+READ_PROBABILITY = 0.85
+
+COLLECTIONS = ["users", "activities", "moods", "notifications", "notification_subscriptions"]
+
+
+def random_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def user_document(rng, name, email, password_hash, created_at):
+    """Forma de register (más partner_id, que fija link_partner)"""
+    return {
+        "id": random_uuid(rng),
+        "name": name,
+        "email": email,
+        "password": password_hash,
+        "partner_id": None,
+        "partner_code": random_uuid(rng)[:8].upper(),
+        "token_version": 0,
+        "created_at": created_at,
+    }
+
+
+def activity_document(rng, author, date, created_at, pending):
+    """Forma de create_activity, y de rate_activity si no está pendiente"""
+    rated = not pending
+    return {
+        "id": random_uuid(rng),
+        "user_id": author["id"],
+        "user_name": author["name"],
+        "description": f"Acto de amor #{rng.randint(1, 1_000_000)}",
+        "category": rng.choices(CATEGORIES, CATEGORY_WEIGHTS)[0],
+        "time_of_day": rng.choices(TIMES_OF_DAY, TIME_OF_DAY_WEIGHTS)[0],
+        "date": date.isoformat(),
+        "rating": rng.choices(RATINGS, RATING_WEIGHTS)[0] if rated else None,
+        "partner_comment": rng.choice(COMMENTS) if rated else None,
+        "is_pending_rating": pending,
+        "created_at": created_at,
+        "rated_at": created_at + timedelta(minutes=rng.randint(5, 24 * 60)) if rated else None,
+    }
+
+
+def mood_document(rng, user_id, date):
+    """Forma de create_mood (un documento por usuario y día)"""
+    mood_id, emoji = rng.choice(MOODS)
+    return {
+        "id": random_uuid(rng),
+        "user_id": user_id,
+        "mood_id": mood_id,
+        "mood_emoji": emoji,
+        "note": None,
+        "date": date.isoformat(),
+        "created_at": datetime.combine(date, datetime.min.time(), timezone.utc) + timedelta(
+            seconds=rng.randint(0, 86399)),
+    }
+
+
+def notification_document(rng, user_id, author_name, activity, read):
+    """Forma de send_push_notification para una actividad nueva (y de mark_read si está leída)"""
+    document = {
+        "id": random_uuid(rng),
+        "user_id": user_id,
+        "title": "💕 Nuevo acto de amor",
+        "body": f"{author_name} registró un acto especial para ti. ¡Ve a calificarlo!",
+        "icon": "/images/icon-192x192.png",
+        "tag": "new_activity",
+        "data": {"activity_id": activity["id"], "type": "new_activity"},
+        "read": read,
+        "created_at": activity["created_at"],
+    }
+    if read:
+        document["read_at"] = activity["created_at"] + timedelta(hours=1)
+    return document
+
+
+def subscription_document(rng, user_id, created_at):
+    """Forma de subscribe_to_notifications"""
+    return {
+        "id": random_uuid(rng),
+        "user_id": user_id,
+        "endpoint": f"https://push.example.com/send/{rng.getrandbits(64):016x}",
+        "keys": {"p256dh": f"{rng.getrandbits(256):064x}", "auth": f"{rng.getrandbits(64):016x}"},
+        "created_at": created_at,
+    }
+
+
+def generate_couple(rng, label, password_hash, days, activities, mood_probability=MOOD_PROBABILITY,
+                    recent_pending_days=0, email_domain=EMAIL_DOMAIN):
+    """Una pareja vinculada con su historial, como listas de documentos por colección
+
+    También devuelve "pending": pares (id de quien debe calificar, id de actividad).
+    recent_pending_days deja pendientes la mitad de las actividades de los últimos días.
+    """
+    today = datetime.now(timezone.utc).date()
+    since = datetime.now(timezone.utc) - timedelta(days=days + 1)
+    user = user_document(rng, f"Pareja {label}a", f"{label}a@{email_domain}", password_hash, since)
+    partner = user_document(rng, f"Pareja {label}b", f"{label}b@{email_domain}", password_hash, since)
+    user["partner_id"], partner["partner_id"] = partner["id"], user["id"]
+    members = (user, partner)
+
+    docs = {"users": [user, partner], "activities": [], "moods": [], "notifications": [],
+            "notification_subscriptions": [], "pending": []}
+
+    subscribed = set()
+    for member in members:
+        if rng.random() < SUBSCRIPTION_PROBABILITY:
+            subscribed.add(member["id"])
+            docs["notification_subscriptions"].append(subscription_document(rng, member["id"], since))
+
+    day_offsets = sorted((rng.randrange(days + 1) for _ in range(activities)), reverse=True)
+    for day_offset in day_offsets:
+        date = today - timedelta(days=day_offset)
+        author_index = rng.randrange(2)
+        author, rater = members[author_index], members[1 - author_index]
+        created_at = datetime.combine(date, datetime.min.time(), timezone.utc) + timedelta(
+            seconds=rng.randint(0, 86399))
+        pending = rng.random() < PENDING_PROBABILITY or (day_offset < recent_pending_days and rng.random() < 0.5)
+
+        activity = activity_document(rng, author, date, created_at, pending)
+        docs["activities"].append(activity)
+        if pending:
+            docs["pending"].append((rater["id"], activity["id"]))
+        if rater["id"] in subscribed:
+            read = not pending and rng.random() < READ_PROBABILITY
+            docs["notifications"].append(notification_document(rng, rater["id"], author["name"], activity, read))
+
+    for day_offset in range(days, -1, -1):
+        date = today - timedelta(days=day_offset)
+        for member in members:
+            if rng.random() < mood_probability:
+                docs["moods"].append(mood_document(rng, member["id"], date))
+
+    return docs
+
+
+def generate_shard(task):
+    """Proceso hijo: genera e inserta las parejas [start, end), cada una con su propia semilla"""
+    (mongo_url, db_name, shard, start, end, activities_per_couple, remainder,
+     days, batch_size, seed, run_tag, password_hash) = task
+
+    client = MongoClient(mongo_url)
+    db = client[db_name]
+    buffers = {name: [] for name in COLLECTIONS}
+    counts = {name: 0 for name in COLLECTIONS}
+
+    def flush(name):
+        if buffers[name]:
+            db[name].insert_many(buffers[name], ordered=False)
+            counts[name] += len(buffers[name])
+            buffers[name] = []
+
+    try:
+        for index in range(start, end):
+            activities = activities_per_couple + (1 if index < remainder else 0)
+            # Semilla por pareja: los datos no dependen de cómo se reparten entre procesos
+            rng = random.Random(f"{seed}:{index}")
+            docs = generate_couple(rng, f"{run_tag}-{index}-", password_hash, days, activities)
+            for name in COLLECTIONS:
+                buffers[name].extend(docs[name])
+                if len(buffers[name]) >= batch_size:
+                    flush(name)
+        for name in COLLECTIONS:
+            flush(name)
+    finally:
+        client.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga datos sintéticos de LoveActs")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default=os.environ.get("DB_NAME", "loveacts_scale"), help="Base de datos destino")
+    parser.add_argument("--activities", type=int, required=True, help="Total de actividades (1k a 10M)")
+    parser.add_argument("--couples", type=int, default=None,
+                        help="Parejas a crear (por defecto una por cada 500 actividades)")
+    parser.add_argument("--days", type=int, default=365, help="Días de historial")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--password", default=DEFAULT_PASSWORD, help="Contraseña de todos los usuarios")
+    parser.add_argument("--drop", action="store_true", help="Vaciar las colecciones antes de cargar")
+    args = parser.parse_args()
+
+    couples = args.couples or max(1, args.activities // 500)
+    activities_per_couple, remainder = divmod(args.activities, couples)
+
+    if args.drop:
+        client = MongoClient(args.mongo_url)
+        for name in COLLECTIONS:
+            client[args.db][name].drop()
+        client.close()
+
+    # bcrypt es lento a propósito: un único hash compartido por todos los usuarios
+    password_hash = bcrypt.hashpw(args.password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    run_tag = f"s{args.seed}"
+
+    shards = max(1, min(couples, args.workers * 4))
+    bounds = [couples * i // shards for i in range(shards + 1)]
+    tasks = [
+        (args.mongo_url, args.db, shard, bounds[shard], bounds[shard + 1], activities_per_couple, remainder,
+         args.days, args.batch_size, args.seed, run_tag, password_hash)
+        for shard in range(shards)
+    ]
+
+    start = time.perf_counter()
+    totals = {name: 0 for name in COLLECTIONS}
+    with multiprocessing.Pool(processes=min(args.workers, shards)) as pool:
+        for counts in pool.imap_unordered(generate_shard, tasks):
+            for name, count in counts.items():
+                totals[name] += count
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        "database": args.db,
+        "couples": couples,
+        "inserted": totals,
+        "elapsed_seconds": round(elapsed, 2),
+        "documents_per_second": round(sum(totals.values()) / elapsed, 1),
+        "login": {"email": f"{run_tag}-0-a@{EMAIL_DOMAIN}", "password": args.password},
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Benchmark de carga de LoveActs con parejas sintéticas
+
+Siembra N parejas con historial de actividades y estados de ánimo, lanza una
+mezcla concurrente de operaciones (login, crear actividad, calificar, vista
+diaria, recuerdos, logros...) y reporta throughput y p50/p95/p99 por endpoint
+en JSON, para comparar entre commits.
+
+Por defecto la app corre en el mismo proceso (httpx + ASGITransport) contra
+MONGO_URL/DB_NAME. Con --base-url se ataca un servidor ya levantado, que debe
+usar la misma base de datos para ver los datos sembrados.
+
+Uso (desde la raíz del repo, con un mongod local):
+    DB_NAME=loveacts_bench python benchmarks/load_test.py --couples 50 --duration 30 --concurrency 32 \\
+        --output results.json
+    DB_NAME=loveacts_bench python benchmarks/load_test.py --compare results.json --fail-threshold 10
+
+Con STORAGE_BACKEND=memory no hace falta Mongo: la app y los datos sembrados
+viven en el motor en memoria del proceso, lo que aísla el coste de CPU de la
+propia app (solo tiene sentido sin --base-url).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+# Toda la carga sale de una IP y de pocos usuarios: sin límites de tasa ni descarte
+os.environ.setdefault("ADMISSION_ENABLED", "0")
+
+import httpx
+
+import generate_data
+import server
+from generate_data import CATEGORIES, CATEGORY_WEIGHTS, MOODS, RATING_WEIGHTS, RATINGS
+
+BENCH_EMAIL_DOMAIN = "bench.example.com"
+BENCH_PASSWORD = "bench-password"
+
+# Operación -> peso en la mezcla de carga
+WORKLOAD = {
+    "daily": 30,
+    "create_activity": 15,
+    "memories_filter": 12,
+    "rate_activity": 10,
+    "pending_ratings": 10,
+    "achievements": 8,
+    "memories_special": 5,
+    "login": 5,
+    "create_mood": 5,
+}
+
+
+def seed_couples(db, count, days, activities_per_day, seed):
+    """Inserta parejas vinculadas con historial. Devuelve la lista de parejas sembradas"""
+    rng = random.Random(seed)
+    password_hash = server.hash_password(BENCH_PASSWORD)  # bcrypt una sola vez
+    run_tag = uuid.uuid4().hex[:8]
+    couples = []
+
+    for index in range(count):
+        docs = generate_data.generate_couple(
+            rng, f"{run_tag}-{index}", password_hash, days,
+            activities=2 * activities_per_day * (days + 1),
+            recent_pending_days=2,
+            email_domain=BENCH_EMAIL_DOMAIN,
+        )
+        for collection in generate_data.COLLECTIONS:
+            if docs[collection]:
+                db[collection].insert_many(docs[collection])
+
+        couples.append({"members": docs["users"], "pending": docs["pending"]})
+
+    return couples
+
+
+def cleanup(db, couples):
+    user_ids = [member["id"] for couple in couples for member in couple["members"]]
+    for collection in ("activities", "moods", "notifications", "notification_subscriptions"):
+        db[collection].delete_many({"user_id": {"$in": user_ids}})
+    db.users.delete_many({"id": {"$in": user_ids}})
+    db.notification_counters.delete_many({"_id": {"$in": user_ids}})
+
+
+class LoadRunner:
+    def __init__(self, client, couples, seed):
+        self.client = client
+        self.couples = couples
+        self.rng = random.Random(seed)
+        self.tokens = {}
+        self.latencies = {name: [] for name in WORKLOAD}
+        self.errors = {name: 0 for name in WORKLOAD}
+        for couple in couples:
+            for member in couple["members"]:
+                self.tokens[member["id"]] = server.create_access_token(member)
+
+    def headers(self, member):
+        return {"Authorization": f"Bearer {self.tokens[member['id']]}"}
+
+    async def request(self, operation, couple, member):
+        today = datetime.now(timezone.utc).date().isoformat()
+        if operation == "daily":
+            return await self.client.get(f"/api/activities/daily/{today}", headers=self.headers(member))
+        if operation == "create_activity":
+            return await self.client.post("/api/activities", headers=self.headers(member), json={
+                "description": "Acto de carga",
+                "category": self.rng.choices(CATEGORIES, CATEGORY_WEIGHTS)[0],
+            })
+        if operation == "rate_activity":
+            pending = [item for item in couple["pending"] if item[0] == member["id"]]
+            if not pending:
+                return None
+            item = self.rng.choice(pending)
+            couple["pending"].remove(item)
+            return await self.client.post(f"/api/activities/{item[1]}/rate", headers=self.headers(member),
+                                          json={"rating": self.rng.choices(RATINGS, RATING_WEIGHTS)[0]})
+        if operation == "create_mood":
+            mood_id, emoji = self.rng.choice(MOODS)
+            return await self.client.post("/api/mood", headers=self.headers(member),
+                                          json={"mood_id": mood_id, "mood_emoji": emoji})
+        if operation == "memories_filter":
+            return await self.client.get("/api/memories/filter", headers=self.headers(member),
+                                         params={"days_back": self.rng.choice([7, 30, 90, 365])})
+        if operation == "memories_special":
+            return await self.client.get("/api/memories/special", headers=self.headers(member))
+        if operation == "pending_ratings":
+            return await self.client.get("/api/activities/pending-ratings", headers=self.headers(member))
+        if operation == "achievements":
+            return await self.client.get("/api/achievements", headers=self.headers(member))
+        if operation == "login":
+            return await self.client.post("/api/login", json={"email": member["email"], "password": BENCH_PASSWORD})
+        raise ValueError(operation)
+
+    async def worker(self, deadline):
+        operations, weights = list(WORKLOAD), list(WORKLOAD.values())
+        while time.perf_counter() < deadline:
+            operation = self.rng.choices(operations, weights)[0]
+            couple = self.rng.choice(self.couples)
+            member = self.rng.choice(couple["members"])
+
+            start = time.perf_counter()
+            try:
+                response = await self.request(operation, couple, member)
+            except httpx.HTTPError:
+                self.errors[operation] += 1
+                continue
+            if response is None:
+                continue
+            self.latencies[operation].append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                self.errors[operation] += 1
+
+    async def run(self, duration, concurrency):
+        deadline = time.perf_counter() + duration
+        start = time.perf_counter()
+        await asyncio.gather(*(self.worker(deadline) for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return round(sorted_values[index] * 1000, 3)
+
+
+def summarize(latencies, errors, elapsed):
+    endpoints = {}
+    total = 0
+    for operation, values in latencies.items():
+        values = sorted(values)
+        total += len(values)
+        endpoints[operation] = {
+            "requests": len(values),
+            "errors": errors[operation],
+            "throughput_rps": round(len(values) / elapsed, 2),
+            "p50_ms": percentile(values, 0.50),
+            "p95_ms": percentile(values, 0.95),
+            "p99_ms": percentile(values, 0.99),
+            "max_ms": round(values[-1] * 1000, 3) if values else None,
+        }
+    return {
+        "total_requests": total,
+        "total_errors": sum(errors.values()),
+        "throughput_rps": round(total / elapsed, 2),
+        "elapsed_seconds": round(elapsed, 2),
+        "endpoints": endpoints,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Cambios de p95 y throughput respecto a una ejecución anterior. Devuelve las regresiones"""
+    regressions = []
+    for operation, current in results["summary"]["endpoints"].items():
+        previous = baseline["summary"]["endpoints"].get(operation)
+        if not previous or not previous["p95_ms"] or not current["p95_ms"]:
+            continue
+        p95_change = (current["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] * 100
+        rps_change = ((current["throughput_rps"] - previous["throughput_rps"]) / previous["throughput_rps"] * 100
+                      if previous["throughput_rps"] else 0.0)
+        print(f"{operation:18} p95 {previous['p95_ms']:>9.2f} -> {current['p95_ms']:>9.2f} ms ({p95_change:+6.1f}%)"
+              f"   rps {previous['throughput_rps']:>8.1f} -> {current['throughput_rps']:>8.1f} ({rps_change:+6.1f}%)",
+              file=sys.stderr)
+        if p95_change > threshold:
+            regressions.append(operation)
+    return regressions
+
+
+async def main_async(args):
+    couples = seed_couples(server.db, args.couples, args.history_days, args.activities_per_day, args.seed)
+    try:
+        if args.base_url:
+            client = httpx.AsyncClient(base_url=args.base_url, timeout=30)
+            lifespan = None
+        else:
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app),
+                                       base_url="http://loadtest", timeout=30)
+            # Ejecuta el arranque/apagado de la app como lo haría uvicorn
+            lifespan = server.app.router.lifespan_context(server.app)
+            await lifespan.__aenter__()
+
+        try:
+            runner = LoadRunner(client, couples, args.seed)
+            if args.warmup:
+                await runner.run(args.warmup, args.concurrency)
+                runner.latencies = {name: [] for name in WORKLOAD}
+                runner.errors = {name: 0 for name in WORKLOAD}
+            elapsed = await runner.run(args.duration, args.concurrency)
+        finally:
+            await client.aclose()
+            if lifespan is not None:
+                await lifespan.__aexit__(None, None, None)
+    finally:
+        if not args.keep_data:
+            cleanup(server.db, couples)
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "mode": "remote" if args.base_url else "in-process",
+        "params": {
+            "couples": args.couples,
+            "history_days": args.history_days,
+            "activities_per_day": args.activities_per_day,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "seed": args.seed,
+            "storage": server.STORAGE_BACKEND,
+        },
+        "summary": summarize(runner.latencies, runner.errors, elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de carga con parejas sintéticas")
+    parser.add_argument("--couples", type=int, default=20)
+    parser.add_argument("--history-days", type=int, default=90)
+    parser.add_argument("--activities-per-day", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20, help="Segundos de carga medida")
+    parser.add_argument("--warmup", type=float, default=3, help="Segundos de calentamiento no medidos")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--base-url", help="Atacar un servidor en marcha (p. ej. http://localhost:8001)")
+    parser.add_argument("--output", help="Guardar los resultados JSON en este archivo")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior con el que comparar")
+    parser.add_argument("--fail-threshold", type=float, default=None,
+                        help="Salir con error si el p95 de algún endpoint empeora más de este porcentaje")
+    parser.add_argument("--keep-data", action="store_true", help="No borrar las parejas sembradas al terminar")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.fail_threshold or float("inf"))
+        if regressions and args.fail_threshold is not None:
+            print(f"Regresiones de p95 > {args.fail_threshold}%: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
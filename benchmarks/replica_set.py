@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Replica set local para probar el enrutado de lecturas y el change feed
+
+start levanta un mongod por puerto (27017-27019 por defecto; con un solo
+puerto, un replica set de un nodo) con datos en un directorio temporal, inicia
+el replica set y espera al primario; stop los detiene.
+
+check corre la app en proceso contra el replica set y comprueba que los
+endpoints de análisis leen de un secundario y que aun así quien escribe ve su
+escritura en la siguiente lectura (sesiones causales, ver read_routing).
+
+check-feed corre el change feed en proceso (CHANGE_FEED_MODE=stream) y
+comprueba que una actividad insertada directamente en Mongo, sin pasar por la
+API, notifica a la pareja, actualiza user_stats e invalida la caché de logros,
+y que tras parar el feed retoma desde su resume token lo escrito mientras
+estaba parado. Basta un nodo.
+
+Uso (desde la raíz del repo, con mongod en el PATH):
+    python benchmarks/replica_set.py start --dir /tmp/loveacts-rs
+    MONGO_URL="mongodb://localhost:27017,localhost:27018,localhost:27019/?replicaSet=rs0" \\
+        DB_NAME=loveacts_rs python benchmarks/replica_set.py check
+    python benchmarks/replica_set.py stop
+
+    python benchmarks/replica_set.py start --ports 27017
+    MONGO_URL="mongodb://localhost:27017/?replicaSet=rs0" DB_NAME=loveacts_rs \\
+        python benchmarks/replica_set.py check-feed
+    python benchmarks/replica_set.py stop --ports 27017
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+
+REPLICA_SET = "rs0"
+
+
+def replica_set_url(ports):
+    hosts = ",".join(f"localhost:{port}" for port in ports)
+    return f"mongodb://{hosts}/?replicaSet={REPLICA_SET}"
+
+
+def start(directory, ports):
+    for port in ports:
+        node_dir = os.path.join(directory, str(port))
+        os.makedirs(node_dir, exist_ok=True)
+        subprocess.run(
+            ["mongod", "--replSet", REPLICA_SET, "--port", str(port), "--bind_ip", "localhost",
+             "--dbpath", node_dir, "--logpath", os.path.join(node_dir, "mongod.log"),
+             "--pidfilepath", os.path.join(node_dir, "mongod.pid"), "--fork"],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+
+    client = MongoClient(f"mongodb://localhost:{ports[0]}", directConnection=True)
+    try:
+        client.admin.command("replSetInitiate", {
+            "_id": REPLICA_SET,
+            "members": [{"_id": index, "host": f"localhost:{port}"} for index, port in enumerate(ports)],
+        })
+    except PyMongoError as e:
+        if "already initialized" not in str(e):
+            raise
+    finally:
+        client.close()
+
+    client = MongoClient(replica_set_url(ports), serverSelectionTimeoutMS=60000)
+    try:
+        client.admin.command("ping")  # espera a que haya primario
+        deadline = time.monotonic() + 60
+        while len(client.secondaries) < len(ports) - 1:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Los secundarios no terminaron de sincronizar")
+            time.sleep(0.5)
+    finally:
+        client.close()
+    print(f'export MONGO_URL="{replica_set_url(ports)}"')
+
+
+def stop(ports):
+    for port in ports:
+        client = MongoClient(f"mongodb://localhost:{port}", directConnection=True, serverSelectionTimeoutMS=2000)
+        try:
+            client.admin.command("shutdown", force=True)
+        except PyMongoError:
+            pass  # el nodo cierra la conexión al apagarse, o ya estaba parado
+        finally:
+            client.close()
+
+
+class ReadTargets(monitoring.CommandListener):
+    """Servidor al que fue cada find/count de la petición en curso"""
+
+    def __init__(self):
+        self.reads = []
+
+    def started(self, event):
+        if event.command_name in ("find", "count", "aggregate"):
+            self.reads.append((event.command_name, event.connection_id))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def check():
+    targets = ReadTargets()
+    monitoring.register(targets)  # antes de que server abra su cliente
+
+    import httpx
+    import server
+
+    server.db.command("ping")  # espera al descubrimiento de la topología
+    primary = server.db.client.primary
+    if primary is None or not server.db.client.secondaries:
+        raise SystemExit("MONGO_URL no apunta a un replica set con secundarios")
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://check") as http:
+        suffix = uuid.uuid4().hex[:8]
+        registered = []
+        for name in ("a", "b"):
+            response = await http.post("/api/register", json={
+                "name": f"RS {name}", "email": f"rs-{name}-{suffix}@check.example.com", "password": "password123",
+            })
+            response.raise_for_status()
+            registered.append(response.json())
+        response = await http.post("/api/link-partner", json={"partner_code": registered[1]["user"]["partner_code"]},
+                                   headers={"Authorization": f"Bearer {registered[0]['token']}"})
+        response.raise_for_status()
+        headers = []
+        for name in ("a", "b"):  # tokens nuevos, con partner_id en los claims
+            response = await http.post("/api/login", json={
+                "email": f"rs-{name}-{suffix}@check.example.com", "password": "password123",
+            })
+            response.raise_for_status()
+            headers.append({"Authorization": f"Bearer {response.json()['token']}"})
+
+        failures = 0
+        for attempt in range(20):
+            response = await http.post("/api/activities", json={"description": f"Prueba {attempt}"},
+                                       headers=headers[0])
+            response.raise_for_status()
+            activity_id = response.json()["activity"]["id"]
+            response = await http.post(f"/api/activities/{activity_id}/rate", json={"rating": 5},
+                                       headers=headers[1])
+            response.raise_for_status()
+
+            # Inmediatamente después de calificar: debe verse aunque se lea de un secundario
+            targets.reads.clear()
+            response = await http.get("/api/memories/filter", headers=headers[1])
+            response.raise_for_status()
+            if response.json()["total_found"] != attempt + 1:
+                failures += 1
+        secondary_reads = sum(1 for _, address in targets.reads if address != primary)
+
+    print(f"lecturas de /api/memories/filter en secundarios: {secondary_reads}/{len(targets.reads)}")
+    print(f"lecturas sin la escritura propia: {failures}/20")
+    if failures or not secondary_reads:
+        sys.exit(1)
+
+
+async def wait_for(description, condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not await asyncio.to_thread(condition):
+        if time.monotonic() > deadline:
+            raise SystemExit(f"Tiempo agotado esperando: {description}")
+        await asyncio.sleep(0.1)
+
+
+async def check_feed():
+    os.environ["CHANGE_FEED_MODE"] = "stream"  # antes de importar server
+
+    import httpx
+    import server
+
+    db = server.db
+    db.command("ping")
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://check") as http:
+        suffix = uuid.uuid4().hex[:8]
+        registered = []
+        for name in ("a", "b"):
+            response = await http.post("/api/register", json={
+                "name": f"Feed {name}", "email": f"feed-{name}-{suffix}@check.example.com", "password": "password123",
+            })
+            response.raise_for_status()
+            registered.append(response.json())
+        users = [entry["user"] for entry in registered]
+        response = await http.post("/api/link-partner", json={"partner_code": users[1]["partner_code"]},
+                                   headers={"Authorization": f"Bearer {registered[0]['token']}"})
+        response.raise_for_status()
+        headers = []
+        for name in ("a", "b"):
+            response = await http.post("/api/login", json={
+                "email": f"feed-{name}-{suffix}@check.example.com", "password": "password123",
+            })
+            response.raise_for_status()
+            headers.append({"Authorization": f"Bearer {response.json()['token']}"})
+        response = await http.post("/api/notifications/subscribe", json={"endpoint": f"check-{suffix}", "keys": {}},
+                                   headers=headers[1])
+        response.raise_for_status()
+
+        def insert_activity(description):
+            # Como lo haría una importación: directo en la colección, sin pasar por la API
+            db.activities.insert_one({
+                "id": str(uuid.uuid4()), "user_id": users[0]["id"], "user_name": users[0]["name"],
+                "description": description, "category": "general", "time_of_day": None,
+                "date": time.strftime("%Y-%m-%d", time.gmtime()), "rating": None, "partner_comment": None,
+                "is_pending_rating": True, "created_at": datetime.now(timezone.utc), "rated_at": None,
+            })
+
+        def notifications():
+            return db.notifications.count_documents({"user_id": users[1]["id"]})
+
+        async def total_activities():
+            response = await http.get("/api/achievements", headers=headers[0])
+            response.raise_for_status()
+            return response.json()["stats"]["total_activities"]
+
+        state = {"_id": server.changes.name, "owner": server.changes.owner, "resume_token": {"$exists": True}}
+        server.changes.start(leader=True)
+        await wait_for("lease y primer checkpoint", lambda: db.change_feed_state.find_one(state))
+        before = await total_activities()  # queda en la caché de vistas
+
+        insert_activity("Importada 1")
+        await wait_for("notificación de la actividad importada", lambda: notifications() == 1)
+        # La caché se invalida al llegar el evento de user_stats que escribe el propio feed
+        deadline = time.monotonic() + 10
+        after = await total_activities()
+        while after != 1 and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+            after = await total_activities()
+
+        await server.changes.stop()
+        insert_activity("Importada 2")  # con el feed parado
+        server.changes.start(leader=True)
+        await wait_for("notificación escrita con el feed parado", lambda: notifications() == 2)
+        await server.changes.stop()
+
+    print(f"logros antes/después de la actividad importada: {before}/{after}")
+    print(f"notificaciones a la pareja: {notifications()}/2")
+    if (before, after) != (0, 1):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replica set local para probar lecturas en secundarios")
+    parser.add_argument("command", choices=["start", "stop", "check", "check-feed"])
+    parser.add_argument("--dir", default="/tmp/loveacts-rs", help="Datos y logs de los mongod")
+    parser.add_argument("--ports", type=int, nargs="+", default=[27017, 27018, 27019])
+    args = parser.parse_args()
+
+    if args.command == "start":
+        start(args.dir, args.ports)
+    elif args.command == "stop":
+        stop(args.ports)
+    elif args.command == "check":
+        asyncio.run(check())
+    else:
+        asyncio.run(check_feed())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Benchmark de arranque en frío de la API de LoveActs
+
+Lanza uvicorn con la app en un proceso nuevo y mide el tiempo hasta la primera
+respuesta 200 de /api/health (importaciones, lifespan y primer request), varias
+veces. Con --importtime muestra además los módulos que más tardan en importarse
+(python -X importtime).
+
+Uso (desde la raíz del repo):
+    python benchmarks/startup_bench.py --runs 10 --output startup.json
+    python benchmarks/startup_bench.py --compare startup.json --fail-threshold 20
+    python benchmarks/startup_bench.py --importtime --runs 0
+"""
+
+import argparse
+import http.client
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def health_ok(port):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+    try:
+        connection.request("GET", "/api/health")
+        return connection.getresponse().status == 200
+    except OSError:
+        return False
+    finally:
+        connection.close()
+
+
+def measure_once(timeout):
+    """Segundos desde lanzar el proceso hasta el primer /api/health correcto"""
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"El servidor terminó al arrancar (código {process.returncode})")
+            if health_ok(port):
+                return time.perf_counter() - start
+            time.sleep(0.005)
+        raise RuntimeError(f"Sin respuesta de /api/health en {timeout}s")
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def import_profile(top):
+    """Módulos con más tiempo acumulado de importación al importar server"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=BACKEND_DIR, capture_output=True, text=True,
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append({"module": name, "depth": (len(indent) - 1) // 2, "self_ms": int(self_us) / 1000,
+                            "cumulative_ms": int(cumulative_us) / 1000})
+    total = next((m["cumulative_ms"] for m in modules if m["module"] == "server"), None)
+    # Solo las importaciones directas de server: lo que se puede mover o diferir
+    direct = [m for m in modules if m["depth"] == 1]
+    direct.sort(key=lambda m: m["cumulative_ms"], reverse=True)
+    return {"server_import_ms": total, "top": direct[:top]}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=BACKEND_DIR).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Devuelve True si la mediana empeoró más de threshold %"""
+    current, previous = results["summary"]["median_ms"], baseline["summary"]["median_ms"]
+    change = (current - previous) / previous * 100
+    print(f"mediana: {previous:.1f} ms -> {current:.1f} ms ({change:+.1f}%)", file=sys.stderr)
+    return change > threshold
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiempo hasta la primera respuesta de /api/health")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--importtime", action="store_true", help="Incluir el perfil de -X importtime")
+    parser.add_argument("--top", type=int, default=15, help="Módulos a mostrar con --importtime")
+    parser.add_argument("--output", help="Guardar resultados en JSON")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior")
+    parser.add_argument("--fail-threshold", type=float, default=20, help="% de empeoramiento que hace fallar")
+    args = parser.parse_args()
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "storage": os.environ.get("STORAGE_BACKEND", "mongo"),
+    }
+
+    if args.runs:
+        samples = [measure_once(args.timeout) * 1000 for _ in range(args.runs)]
+        samples.sort()
+        results["summary"] = {
+            "runs": len(samples),
+            "min_ms": round(samples[0], 1),
+            "median_ms": round(statistics.median(samples), 1),
+            "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1),
+            "max_ms": round(samples[-1], 1),
+        }
+    if args.importtime:
+        results["imports"] = import_profile(args.top)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare and "summary" in results:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.fail_threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
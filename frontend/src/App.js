@@ -1,4 +1,4 @@
-import React, { useState, useEffect, createContext, useContext } from 'react';
+import React, { useState, useEffect, useRef, createContext, useContext } from 'react';
 import './App.css';
 
 const API_URL = process.env.REACT_APP_BACKEND_URL;
@@ -171,6 +171,16 @@ const UpdateAvailableNotification = () => {
   );
 };
 
+// Fecha de expiración (ms) del token de acceso, leída del payload del JWT
+const getTokenExpiry = (token) => {
+  try {
+    const payload = JSON.parse(atob(token.split('.')[1].replace(/-/g, '+').replace(/_/g, '/')));
+    return payload.exp ? payload.exp * 1000 : null;
+  } catch (error) {
+    return null;
+  }
+};
+
 const AuthProvider = ({ children }) => {
   const [user, setUser] = useState(null);
   const [token, setToken] = useState(localStorage.getItem('token'));
@@ -184,6 +194,86 @@ const AuthProvider = ({ children }) => {
     }
   }, [token]);
 
+  // Renovar el token de acceso un minuto antes de que expire
+  useEffect(() => {
+    if (!token) return;
+    const expiry = getTokenExpiry(token);
+    if (!expiry) return;
+    const timer = setTimeout(refreshSession, Math.max(expiry - Date.now() - 60000, 0));
+    return () => clearTimeout(timer);
+  }, [token]);
+
+  const saveTokens = (data) => {
+    localStorage.setItem('token', data.token);
+    if (data.refresh_token) {
+      localStorage.setItem('refresh_token', data.refresh_token);
+    }
+    setToken(data.token);
+  };
+
+  const clearTokens = () => {
+    localStorage.removeItem('token');
+    localStorage.removeItem('refresh_token');
+    setToken(null);
+  };
+
+  const refreshSession = async () => {
+    const refreshToken = localStorage.getItem('refresh_token');
+    if (!refreshToken) return null;
+
+    try {
+      const response = await fetch(`${API_URL}/api/token/refresh`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ refresh_token: refreshToken }),
+      });
+
+      if (!response.ok) return null;
+      const data = await response.json();
+      saveTokens(data);
+      return data.token;
+    } catch (error) {
+      return null;
+    }
+  };
+
+  // Varias peticiones con 401 a la vez comparten una sola renovación
+  const refreshing = useRef(null);
+
+  const refreshOnce = () => {
+    if (!refreshing.current) {
+      refreshing.current = refreshSession().finally(() => {
+        refreshing.current = null;
+      });
+    }
+    return refreshing.current;
+  };
+
+  // fetch a la API con el token actual; ante un 401 (token expirado o desactualizado
+  // tras vincular o desvincular la pareja) renueva la sesión y reintenta una vez
+  const authFetch = async (path, options = {}) => {
+    const send = (accessToken) => fetch(`${API_URL}${path}`, {
+      ...options,
+      headers: {
+        ...options.headers,
+        'Authorization': `Bearer ${accessToken}`
+      }
+    });
+
+    const response = await send(localStorage.getItem('token'));
+    if (response.status !== 401) return response;
+
+    const newToken = await refreshOnce();
+    if (!newToken) {
+      clearTokens();
+      setUser(null);
+      return response;
+    }
+    return send(newToken);
+  };
+
   const fetchUserInfo = async () => {
     try {
       const response = await fetch(`${API_URL}/api/me`, {
@@ -195,14 +285,13 @@ const AuthProvider = ({ children }) => {
       if (response.ok) {
         const data = await response.json();
         setUser(data.user);
-      } else {
-        localStorage.removeItem('token');
-        setToken(null);
+      } else if (!(await refreshSession())) {
+        // Token expirado o desactualizado y sin sesión que renovar
+        clearTokens();
       }
     } catch (error) {
       console.error('Error fetching user info:', error);
-      localStorage.removeItem('token');
-      setToken(null);
+      clearTokens();
     } finally {
       setLoading(false);
     }
@@ -221,8 +310,7 @@ const AuthProvider = ({ children }) => {
       const data = await response.json();
 
       if (response.ok) {
-        localStorage.setItem('token', data.token);
-        setToken(data.token);
+        saveTokens(data);
         setUser(data.user);
         return { success: true };
       } else {
@@ -246,8 +334,7 @@ const AuthProvider = ({ children }) => {
       const data = await response.json();
 
       if (response.ok) {
-        localStorage.setItem('token', data.token);
-        setToken(data.token);
+        saveTokens(data);
         setUser(data.user);
         return { success: true };
       } else {
@@ -259,8 +346,17 @@ const AuthProvider = ({ children }) => {
   };
 
   const logout = () => {
-    localStorage.removeItem('token');
-    setToken(null);
+    const refreshToken = localStorage.getItem('refresh_token');
+    if (refreshToken) {
+      fetch(`${API_URL}/api/logout`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ refresh_token: refreshToken }),
+      }).catch(() => {});
+    }
+    clearTokens();
     setUser(null);
   };
 
@@ -272,7 +368,9 @@ const AuthProvider = ({ children }) => {
       register,
       logout,
       loading,
-      fetchUserInfo
+      fetchUserInfo,
+      saveTokens,
+      authFetch
     }}>
       {children}
     </AuthContext.Provider>
@@ -413,7 +511,7 @@ const AuthForm = () => {
 
 // Componente principal expandido
 const Dashboard = () => {
-  const { user, logout, fetchUserInfo, token } = useAuth();
+  const { user, logout, fetchUserInfo, saveTokens, authFetch } = useAuth();
   const { isInstalled } = usePWA();
   const [currentView, setCurrentView] = useState('home');
   const [activities, setActivities] = useState([]);
@@ -485,11 +583,7 @@ const Dashboard = () => {
 
   const fetchDailyData = async () => {
     try {
-      const response = await fetch(`${API_URL}/api/activities/daily/${selectedDate}`, {
-        headers: {
-          'Authorization': `Bearer ${token}`
-        }
-      });
+      const response = await authFetch(`/api/activities/daily/${selectedDate}`);
 
       if (response.ok) {
         const data = await response.json();
@@ -506,11 +600,7 @@ const Dashboard = () => {
 
   const fetchPendingRatings = async () => {
     try {
-      const response = await fetch(`${API_URL}/api/activities/pending-ratings`, {
-        headers: {
-          'Authorization': `Bearer ${token}`
-        }
-      });
+      const response = await authFetch(`/api/activities/pending-ratings`);
 
       if (response.ok) {
         const data = await response.json();
@@ -523,11 +613,7 @@ const Dashboard = () => {
 
   const fetchMemories = async () => {
     try {
-      const response = await fetch(`${API_URL}/api/memories/special`, {
-        headers: {
-          'Authorization': `Bearer ${token}`
-        }
-      });
+      const response = await authFetch(`/api/memories/special`);
 
       if (response.ok) {
         const data = await response.json();
@@ -540,11 +626,7 @@ const Dashboard = () => {
 
   const fetchAchievements = async () => {
     try {
-      const response = await fetch(`${API_URL}/api/achievements`, {
-        headers: {
-          'Authorization': `Bearer ${token}`
-        }
-      });
+      const response = await authFetch(`/api/achievements`);
 
       if (response.ok) {
         const data = await response.json();
@@ -557,11 +639,7 @@ const Dashboard = () => {
 
   const fetchTotalStats = async () => {
     try {
-      const response = await fetch(`${API_URL}/api/stats/total`, {
-        headers: {
-          'Authorization': `Bearer ${token}`
-        }
-      });
+      const response = await authFetch(`/api/stats/total`);
 
       if (response.ok) {
         const data = await response.json();
@@ -578,11 +656,10 @@ const Dashboard = () => {
     setError('');
 
     try {
-      const response = await fetch(`${API_URL}/api/activities`, {
+      const response = await authFetch(`/api/activities`, {
         method: 'POST',
         headers: {
-          'Content-Type': 'application/json',
-          'Authorization': `Bearer ${token}`
+          'Content-Type': 'application/json'
         },
         body: JSON.stringify(newActivity),
       });
@@ -613,11 +690,10 @@ const Dashboard = () => {
     setError('');
 
     try {
-      const response = await fetch(`${API_URL}/api/mood`, {
+      const response = await authFetch(`/api/mood`, {
         method: 'POST',
         headers: {
-          'Content-Type': 'application/json',
-          'Authorization': `Bearer ${token}`
+          'Content-Type': 'application/json'
         },
         body: JSON.stringify(newMood),
       });
@@ -645,11 +721,10 @@ const Dashboard = () => {
     setError('');
 
     try {
-      const response = await fetch(`${API_URL}/api/activities/${selectedActivity.id}/rate`, {
+      const response = await authFetch(`/api/activities/${selectedActivity.id}/rate`, {
         method: 'POST',
         headers: {
-          'Content-Type': 'application/json',
-          'Authorization': `Bearer ${token}`
+          'Content-Type': 'application/json'
         },
         body: JSON.stringify(activityRating),
       });
@@ -679,11 +754,10 @@ const Dashboard = () => {
     setError('');
 
     try {
-      const response = await fetch(`${API_URL}/api/link-partner`, {
+      const response = await authFetch(`/api/link-partner`, {
         method: 'POST',
         headers: {
-          'Content-Type': 'application/json',
-          'Authorization': `Bearer ${token}`
+          'Content-Type': 'application/json'
         },
         body: JSON.stringify({ partner_code: partnerCode }),
       });
@@ -694,7 +768,8 @@ const Dashboard = () => {
         setSuccess(data.message);
         setShowPartnerModal(false);
         setPartnerCode('');
-        fetchUserInfo();
+        saveTokens(data); // La vinculación invalida el token anterior; recarga el usuario
+
         fetchTotalStats(); // Actualizar estadísticas después de vincular
         setTimeout(() => setSuccess(''), 3000);
       } else {
@@ -721,11 +796,10 @@ const Dashboard = () => {
         updateData.photo = editPartnerData.photo;
       }
 
-      const response = await fetch(`${API_URL}/api/partner-info`, {
+      const response = await authFetch(`/api/partner-info`, {
         method: 'PUT',
         headers: {
-          'Content-Type': 'application/json',
-          'Authorization': `Bearer ${token}`
+          'Content-Type': 'application/json'
         },
         body: JSON.stringify(updateData),
       });
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+
+# Antes de importar server: los tests no necesitan Mongo y todas las peticiones llegan desde la misma IP
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ["ADMISSION_ENABLED"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+import storage
+
+
+@pytest.fixture
+def memory_db():
+    """Base de datos vacía del motor en memoria"""
+    return storage.MemoryClient()["loveacts_test"]
+
+
+@pytest.fixture
+def app_db():
+    """server.db sobre un motor en memoria nuevo (vacío) en cada test"""
+    server.db.close()
+    server.db.open()
+    yield server.db
+    server.db.close()
+
+
+@pytest.fixture
+def client(app_db):
+    with TestClient(server.app) as client:
+        yield client
+
+
+def auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def couple(client):
+    """Pareja vinculada: (cabeceras, id) de quien escribe y de su pareja, suscrita a notificaciones"""
+    author = client.post("/api/register", json={"name": "Ana", "email": "ana@example.com", "password": "secreto"}).json()
+    partner = client.post("/api/register", json={"name": "Bea", "email": "bea@example.com", "password": "secreto"}).json()
+    linked = client.post("/api/link-partner", json={"partner_code": author["user"]["partner_code"]},
+                         headers=auth(partner["token"]))
+    assert linked.status_code == 200
+    # El token de quien no hizo la vinculación se queda desactualizado
+    author_token = client.post("/api/login", json={"email": "ana@example.com", "password": "secreto"}).json()["token"]
+    partner_headers = auth(linked.json()["token"])
+    client.post("/api/notifications/subscribe", json={"endpoint": "https://push.example.com/1", "keys": {}},
+                headers=partner_headers)
+    return (auth(author_token), author["user"]["id"]), (partner_headers, partner["user"]["id"])
+
+
+def wait_notifications(timeout=2):
+    """Espera a los handlers exclusivos del change feed (user_stats, notificaciones), que no retrasan la respuesta"""
+    deadline = time.monotonic() + timeout
+    while (server.changes.pending or server.pending_notifications) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not server.changes.pending and not server.pending_notifications
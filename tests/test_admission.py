@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import admission
+import metrics
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(admission, "time", clock)
+    return clock
+
+
+def take(buckets, key, rate, burst):
+    return asyncio.run(buckets.take(key, rate, burst))
+
+
+def test_bucket_allows_burst_then_waits(clock):
+    buckets = admission.MemoryBuckets()
+    assert [take(buckets, "k", 2, 3) for _ in range(3)] == [0, 0, 0]
+    assert take(buckets, "k", 2, 3) == pytest.approx(0.5)
+
+
+def test_bucket_refills_at_rate(clock):
+    buckets = admission.MemoryBuckets()
+    for _ in range(3):
+        take(buckets, "k", 2, 3)
+    clock.now += 0.5
+    assert take(buckets, "k", 2, 3) == 0
+    assert take(buckets, "k", 2, 3) > 0
+    # Nunca pasa de la ráfaga
+    clock.now += 60
+    assert [take(buckets, "k", 2, 3) for _ in range(4)][-1] > 0
+
+
+def test_buckets_are_per_key(clock):
+    buckets = admission.MemoryBuckets()
+    take(buckets, "a", 1, 1)
+    assert take(buckets, "a", 1, 1) > 0
+    assert take(buckets, "b", 1, 1) == 0
+
+
+def test_least_recently_used_keys_are_dropped(clock):
+    buckets = admission.MemoryBuckets(max_keys=2)
+    take(buckets, "a", 1, 1)
+    take(buckets, "b", 1, 1)
+    take(buckets, "a", 1, 1)
+    take(buckets, "c", 1, 1)
+    assert take(buckets, "a", 1, 1) > 0
+    assert take(buckets, "b", 1, 1) == 0  # descartado: vuelve con la ráfaga completa
+
+
+@pytest.fixture
+def client(monkeypatch, clock):
+    monkeypatch.setattr(admission, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(admission, "RATE_LIMITS", {"ip": (1, 3), "user": (1, 2), "auth": (1, 1), "analytics": (1, 1)})
+    monkeypatch.setattr(metrics, "event_loop_lag", 0.0)
+
+    app = FastAPI()
+
+    @app.get("/stats")
+    async def stats():
+        return {}
+
+    @app.get("/daily")
+    async def daily():
+        return {}
+
+    @app.post("/mood")
+    async def mood():
+        return {}
+
+    @app.post("/login")
+    async def login():
+        return {}
+
+    app.add_middleware(
+        admission.AdmissionMiddleware,
+        identify=lambda scope: dict(scope["headers"]).get(b"x-user", b"").decode() or None,
+        priorities={"POST /mood": admission.CRITICAL, "GET /stats": admission.LOW},
+        auth_routes=["POST /login"],
+        analytics_routes=["GET /stats"],
+        buckets=admission.MemoryBuckets(),
+    )
+    return TestClient(app)
+
+
+def overload(monkeypatch, level):
+    monkeypatch.setattr(metrics, "event_loop_lag", level * admission.ADMISSION_TARGET_LAG_MS / 1000)
+
+
+def test_rate_limit_returns_429_with_retry_after(client):
+    assert client.post("/login").status_code == 200
+    response = client.post("/login")
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "1"
+
+
+def test_user_bucket_applies_to_authenticated_requests(client):
+    headers = {"x-user": "u1"}
+    assert [client.get("/daily", headers=headers).status_code for _ in range(3)] == [200, 200, 429]
+
+
+def test_ip_bucket_applies_to_everyone(client):
+    statuses = [client.get("/daily", headers={"x-user": f"u{index}"}).status_code for index in range(4)]
+    assert statuses == [200, 200, 200, 429]
+
+
+def test_sheds_by_priority(client, monkeypatch):
+    overload(monkeypatch, 0.7)
+    assert client.get("/stats").status_code == 503
+    assert client.get("/daily").status_code == 200
+    overload(monkeypatch, 0.95)
+    assert client.get("/daily").status_code == 503
+    assert client.post("/mood").status_code == 200
+
+
+def test_shedding_happens_before_rate_limits(client, monkeypatch):
+    overload(monkeypatch, 1.0)
+    for _ in range(5):
+        response = client.get("/stats")
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+    # Lo descartado no gastó tokens
+    overload(monkeypatch, 0.0)
+    assert client.get("/stats").status_code == 200
+    assert client.get("/stats").status_code == 429
+
+
+def test_critical_routes_are_only_rate_limited(client, monkeypatch):
+    overload(monkeypatch, 10.0)
+    assert [client.post("/mood").status_code for _ in range(4)] == [200, 200, 200, 429]
+
+
+def test_in_flight_requests_raise_the_load(client, monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_MAX_IN_FLIGHT", 10)
+    assert client.get("/daily").status_code == 200  # construye la pila de middlewares
+    middleware = client.app.middleware_stack
+    while not isinstance(middleware, admission.AdmissionMiddleware):
+        middleware = middleware.app
+    middleware.in_flight = 7
+    assert client.get("/stats").status_code == 503
+    assert client.get("/daily").status_code == 200
@@ -0,0 +1,56 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pyarrow.parquet as pq
+
+import analytics_export
+
+
+def add_activity(db, index, created_at):
+    db.activities.insert_one({
+        "id": f"a{index}", "user_id": "u1", "category": "emotional", "time_of_day": "morning",
+        "rating": None, "is_pending_rating": True, "date": created_at.date().isoformat(),
+        "created_at": created_at, "rated_at": None,
+    })
+
+
+def rate(db, index):
+    time.sleep(0.002)  # las fechas se guardan con milisegundos
+    db.activities.update_one({"id": f"a{index}"}, {"$set": {
+        "rating": 4, "is_pending_rating": False, "rated_at": datetime.now(timezone.utc),
+    }})
+
+
+def exported(output_dir):
+    rows = pq.read_table(output_dir / "activities").to_pylist()
+    return sorted((row["id"], row["rating"]) for row in rows)
+
+
+def test_reexported_rows_replace_previous_ones(memory_db, tmp_path):
+    created_at = datetime.now(timezone.utc).replace(day=1, hour=0) - timedelta(seconds=1)
+    for index in range(5):
+        add_activity(memory_db, index, created_at)
+    analytics_export.run_export(memory_db, tmp_path, ["activities"], batch_size=2)
+
+    for index in (1, 3, 4):
+        rate(memory_db, index)
+    summary = analytics_export.run_export(memory_db, tmp_path, ["activities"], batch_size=2)
+    assert summary["collections"]["activities"]["rows"] == 3
+    assert exported(tmp_path) == [("a0", None), ("a1", 4), ("a2", None), ("a3", 4), ("a4", 4)]
+
+    # Una parte cuyas filas se reexportaron todas desaparece
+    for index in (1, 3, 4):
+        rate(memory_db, index)
+    analytics_export.run_export(memory_db, tmp_path, ["activities"], batch_size=2)
+    assert exported(tmp_path) == [("a0", None), ("a1", 4), ("a2", None), ("a3", 4), ("a4", 4)]
+    partition = next((tmp_path / "activities").iterdir())
+    assert len([name for name in partition.iterdir() if not name.name.startswith(".")]) == 2
+
+
+def test_incremental_run_without_changes_writes_nothing(memory_db, tmp_path):
+    add_activity(memory_db, 0, datetime.now(timezone.utc) - timedelta(seconds=1))
+    analytics_export.run_export(memory_db, tmp_path, ["activities"])
+    summary = analytics_export.run_export(memory_db, tmp_path, ["activities"])
+    assert summary["collections"]["activities"]["rows"] == 0
+    assert summary["collections"]["activities"]["files"] == []
+    assert exported(tmp_path) == [("a0", None)]
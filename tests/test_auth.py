@@ -0,0 +1,81 @@
+from datetime import date
+
+import server
+from tests.conftest import auth
+
+TODAY = date.today().isoformat()
+
+
+def daily(client, headers):
+    return client.get(f"/api/activities/daily/{TODAY}", headers=headers)
+
+
+def count_user_lookups(monkeypatch, app_db):
+    """Cuenta las lecturas de users por id"""
+    lookups = []
+    find_one = app_db.users.find_one
+
+    def counting(filter=None, *args, **kwargs):
+        lookups.append(filter)
+        return find_one(filter, *args, **kwargs)
+
+    monkeypatch.setattr(app_db.users, "find_one", counting)
+    return lookups
+
+
+def test_claims_read_token_version_once(client, couple, app_db, monkeypatch):
+    (author, author_id), _ = couple
+    server.forget_token_version(author_id)
+    lookups = count_user_lookups(monkeypatch, app_db)
+    for _ in range(5):
+        assert daily(client, author).status_code == 200
+    assert lookups.count({"id": author_id}) == 1
+
+
+def test_token_version_is_read_again_after_ttl(client, couple, app_db, monkeypatch):
+    (author, author_id), _ = couple
+    monkeypatch.setattr(server, "TOKEN_VERSION_CACHE_SECONDS", 0)
+    lookups = count_user_lookups(monkeypatch, app_db)
+    for _ in range(3):
+        assert daily(client, author).status_code == 200
+    assert lookups.count({"id": author_id}) == 3
+
+
+def test_unlink_rejects_old_tokens_of_both_members(client, couple):
+    (author, _), (partner, _) = couple
+    assert daily(client, author).status_code == 200
+    assert daily(client, partner).status_code == 200
+
+    response = client.delete("/api/unlink-partner", headers=author)
+    assert response.status_code == 200
+    assert daily(client, author).status_code == 401
+    assert daily(client, partner).status_code == 401
+    assert daily(client, auth(response.json()["token"])).status_code == 200
+
+
+def test_refresh_rotates_tokens(client):
+    tokens = client.post("/api/register", json={"name": "Ana", "email": "ana@example.com", "password": "secreto"}).json()
+    response = client.post("/api/token/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert response.status_code == 200
+    rotated = response.json()
+    assert rotated["refresh_token"] != tokens["refresh_token"]
+    assert client.get("/api/me", headers=auth(rotated["token"])).status_code == 200
+
+    # Reutilizar el refresh token ya canjeado se rechaza
+    response = client.post("/api/token/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Token revocado"
+    assert client.post("/api/token/refresh", json={"refresh_token": rotated["refresh_token"]}).status_code == 200
+
+
+def test_logout_revokes_refresh_token(client):
+    tokens = client.post("/api/register", json={"name": "Ana", "email": "ana@example.com", "password": "secreto"}).json()
+    assert client.post("/api/logout", json={"refresh_token": tokens["refresh_token"]}).status_code == 200
+    assert client.post("/api/token/refresh", json={"refresh_token": tokens["refresh_token"]}).status_code == 401
+
+
+def test_token_types_are_not_interchangeable(client):
+    tokens = client.post("/api/register", json={"name": "Ana", "email": "ana@example.com", "password": "secreto"}).json()
+    assert client.post("/api/token/refresh", json={"refresh_token": tokens["token"]}).status_code == 401
+    assert client.get("/api/me", headers=auth(tokens["refresh_token"])).status_code == 401
+    assert daily(client, auth(tokens["refresh_token"])).status_code == 401
@@ -0,0 +1,226 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import change_feed
+import server
+from change_feed import ChangeFeed
+from tests.conftest import wait_notifications
+
+
+def change(collection, operation, document=None, updated_fields=None):
+    event = {"operationType": operation, "ns": {"coll": collection}, "documentKey": {"_id": 1},
+             "fullDocument": document}
+    if updated_fields is not None:
+        event["updateDescription"] = {"updatedFields": updated_fields, "removedFields": []}
+    return event
+
+
+@pytest.fixture
+def feed(memory_db):
+    return ChangeFeed(memory_db, ["activities", "moods"], name="test")
+
+
+def test_dispatch_routes_by_collection_and_operation(feed):
+    seen = []
+
+    @feed.on("activities", "insert")
+    async def on_activity_insert(event):
+        seen.append(("activities", event["operationType"]))
+
+    @feed.on("moods", "insert", "update")
+    async def on_mood(event):
+        seen.append(("moods", event["operationType"]))
+
+    async def scenario():
+        await feed.dispatch(change("activities", "insert"), exclusive=True)
+        await feed.dispatch(change("activities", "update"), exclusive=True)
+        await feed.dispatch(change("moods", "update"), exclusive=True)
+        await feed.dispatch(change("users", "insert"), exclusive=True)
+
+    asyncio.run(scenario())
+    assert seen == [("activities", "insert"), ("moods", "update")]
+
+
+def test_exclusive_handlers_only_run_on_the_leader(feed):
+    seen = []
+
+    @feed.on("moods", "insert")
+    async def local(event):
+        seen.append("local")
+
+    @feed.on("moods", "insert", exclusive=True)
+    async def exclusive(event):
+        seen.append("exclusive")
+
+    asyncio.run(feed.dispatch(change("moods", "insert"), exclusive=False))
+    assert seen == ["local"]
+    asyncio.run(feed.dispatch(change("moods", "insert"), exclusive=True))
+    assert seen == ["local", "local", "exclusive"]
+
+
+def test_broken_handler_does_not_stop_the_others(feed):
+    seen = []
+
+    @feed.on("moods", "insert")
+    async def broken(event):
+        raise RuntimeError("fallo")
+
+    @feed.on("moods", "insert")
+    async def working(event):
+        seen.append(event["fullDocument"])
+
+    asyncio.run(feed.dispatch(change("moods", "insert", {"id": "m1"}), exclusive=True))
+    assert seen == [{"id": "m1"}]
+
+
+def test_written_publishes_inline_writes(feed, monkeypatch):
+    monkeypatch.setattr(change_feed, "CHANGE_FEED_MODE", "inline")
+    seen = []
+
+    @feed.on("moods", "update", exclusive=True)
+    async def on_update(event):
+        seen.append(event)
+
+    async def scenario():
+        await feed.written("moods", "update", {"_id": 7, "user_id": "u1"}, {"mood_id": "happy"},
+                           context={"author": {"id": "u1"}})
+        await feed.drain()
+
+    asyncio.run(scenario())
+    assert seen[0]["documentKey"] == {"_id": 7}
+    assert seen[0]["updateDescription"]["updatedFields"] == {"mood_id": "happy"}
+    assert seen[0]["context"] == {"author": {"id": "u1"}}
+
+    # Con change streams la escritura llega por el stream, no desde el endpoint
+    monkeypatch.setattr(change_feed, "CHANGE_FEED_MODE", "stream")
+    asyncio.run(feed.written("moods", "update", {"_id": 7, "user_id": "u1"}, {"mood_id": "sad"}))
+    assert len(seen) == 1
+
+
+def test_written_does_not_wait_for_exclusive_handlers(feed, monkeypatch):
+    monkeypatch.setattr(change_feed, "CHANGE_FEED_MODE", "inline")
+    seen = []
+
+    @feed.on("moods", "insert")
+    async def local(event):
+        seen.append("local")
+
+    @feed.on("moods", "insert", exclusive=True)
+    async def slow_exclusive(event):
+        await asyncio.sleep(0.05)
+        seen.append("exclusive")
+
+    async def scenario():
+        await feed.written("moods", "insert", {"_id": 1, "user_id": "u1"})
+        assert seen == ["local"]  # la petición responde ya con las cachés invalidadas
+        assert len(feed.pending) == 1
+        await feed.stop(timeout=1)
+        assert seen == ["local", "exclusive"]
+        assert not feed.pending
+
+    asyncio.run(scenario())
+
+
+def test_lease_is_held_by_one_process(memory_db):
+    leader = ChangeFeed(memory_db, ["moods"], name="test")
+    follower = ChangeFeed(memory_db, ["moods"], name="test")
+    assert leader._acquire_lease() is not None
+    assert follower._acquire_lease() is None
+    assert leader._acquire_lease() is not None  # renovación
+
+    assert leader._save_position({"_data": "1"})
+    assert not follower._save_position({"_data": "2"})
+
+    leader._release_lease()
+    time.sleep(0.002)  # expires_at se guarda con milisegundos
+    state = follower._acquire_lease()
+    assert state["owner"] == follower.owner
+    assert state["resume_token"] == {"_data": "1"}
+    assert not leader._save_position({"_data": "3"})
+
+
+def test_expired_lease_can_be_taken_over(memory_db):
+    leader = ChangeFeed(memory_db, ["moods"], name="test")
+    follower = ChangeFeed(memory_db, ["moods"], name="test")
+    leader._acquire_lease()
+    memory_db.change_feed_state.update_one(
+        {"_id": "test"}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    )
+    assert follower._acquire_lease() is not None
+
+
+def test_history_lost_resets_position(memory_db):
+    lost = []
+    feed = ChangeFeed(memory_db, ["moods"], name="test", on_history_lost=lambda: lost.append(True))
+    feed._acquire_lease()
+    feed._save_position({"_data": "1"})
+    feed._reset_position()
+    assert "resume_token" not in memory_db.change_feed_state.find_one({"_id": "test"})
+    assert lost == [True]
+
+
+# Handlers de la app (modo inline)
+
+def partner_notifications(partner_id, tag):
+    wait_notifications()
+    return server.db.notifications.count_documents({"user_id": partner_id, "tag": tag})
+
+
+def test_resending_the_same_mood_does_not_notify(client, couple):
+    (author, _), (_, partner_id) = couple
+    mood = {"mood_id": "happy", "mood_emoji": "😊"}
+    assert client.post("/api/mood", json=mood, headers=author).status_code == 200
+    assert client.post("/api/mood", json=mood, headers=author).status_code == 200
+    assert partner_notifications(partner_id, "mood_update") == 1
+
+
+def test_changing_the_mood_notifies(client, couple):
+    (author, _), (_, partner_id) = couple
+    client.post("/api/mood", json={"mood_id": "happy", "mood_emoji": "😊"}, headers=author)
+    client.post("/api/mood", json={"mood_id": "happy", "mood_emoji": "😊", "note": "día largo"}, headers=author)
+    client.post("/api/mood", json={"mood_id": "sad", "mood_emoji": "😢", "note": "día largo"}, headers=author)
+    assert partner_notifications(partner_id, "mood_update") == 3
+
+
+def test_handlers_take_the_author_from_the_request(app_db, monkeypatch):
+    app_db.users.insert_one({"id": "u1", "name": "Ana", "partner_id": "u2"})
+    author = {"id": "u1", "name": "Ana", "partner_id": "u2"}
+    event = change("moods", "insert", {"user_id": "u1"})
+
+    def no_lookup(*args, **kwargs):
+        raise AssertionError("lectura del autor en modo inline")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(app_db.users, "find_one", no_lookup)
+        assert asyncio.run(server.change_author({**event, "context": {"author": author}}, "u1")) is author
+    # Desde el change stream no hay contexto: se lee en un hilo
+    assert asyncio.run(server.change_author(event, "u1")) == {"name": "Ana", "partner_id": "u2"}
+
+
+def test_new_activity_notifies_partner(client, couple):
+    (author, _), (_, partner_id) = couple
+    response = client.post("/api/activities", json={"description": "Desayuno sorpresa", "category": "practical"},
+                           headers=author)
+    assert response.status_code == 200
+    assert partner_notifications(partner_id, "new_activity") == 1
+
+
+def test_writes_only_invalidate_user_stats(client, couple):
+    (author, author_id), _ = couple
+    client.post("/api/activities", json={"description": "Paseo", "category": "physical"}, headers=author)
+    wait_notifications()
+    stats = server.db.user_stats.find_one({"_id": author_id})
+    assert stats.get("stats_generation") != stats["generation"]
+
+    summary = server.load_user_stats(author_id)
+    assert summary["activities"] == 1
+    assert summary["categories"]["physical"] == 1
+    stored = server.db.user_stats.find_one({"_id": author_id})
+    assert stored["stats_generation"] == stored["generation"]
+
+    client.post("/api/mood", json={"mood_id": "happy", "mood_emoji": "😊"}, headers=author)
+    wait_notifications()
+    assert server.load_user_stats(author_id)["moods"] == 1
@@ -0,0 +1,209 @@
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, Probe
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker(window_seconds=30, min_calls=4, failure_rate=0.5, slow_call_ms=100,
+                          slow_call_rate=0.75, open_seconds=10, probes=2)
+
+
+def run_probe(breaker, failed=False, sends_commands=True):
+    """Lo que hace el middleware con una petición de prueba"""
+    probe = breaker.allow()
+    assert isinstance(probe, Probe)
+    token = circuit_breaker.current_probe.set(probe)
+    try:
+        if sends_commands:
+            breaker.record(failed, 5)
+    finally:
+        circuit_breaker.current_probe.reset(token)
+        breaker.finish_probe(probe)
+    return probe
+
+
+def open_breaker(breaker):
+    for _ in range(4):
+        breaker.record(True, 5)
+    assert breaker.state == OPEN
+
+
+def test_stays_closed_below_min_calls(breaker):
+    for _ in range(3):
+        breaker.record(True, 5)
+    assert breaker.state == CLOSED
+    assert breaker.allow() is True
+
+
+def test_opens_on_failure_rate(breaker):
+    breaker.record(False, 5)
+    breaker.record(False, 5)
+    breaker.record(True, 5)
+    assert breaker.state == CLOSED
+    breaker.record(True, 5)
+    assert breaker.state == OPEN
+    assert breaker.allow() is False
+
+
+def test_opens_on_slow_call_rate(breaker):
+    for _ in range(3):
+        breaker.record(False, 500)
+    breaker.record(False, 5)
+    assert breaker.state == OPEN
+
+
+def test_old_calls_leave_the_window(breaker, clock):
+    for _ in range(3):
+        breaker.record(True, 5)
+    clock.now += 31
+    breaker.record(True, 5)
+    assert breaker.state == CLOSED
+
+
+def test_retry_after_counts_down(breaker, clock):
+    open_breaker(breaker)
+    assert breaker.retry_after() == 10
+    clock.now += 7.5
+    assert breaker.retry_after() == 3
+
+
+def test_half_open_after_open_seconds(breaker, clock):
+    open_breaker(breaker)
+    clock.now += 9
+    assert breaker.allow() is False
+    clock.now += 1
+    assert isinstance(breaker.allow(), Probe)
+    assert breaker.state == HALF_OPEN
+
+
+def test_half_open_limits_probes(breaker, clock):
+    open_breaker(breaker)
+    clock.now += 10
+    assert isinstance(breaker.allow(), Probe)
+    assert isinstance(breaker.allow(), Probe)
+    assert breaker.allow() is False
+
+
+def test_closes_when_every_probe_succeeds(breaker, clock):
+    open_breaker(breaker)
+    clock.now += 10
+    run_probe(breaker)
+    assert breaker.state == HALF_OPEN
+    run_probe(breaker)
+    assert breaker.state == CLOSED
+    assert breaker.allow() is True
+
+
+def test_failed_probe_reopens(breaker, clock):
+    open_breaker(breaker)
+    clock.now += 10
+    run_probe(breaker)
+    run_probe(breaker, failed=True)
+    assert breaker.state == OPEN
+    assert breaker.allow() is False
+
+
+def test_probe_without_commands_frees_its_slot(breaker, clock):
+    open_breaker(breaker)
+    clock.now += 10
+    run_probe(breaker, sends_commands=False)
+    run_probe(breaker, sends_commands=False)
+    assert breaker.state == HALF_OPEN
+    run_probe(breaker)
+    run_probe(breaker)
+    assert breaker.state == CLOSED
+
+
+def test_stuck_probes_time_out(breaker, clock):
+    open_breaker(breaker)
+    clock.now += 10
+    stuck = [breaker.allow(), breaker.allow()]
+    assert breaker.allow() is False
+    clock.now += 10
+    assert breaker.allow() is False
+    assert breaker.state == OPEN
+    clock.now += 10
+    assert isinstance(breaker.allow(), Probe)
+    # Las pruebas del semiabierto anterior ya no cuentan
+    for probe in stuck:
+        probe.succeeded = True
+        breaker.finish_probe(probe)
+    assert breaker.state == HALF_OPEN
+
+
+def test_calls_in_flight_while_open_are_ignored(breaker, clock):
+    open_breaker(breaker)
+    breaker.record(False, 5)
+    clock.now += 10
+    run_probe(breaker)
+    run_probe(breaker)
+    assert breaker.state == CLOSED
+    # La ventana empieza de cero al cerrarse
+    for _ in range(3):
+        breaker.record(True, 5)
+    assert breaker.state == CLOSED
+
+
+def test_trip_opens_immediately(breaker):
+    breaker.trip("heartbeat")
+    assert breaker.state == OPEN
+
+
+def test_unavailable_failures():
+    assert circuit_breaker.is_unavailable({"errtype": "AutoReconnect"})
+    assert circuit_breaker.is_unavailable({"code": 91})
+    assert not circuit_breaker.is_unavailable({"code": 11000})
+
+
+def stale_key(user_id):
+    return (user_id, "/api/me", b"")
+
+
+HEADERS = [(b"content-type", b"application/json")]
+
+
+def test_stale_cache_is_bounded_by_bytes(clock):
+    cache = circuit_breaker.StaleCache(max_entries=100, max_bytes=3000, max_entry_bytes=2000)
+    for user_id in ("u1", "u2", "u3"):
+        cache.put(stale_key(user_id), HEADERS, b"x" * 1000)
+    assert cache.get(stale_key("u1")) is None
+    assert cache.get(stale_key("u2")) is not None
+    assert cache.get(stale_key("u3")) is not None
+    assert cache.used_bytes <= 3000
+
+
+def test_stale_cache_skips_large_bodies(clock):
+    cache = circuit_breaker.StaleCache(max_bytes=10000, max_entry_bytes=2000)
+    cache.put(stale_key("u1"), HEADERS, b"x" * 100)
+    cache.put(stale_key("u1"), HEADERS, b"x" * 5000)
+    # La respuesta anterior ya no es la última buena
+    assert cache.get(stale_key("u1")) is None
+    assert cache.used_bytes == 0
+
+
+def test_stale_cache_expires_entries(clock):
+    cache = circuit_breaker.StaleCache(max_age=60)
+    cache.put(stale_key("u1"), HEADERS, b"{}")
+    clock.now += 61
+    assert cache.get(stale_key("u1")) is None
+    assert cache.used_bytes == 0
@@ -0,0 +1,35 @@
+import json
+
+from tests.conftest import wait_notifications
+
+
+def export(client, headers, **params):
+    response = client.get("/api/export", params=params, headers=headers)
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_export_includes_the_couple_but_only_own_notifications(client, couple):
+    (author, author_id), (partner, partner_id) = couple
+    client.post("/api/activities", json={"description": "Cena", "category": "emotional"}, headers=author)
+    client.post("/api/mood", json={"mood_id": "happy", "mood_emoji": "😊"}, headers=author)
+    wait_notifications()
+    assert client.get("/api/notifications", headers=partner).json()["unread_count"] > 0
+
+    own = export(client, author)
+    assert {record["type"] for record in own} == {"activity", "mood", "end"}
+    assert not [record for record in own if record["type"] == "notification"]
+
+    records = export(client, partner)
+    notifications = [record["data"] for record in records if record["type"] == "notification"]
+    assert notifications and {item["user_id"] for item in notifications} == {partner_id}
+    assert {record["data"]["user_id"] for record in records if record["type"] == "activity"} == {author_id}
+
+
+def test_export_resumes_from_cursor(client, couple):
+    (author, _), _ = couple
+    for index in range(3):
+        client.post("/api/activities", json={"description": f"Acto {index}", "category": "emotional"}, headers=author)
+    records = export(client, author)
+    resumed = export(client, author, cursor=records[0]["cursor"])
+    assert [record["data"]["id"] for record in resumed[:-1]] == [record["data"]["id"] for record in records[1:-1]]
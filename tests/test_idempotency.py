@@ -0,0 +1,158 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+ACTIVITY = {"description": "Cena sorpresa", "category": "emotional"}
+USER = {"id": "u1"}
+
+
+def post_activity(client, headers, key, body=ACTIVITY):
+    return client.post("/api/activities", json=body, headers={**headers, "Idempotency-Key": key})
+
+
+def test_retry_replays_the_stored_response(client, couple, app_db):
+    (author, author_id), _ = couple
+    first = post_activity(client, author, "k1")
+    second = post_activity(client, author, "k1")
+    assert first.status_code == second.status_code == 200
+    assert "idempotent-replayed" not in first.headers
+    assert second.headers["idempotent-replayed"] == "true"
+    assert second.json() == first.json()
+    assert app_db.activities.count_documents({"user_id": author_id}) == 1
+
+
+def test_new_key_runs_again(client, couple, app_db):
+    (author, author_id), _ = couple
+    post_activity(client, author, "k1")
+    post_activity(client, author, "k2")
+    assert app_db.activities.count_documents({"user_id": author_id}) == 2
+
+
+def test_key_reused_with_another_body_is_rejected(client, couple, app_db):
+    (author, author_id), _ = couple
+    post_activity(client, author, "k1")
+    response = post_activity(client, author, "k1", {**ACTIVITY, "description": "Otra cosa"})
+    assert response.status_code == 422
+    assert app_db.activities.count_documents({"user_id": author_id}) == 1
+
+
+def test_keys_are_per_user(client, couple, app_db):
+    (author, author_id), (partner, partner_id) = couple
+    post_activity(client, author, "k1")
+    assert "idempotent-replayed" not in post_activity(client, partner, "k1").headers
+    assert app_db.activities.count_documents({"user_id": {"$in": [author_id, partner_id]}}) == 2
+
+
+def test_errors_are_not_stored(client, couple, app_db):
+    (author, _), _ = couple
+    headers = {**author, "Idempotency-Key": "k1"}
+    assert client.post("/api/mood", json={"mood_id": "", "mood_emoji": ""}, headers=headers).status_code == 400
+    assert app_db.idempotency_keys.count_documents({}) == 0
+    assert client.post("/api/mood", json={"mood_id": "", "mood_emoji": ""}, headers=headers).status_code == 400
+
+
+def test_in_progress_in_another_process_returns_409(client, couple, app_db, monkeypatch):
+    (author, author_id), _ = couple
+    monkeypatch.setattr(server, "IDEMPOTENCY_WAIT_SECONDS", 0.2)
+    first = post_activity(client, author, "k1")
+    record = app_db.idempotency_keys.find_one({})
+    # Otro worker reservó la clave hace un momento y aún no ha terminado
+    app_db.idempotency_keys.update_one(
+        {"_id": record["_id"]},
+        {"$set": {"status": "in_progress", "locked_at": datetime.now(timezone.utc)}, "$unset": {"response": ""}},
+    )
+    response = post_activity(client, author, "k1")
+    assert response.status_code == 409
+    assert first.status_code == 200
+    assert app_db.activities.count_documents({"user_id": author_id}) == 1
+
+
+def test_abandoned_key_is_taken_over(client, couple, app_db):
+    (author, author_id), _ = couple
+    post_activity(client, author, "k1")
+    record = app_db.idempotency_keys.find_one({})
+    stale = datetime.now(timezone.utc) - timedelta(seconds=server.IDEMPOTENCY_LOCK_SECONDS + 1)
+    app_db.idempotency_keys.update_one(
+        {"_id": record["_id"]},
+        {"$set": {"status": "in_progress", "locked_at": stale}, "$unset": {"response": ""}},
+    )
+    response = post_activity(client, author, "k1")
+    assert response.status_code == 200
+    assert "idempotent-replayed" not in response.headers
+    assert app_db.idempotency_keys.find_one({})["status"] == "completed"
+
+
+def test_concurrent_duplicates_share_one_execution(app_db):
+    calls = []
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def handler():
+            calls.append(1)
+            await release.wait()
+            return {"id": "a1"}
+
+        first = asyncio.ensure_future(server.run_idempotent("k1", USER, "test", {"x": 1}, handler))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(server.run_idempotent("k1", USER, "test", {"x": 1}, handler))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await first, await second
+
+    first, second = asyncio.run(scenario())
+    assert calls == [1]
+    assert first == {"id": "a1"}
+    assert second.headers["idempotent-replayed"] == "true"
+    assert not server.in_flight_idempotent_requests
+
+
+def test_waiter_retries_when_the_original_is_cancelled(app_db):
+    calls = []
+
+    async def scenario():
+        async def slow():
+            calls.append("slow")
+            await asyncio.sleep(10)
+
+        async def fast():
+            calls.append("fast")
+            return {"id": "a1"}
+
+        first = asyncio.ensure_future(server.run_idempotent("k1", USER, "test", {"x": 1}, slow))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(server.run_idempotent("k1", USER, "test", {"x": 1}, fast))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == {"id": "a1"}
+    assert calls == ["slow", "fast"]
+    assert app_db.idempotency_keys.find_one({})["status"] == "completed"
+
+
+def test_waiter_gives_up_at_the_deadline(app_db, monkeypatch):
+    monkeypatch.setattr(server, "IDEMPOTENCY_WAIT_SECONDS", 0.05)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def handler():
+            await release.wait()
+            return {"id": "a1"}
+
+        first = asyncio.ensure_future(server.run_idempotent("k1", USER, "test", {"x": 1}, handler))
+        await asyncio.sleep(0.01)
+        with pytest.raises(HTTPException) as rejected:
+            await server.run_idempotent("k1", USER, "test", {"x": 1}, handler)
+        release.set()
+        await first
+        return rejected.value
+
+    assert asyncio.run(scenario()).status_code == 409
@@ -0,0 +1,192 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import notification_retention as retention
+from tests.conftest import wait_notifications
+
+
+def add_notification(db, user_id, days_ago=0, read=False, **fields):
+    created_at = datetime.now(timezone.utc) - timedelta(days=days_ago)
+    document = {"id": f"n{db.notifications.estimated_document_count()}", "user_id": user_id,
+                "read": read, "created_at": created_at, **fields}
+    db.notifications.insert_one(document)
+    return document
+
+
+def counter(db, user_id):
+    return db.notification_counters.find_one({"_id": user_id})
+
+
+def test_new_counter_includes_existing_notifications(memory_db):
+    add_notification(memory_db, "u1")
+    add_notification(memory_db, "u1", read=True)
+    add_notification(memory_db, "u1")
+    retention.add_unread(memory_db, "u1", 1)
+    assert counter(memory_db, "u1")["unread"] == 2
+    assert counter(memory_db, "u1")["synced"]
+    assert retention.unread_count(memory_db, "u1") == 2
+
+
+def test_increments_after_the_first_one_do_not_count(memory_db):
+    retention.add_unread(memory_db, "u1", 1)  # sin notificación: se fija a las reales (0)
+    add_notification(memory_db, "u1")
+    retention.add_unread(memory_db, "u1", 1)
+    add_notification(memory_db, "u1")
+    retention.add_unread(memory_db, "u1", 1)
+    assert retention.unread_count(memory_db, "u1") == 2
+
+
+def test_unread_count_without_counter(memory_db):
+    add_notification(memory_db, "u1")
+    assert retention.unread_count(memory_db, "u1") == 1
+    assert counter(memory_db, "u1")["unread"] == 1
+    assert retention.unread_count(memory_db, "u2") == 0
+
+
+def test_unsynced_counter_is_recounted(memory_db):
+    # Contador de antes de version/synced
+    memory_db.notification_counters.insert_one({"_id": "u1", "unread": 9})
+    add_notification(memory_db, "u1")
+    assert retention.unread_count(memory_db, "u1") == 1
+    assert counter(memory_db, "u1")["unread"] == 1
+
+
+def test_sync_does_not_overwrite_concurrent_increments(memory_db, monkeypatch):
+    memory_db.notification_counters.insert_one({"_id": "u1", "unread": 0, "version": 0})
+    add_notification(memory_db, "u1")
+    count_documents = memory_db.notifications.count_documents
+
+    def count_while_another_write_lands(query, **kwargs):
+        # Otra escritura llega entre la lectura del contador y el conteo
+        memory_db.notification_counters.update_one({"_id": "u1"}, {"$inc": {"unread": 1, "version": 1}})
+        return count_documents(query, **kwargs)
+
+    monkeypatch.setattr(memory_db.notifications, "count_documents", count_while_another_write_lands)
+    assert retention._sync_counter(memory_db, "u1", attempts=2) is None
+    assert counter(memory_db, "u1")["unread"] == 2  # solo los $inc: el conteo no se aplicó
+
+
+def test_reconcile_fixes_drifted_counters(memory_db):
+    for user_id in ("u1", "u2", "u3"):
+        add_notification(memory_db, user_id)
+        retention.add_unread(memory_db, user_id, 1)
+    # Deriva: un $inc perdido, uno de más y un contador que quedó negativo
+    memory_db.notification_counters.update_one({"_id": "u1"}, {"$inc": {"unread": -1}})
+    memory_db.notification_counters.update_one({"_id": "u2"}, {"$inc": {"unread": 3}})
+    memory_db.notification_counters.update_one({"_id": "u3"}, {"$set": {"unread": -2}})
+    memory_db.notification_counters.insert_one({"_id": "u4", "unread": 5})
+
+    assert retention.reconcile_counters(memory_db, batch_size=2) == 4
+    assert [counter(memory_db, user_id)["unread"] for user_id in ("u1", "u2", "u3", "u4")] == [1, 1, 1, 0]
+    assert retention.reconcile_counters(memory_db) == 0
+
+
+def test_negative_counter_is_shown_as_zero(memory_db):
+    retention.add_unread(memory_db, "u1", 1)
+    retention.add_unread(memory_db, "u1", -3)
+    assert retention.unread_count(memory_db, "u1") == 0
+
+
+def test_mark_read_one_and_all(memory_db):
+    first = add_notification(memory_db, "u1")
+    for _ in range(2):
+        add_notification(memory_db, "u1")
+    retention.add_unread(memory_db, "u1", 3)
+
+    assert retention.mark_read(memory_db, "u1", first["id"]) == 1
+    assert retention.mark_read(memory_db, "u1", first["id"]) == 0
+    assert retention.unread_count(memory_db, "u1") == 2
+    assert memory_db.notifications.find_one({"id": first["id"]})["read_at"] is not None
+
+    assert retention.mark_read(memory_db, "u1") == 2
+    assert retention.unread_count(memory_db, "u1") == 0
+
+
+def test_archive_moves_old_unread(memory_db):
+    for _ in range(3):
+        add_notification(memory_db, "u1", days_ago=100)
+    add_notification(memory_db, "u2", days_ago=100)
+    recent = add_notification(memory_db, "u1", days_ago=1)
+    old_read = add_notification(memory_db, "u1", days_ago=100, read=True)
+    retention.add_unread(memory_db, "u1", 4)
+    retention.add_unread(memory_db, "u2", 1)
+
+    assert retention.archive_unread(memory_db, older_than_days=90, batch_size=2) == 4
+    assert memory_db.notifications_archive.count_documents({}) == 4
+    assert memory_db.notifications.count_documents({"read": False}) == 1
+    assert memory_db.notifications.find_one({"id": recent["id"]}) is not None
+    assert "read_at" in memory_db.notifications.find_one({"id": old_read["id"]})
+    assert retention.unread_count(memory_db, "u1") == 1
+    assert retention.unread_count(memory_db, "u2") == 0
+    assert retention.archive_unread(memory_db, older_than_days=90) == 0
+
+
+def test_archive_tolerates_copies_from_an_interrupted_run(memory_db):
+    old = add_notification(memory_db, "u1", days_ago=100)
+    retention.add_unread(memory_db, "u1", 1)
+    # Un intento anterior la copió pero no llegó a borrarla
+    memory_db.notifications_archive.insert_one(memory_db.notifications.find_one({"id": old["id"]}))
+    assert retention.archive_unread(memory_db, older_than_days=90) == 1
+    assert memory_db.notifications_archive.count_documents({}) == 1
+    assert retention.unread_count(memory_db, "u1") == 0
+
+
+def test_archiver_lease_lasts_the_interval(memory_db):
+    assert retention.claim_archiver_run(memory_db, 3600, "a")
+    assert not retention.claim_archiver_run(memory_db, 3600, "b")
+    assert not retention.claim_archiver_run(memory_db, 3600, "a")  # tampoco el mismo worker antes de tiempo
+    memory_db.job_leases.update_one(
+        {"_id": retention.ARCHIVER_LEASE}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    )
+    assert retention.claim_archiver_run(memory_db, 3600, "b")
+    assert memory_db.job_leases.find_one({"_id": retention.ARCHIVER_LEASE})["owner"] == "b"
+
+
+def test_archiver_skips_while_another_worker_holds_the_lease(memory_db, monkeypatch):
+    runs = []
+    monkeypatch.setattr(retention, "archive_unread", lambda db: runs.append("archive") or 0)
+    monkeypatch.setattr(retention, "reconcile_counters", lambda db: 0)
+    monkeypatch.setattr(retention, "random", SimpleNamespace(uniform=lambda low, high: 0))
+
+    async def scenario(interval):
+        task = asyncio.ensure_future(retention.run_archiver(memory_db, interval))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    retention.claim_archiver_run(memory_db, 3600, "otro")
+    asyncio.run(scenario(0.01))
+    assert runs == []
+
+    memory_db.job_leases.delete_many({})
+    asyncio.run(scenario(0.5))
+    assert runs == ["archive"]
+
+
+def test_ensure_indexes_updates_ttl(memory_db, monkeypatch):
+    assert retention.ensure_indexes(memory_db)
+    index = memory_db.notifications.index_information()[retention.READ_TTL_INDEX]
+    assert index["expireAfterSeconds"] == int(retention.NOTIFICATIONS_READ_TTL_DAYS * 86400)
+
+    monkeypatch.setattr(retention, "NOTIFICATIONS_READ_TTL_DAYS", 7)
+    assert retention.ensure_indexes(memory_db)
+    index = memory_db.notifications.index_information()[retention.READ_TTL_INDEX]
+    assert index["expireAfterSeconds"] == 7 * 86400
+
+
+def test_api_unread_count_and_read_all(client, couple):
+    (author, _), (partner, _) = couple
+    for index in range(3):
+        client.post("/api/activities", json={"description": f"Acto {index}", "category": "emotional"}, headers=author)
+    wait_notifications()
+
+    response = client.get("/api/notifications", headers=partner).json()
+    assert response["unread_count"] == 3
+    notification_id = response["notifications"][0]["id"]
+    assert client.put(f"/api/notifications/{notification_id}/read", headers=partner).status_code == 200
+    assert client.put("/api/notifications/desconocida/read", headers=partner).status_code == 404
+    assert client.get("/api/notifications", headers=partner).json()["unread_count"] == 2
+
+    assert client.put("/api/notifications/read-all", headers=partner).json()["marked"] == 2
+    assert client.get("/api/notifications", headers=partner).json()["unread_count"] == 0
@@ -0,0 +1,222 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import single_flight
+from single_flight import SingleFlight
+
+COUPLE = ("u1", "u2")
+
+
+class Query:
+    """compute() que cuenta sus llamadas y puede quedarse bloqueada hasta release()"""
+
+    def __init__(self, blocking=False):
+        self.calls = 0
+        self.started = threading.Event()
+        self._released = threading.Event()
+        if not blocking:
+            self._released.set()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self._released.wait(5)
+        return {"calls": self.calls}
+
+    def release(self):
+        self._released.set()
+
+
+async def wait_started(query):
+    assert await asyncio.to_thread(query.started.wait, 5)
+
+
+def test_couple_key_is_shared_by_both_members():
+    assert single_flight.couple_key({"id": "u2", "partner_id": "u1"}) == COUPLE
+    assert single_flight.couple_key({"id": "u1", "partner_id": "u2"}) == COUPLE
+    assert single_flight.couple_key({"id": "u3", "partner_id": None}) == ("u3",)
+
+
+def test_identical_reads_join_the_one_in_flight():
+    async def scenario():
+        flights = SingleFlight(ttl=60)
+        query = Query(blocking=True)
+        first = asyncio.ensure_future(flights.run("daily", COUPLE, ("2024-01-01",), query))
+        await wait_started(query)
+        second = asyncio.ensure_future(flights.run("daily", COUPLE, ("2024-01-01",), query))
+        await asyncio.sleep(0)
+        query.release()
+        results = await asyncio.gather(first, second)
+        assert query.calls == 1
+        assert results[0] is results[1]
+
+    asyncio.run(scenario())
+
+
+def test_different_params_do_not_join():
+    async def scenario():
+        flights = SingleFlight(ttl=60)
+        query = Query()
+        await flights.run("daily", COUPLE, ("2024-01-01",), query)
+        await flights.run("daily", COUPLE, ("2024-01-02",), query)
+        await flights.run("weekly", COUPLE, ("2024-01-01",), query)
+        assert query.calls == 3
+
+    asyncio.run(scenario())
+
+
+def test_result_is_reused_until_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(single_flight, "time", SimpleNamespace(monotonic=lambda: now[0]))
+
+    async def scenario():
+        flights = SingleFlight(ttl=1)
+        query = Query()
+        await flights.run("daily", COUPLE, (), query)
+        await flights.run("daily", COUPLE, (), query)
+        assert query.calls == 1
+        now[0] += 1
+        await flights.run("daily", COUPLE, (), query)
+        assert query.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_invalidate_drops_cached_result():
+    async def scenario():
+        flights = SingleFlight(ttl=60)
+        query = Query()
+        await flights.run("daily", COUPLE, (), query)
+        flights.invalidate("u2")
+        result = await flights.run("daily", COUPLE, (), query)
+        assert query.calls == 2
+        assert result == {"calls": 2}
+        # Otra pareja no se ve afectada
+        other = Query()
+        await flights.run("daily", ("u3",), (), other)
+        flights.invalidate("u1")
+        await flights.run("daily", ("u3",), (), other)
+        assert other.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_reads_after_a_write_do_not_join_earlier_flight():
+    async def scenario():
+        flights = SingleFlight(ttl=60)
+        before, after = Query(blocking=True), Query()
+        first = asyncio.ensure_future(flights.run("daily", COUPLE, (), before))
+        await wait_started(before)
+        flights.invalidate("u1")
+        assert await flights.run("daily", COUPLE, (), after) == {"calls": 1}
+        assert after.calls == 1
+        before.release()
+        await first
+
+    asyncio.run(scenario())
+
+
+def test_result_read_during_a_write_is_not_cached():
+    async def scenario():
+        flights = SingleFlight(ttl=60)
+        query = Query(blocking=True)
+        first = asyncio.ensure_future(flights.run("daily", COUPLE, (), query))
+        await wait_started(query)
+        flights.invalidate("u2")
+        query.release()
+        await first
+        await flights.run("daily", COUPLE, (), query)
+        assert query.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_errors_are_not_cached():
+    async def scenario():
+        flights = SingleFlight(ttl=60)
+        calls = []
+
+        def failing():
+            calls.append(1)
+            raise RuntimeError("sin conexión")
+
+        for _ in range(2):
+            try:
+                await flights.run("daily", COUPLE, (), failing)
+            except RuntimeError:
+                pass
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_caller_does_not_cancel_joined_readers():
+    async def scenario():
+        flights = SingleFlight(ttl=60)
+        query = Query(blocking=True)
+        first = asyncio.ensure_future(flights.run("daily", COUPLE, (), query))
+        await wait_started(query)
+        second = asyncio.ensure_future(flights.run("daily", COUPLE, (), query))
+        await asyncio.sleep(0)
+        first.cancel()
+        query.release()
+        assert await second == {"calls": 1}
+
+    asyncio.run(scenario())
+
+
+def test_cache_is_bounded():
+    async def scenario():
+        flights = SingleFlight(ttl=60, max_entries=2)
+        query = Query()
+        for day in ("01", "02", "03"):
+            await flights.run("daily", COUPLE, (day,), query)
+        await flights.run("daily", COUPLE, ("01",), query)
+        assert query.calls == 4
+
+    asyncio.run(scenario())
+
+
+def test_idle_generations_are_forgotten(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(single_flight, "time", SimpleNamespace(monotonic=lambda: now[0]))
+
+    async def scenario():
+        flights = SingleFlight(ttl=1)
+        query = Query()
+        flights.invalidate("u1")
+        now[0] += 1.5
+        await flights.run("daily", COUPLE, (), query)
+        flights.invalidate("u3")
+        assert list(flights._generations) == ["u3"]
+        await flights.run("daily", COUPLE, (), query)
+        assert query.calls == 2  # sin su generación, lo guardado no coincide
+        # Una escritura posterior nunca repite una generación anterior
+        flights.invalidate("u1")
+        assert await flights.run("daily", COUPLE, (), query) == {"calls": 3}
+
+    asyncio.run(scenario())
+
+
+def test_generation_is_kept_while_a_read_is_in_flight(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(single_flight, "time", SimpleNamespace(monotonic=lambda: now[0]))
+
+    async def scenario():
+        flights = SingleFlight(ttl=1)
+        before = Query(blocking=True)
+        first = asyncio.ensure_future(flights.run("daily", COUPLE, (), before))
+        await wait_started(before)
+        flights.invalidate("u1")
+        now[0] += 1.5
+        flights.invalidate("u3")
+        assert "u1" in flights._generations
+        before.release()
+        await first
+        # Lo leído antes de la escritura no se guardó
+        after = Query()
+        await flights.run("daily", COUPLE, (), after)
+        assert after.calls == 1
+
+    asyncio.run(scenario())
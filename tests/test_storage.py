@@ -0,0 +1,199 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+import storage
+
+
+@pytest.fixture
+def moods(memory_db):
+    return memory_db.moods
+
+
+def ids(docs):
+    return [doc["id"] for doc in docs]
+
+
+# Índices únicos
+
+def test_unique_index_rejects_duplicates(moods):
+    moods.create_index([("user_id", ASCENDING), ("date", ASCENDING)], unique=True)
+    moods.insert_one({"id": "m1", "user_id": "u1", "date": "2026-10-01"})
+    moods.insert_one({"id": "m2", "user_id": "u1", "date": "2026-10-02"})
+    with pytest.raises(DuplicateKeyError):
+        moods.insert_one({"id": "m3", "user_id": "u1", "date": "2026-10-01"})
+    # Una actualización que choca con otra clave tampoco se aplica
+    with pytest.raises(DuplicateKeyError):
+        moods.update_one({"id": "m2"}, {"$set": {"date": "2026-10-01"}})
+    assert moods.find_one({"id": "m2"})["date"] == "2026-10-02"
+    assert moods.count_documents({}) == 2
+
+
+def test_unique_index_on_insert_many(moods):
+    moods.create_index("id", unique=True)
+    with pytest.raises(BulkWriteError) as error:
+        moods.insert_many([{"id": "a"}, {"id": "a"}, {"id": "b"}], ordered=False)
+    assert error.value.details["nInserted"] == 2
+    assert sorted(ids(moods.find())) == ["a", "b"]
+
+
+def test_unique_index_over_existing_duplicates_fails(moods):
+    moods.insert_many([{"id": "a"}, {"id": "a"}])
+    with pytest.raises(DuplicateKeyError):
+        moods.create_index("id", unique=True)
+    assert "id_1" not in moods.index_information()
+
+
+def test_partial_unique_index_only_covers_matching_documents(moods):
+    moods.create_index("user_id", unique=True, partialFilterExpression={"active": True})
+    moods.insert_many([{"id": "m1", "user_id": "u1", "active": False}, {"id": "m2", "user_id": "u1", "active": False}])
+    moods.insert_one({"id": "m3", "user_id": "u1", "active": True})
+    with pytest.raises(DuplicateKeyError):
+        moods.insert_one({"id": "m4", "user_id": "u1", "active": True})
+    with pytest.raises(DuplicateKeyError):
+        moods.update_one({"id": "m1"}, {"$set": {"active": True}})
+    # Al salir del filtro deja libre la clave
+    moods.update_one({"id": "m3"}, {"$set": {"active": False}})
+    moods.update_one({"id": "m1"}, {"$set": {"active": True}})
+    assert ids(moods.find({"user_id": "u1", "active": True})) == ["m1"]
+    assert moods.index_information()["user_id_1"]["partialFilterExpression"] == {"active": True}
+
+
+def test_index_options_conflicts_and_unsupported(moods):
+    moods.create_index("created_at", expireAfterSeconds=60, name="ttl")
+    assert moods.create_index("created_at", expireAfterSeconds=60, name="ttl") == "ttl"
+    with pytest.raises(OperationFailure) as error:
+        moods.create_index("created_at", expireAfterSeconds=120, name="ttl")
+    assert error.value.code == 85
+    with pytest.raises(OperationFailure) as error:
+        moods.create_index("date", name="ttl")
+    assert error.value.code == 86
+    with pytest.raises(OperationFailure):
+        moods.create_index("date", sparse=True)
+    assert "date_1" not in moods.index_information()
+
+
+def test_unsupported_command(memory_db):
+    assert memory_db.command("ping") == {"ok": 1.0}
+    with pytest.raises(OperationFailure) as error:
+        memory_db.command("dbStats")
+    assert error.value.code == 59
+
+
+# Consultas por rango sobre índices ordenados
+
+@pytest.fixture
+def activities(memory_db):
+    base = datetime(2026, 10, 1)
+    memory_db.activities.create_index([("user_id", ASCENDING), ("created_at", DESCENDING)])
+    for day in range(10):
+        for user_id in ("u1", "u2"):
+            memory_db.activities.insert_one({"id": f"{user_id}-{day}", "user_id": user_id, "rating": day % 5,
+                                             "created_at": base + timedelta(days=day)})
+    return memory_db.activities
+
+
+def test_range_on_indexed_prefix(activities):
+    base = datetime(2026, 10, 1)
+    found = activities.find({"user_id": "u1", "created_at": {"$gte": base + timedelta(days=2),
+                                                             "$lt": base + timedelta(days=5)}})
+    assert sorted(ids(found)) == ["u1-2", "u1-3", "u1-4"]
+    found = activities.find({"user_id": "u2", "created_at": {"$gt": base + timedelta(days=7)}})
+    assert sorted(ids(found)) == ["u2-8", "u2-9"]
+    assert activities.count_documents({"user_id": {"$in": ["u1", "u2"]}, "created_at": {"$lte": base}}) == 2
+
+
+def test_range_uses_the_index(activities, monkeypatch):
+    examined = []
+    matches = storage.matches
+
+    def counting(doc, query):
+        examined.append(doc["id"])
+        return matches(doc, query)
+
+    monkeypatch.setattr(storage, "matches", counting)
+    assert activities.count_documents({"user_id": "u1", "created_at": {"$gte": datetime(2026, 10, 9)}}) == 2
+    assert sorted(examined) == ["u1-8", "u1-9"]
+
+
+def test_range_with_other_filters_and_sort(activities):
+    found = activities.find({"user_id": "u1", "created_at": {"$gte": datetime(2026, 10, 3)}, "rating": {"$gte": 3}})
+    assert ids(found.sort("created_at", DESCENDING)) == ["u1-9", "u1-8", "u1-4", "u1-3"]
+
+
+def test_indexes_follow_updates_and_deletes(activities):
+    activities.update_one({"id": "u1-0"}, {"$set": {"created_at": datetime(2026, 12, 1)}})
+    activities.delete_one({"id": "u1-9"})
+    found = activities.find({"user_id": "u1", "created_at": {"$gte": datetime(2026, 10, 9)}})
+    assert sorted(ids(found)) == ["u1-0", "u1-8"]
+
+
+def test_mixed_types_compare_in_bson_order(memory_db):
+    memory_db.items.create_index("value")
+    for index, value in enumerate([None, 3, "b", 1.5, "a", datetime(2026, 1, 1)]):
+        memory_db.items.insert_one({"id": str(index), "value": value})
+    # Los rangos no cruzan de tipo: $gte 1 no incluye cadenas ni fechas
+    assert sorted(doc["value"] for doc in memory_db.items.find({"value": {"$gte": 1}})) == [1.5, 3]
+    assert [doc["value"] for doc in memory_db.items.find().sort("value", ASCENDING)] == \
+        [None, 1.5, 3, "a", "b", datetime(2026, 1, 1)]
+
+
+# Operadores de actualización
+
+def test_update_operators(memory_db):
+    memory_db.stats.insert_one({"_id": "u1", "counts": {"moods": 1}, "tags": ["a"], "old": True})
+    result = memory_db.stats.update_one({"_id": "u1"}, {
+        "$set": {"counts.activities": 2}, "$inc": {"counts.moods": 2, "version": 1},
+        "$unset": {"old": ""}, "$push": {"tags": "b"}, "$setOnInsert": {"created": True},
+    })
+    assert (result.matched_count, result.modified_count) == (1, 1)
+    assert memory_db.stats.find_one({"_id": "u1"}) == {
+        "_id": "u1", "counts": {"moods": 3, "activities": 2}, "tags": ["a", "b"], "version": 1,
+    }
+    # Sin cambios reales no cuenta como modificado
+    assert memory_db.stats.update_one({"_id": "u1"}, {"$set": {"version": 1}}).modified_count == 0
+
+
+def test_upsert_copies_equality_fields(memory_db):
+    result = memory_db.counters.update_one(
+        {"_id": "u1", "kind": {"$eq": "unread"}, "unread": {"$gte": 0}},
+        {"$inc": {"unread": 1}, "$setOnInsert": {"synced": False}}, upsert=True,
+    )
+    assert result.upserted_id == "u1"
+    assert memory_db.counters.find_one({"_id": "u1"}) == {"_id": "u1", "kind": "unread", "unread": 1, "synced": False}
+    memory_db.counters.update_one({"_id": "u1"}, {"$inc": {"unread": 1}, "$setOnInsert": {"synced": True}}, upsert=True)
+    assert memory_db.counters.find_one({"_id": "u1"})["synced"] is False
+
+
+def test_find_one_and_update(memory_db):
+    memory_db.leases.insert_one({"_id": "feed", "owner": "a"})
+    before = memory_db.leases.find_one_and_update({"_id": "feed"}, {"$set": {"owner": "b"}})
+    assert before["owner"] == "a"
+    after = memory_db.leases.find_one_and_update({"_id": "feed"}, {"$set": {"owner": "c"}},
+                                                 return_document=ReturnDocument.AFTER, projection={"_id": 0})
+    assert after == {"owner": "c"}
+    assert memory_db.leases.find_one_and_update({"_id": "other"}, {"$set": {"owner": "a"}}) is None
+    created = memory_db.leases.find_one_and_update({"_id": "other"}, {"$set": {"owner": "a"}}, upsert=True,
+                                                   return_document=ReturnDocument.AFTER)
+    assert created == {"_id": "other", "owner": "a"}
+
+
+def test_invalid_updates_are_rejected(memory_db):
+    memory_db.stats.insert_one({"_id": "u1"})
+    with pytest.raises(OperationFailure):
+        memory_db.stats.update_one({"_id": "u1"}, {"version": 1})
+    with pytest.raises(OperationFailure):
+        memory_db.stats.update_one({"_id": "u1"}, {"$rename": {"a": "b"}})
+
+
+def test_ttl_index_purges_expired_documents(memory_db, monkeypatch):
+    memory_db.keys.create_index("created_at", expireAfterSeconds=60)
+    now = datetime.now(timezone.utc)
+    memory_db.keys.insert_many([{"id": "old", "created_at": now - timedelta(seconds=120)},
+                                {"id": "new", "created_at": now}])
+    monkeypatch.setattr(storage, "TTL_MONITOR_SECONDS", 0)
+    memory_db.keys._next_ttl_check = 0.0
+    assert memory_db.keys.count_documents({}) == 1
+    assert ids(memory_db.keys.find()) == ["new"]
@@ -0,0 +1,160 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import run
+import view_cache
+from view_cache import MemoryCacheClient, ViewCache
+
+
+class Compute:
+    """compute() de una vista que cuenta cuántas veces se calculó"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        return {"calls": self.calls}
+
+
+@pytest.fixture
+def views(monkeypatch):
+    monkeypatch.setattr(view_cache, "VIEW_CACHE_ENABLED", True)
+    return ViewCache(MemoryCacheClient(), ttls={"achievements": 60, "correlation": 60})
+
+
+ACHIEVEMENT_TAGS = [("activities", "u1"), ("activities", "u2"), ("user_stats", "u1")]
+CORRELATION_TAGS = [("activities", "u1"), ("moods", "u1")]
+
+
+def test_second_read_is_a_hit(views):
+    async def scenario():
+        compute = Compute()
+        assert await views.get_or_compute("achievements", ("u1",), ACHIEVEMENT_TAGS, compute) == {"calls": 1}
+        assert await views.get_or_compute("achievements", ("u1",), ACHIEVEMENT_TAGS, compute) == {"calls": 1}
+        assert compute.calls == 1
+        stats = await views.stats()
+        assert stats["views"]["achievements"] == {"hits": 1, "misses": 1, "hit_ratio": 0.5}
+
+    asyncio.run(scenario())
+
+
+def test_params_are_part_of_the_key(views):
+    async def scenario():
+        compute = Compute()
+        await views.get_or_compute("achievements", ("u1",), ACHIEVEMENT_TAGS, compute)
+        await views.get_or_compute("achievements", ("u2",), ACHIEVEMENT_TAGS, compute)
+        assert compute.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_invalidate_only_recomputes_dependent_views(views):
+    async def scenario():
+        achievements, correlation = Compute(), Compute()
+        await views.get_or_compute("achievements", ("u1",), ACHIEVEMENT_TAGS, achievements)
+        await views.get_or_compute("correlation", ("u1",), CORRELATION_TAGS, correlation)
+
+        await views.invalidate("moods", "u1")
+        await views.get_or_compute("achievements", ("u1",), ACHIEVEMENT_TAGS, achievements)
+        await views.get_or_compute("correlation", ("u1",), CORRELATION_TAGS, correlation)
+        assert (achievements.calls, correlation.calls) == (1, 2)
+
+        # Una escritura de la pareja invalida lo que depende de sus datos
+        await views.invalidate("activities", "u2")
+        await views.get_or_compute("achievements", ("u1",), ACHIEVEMENT_TAGS, achievements)
+        await views.get_or_compute("correlation", ("u1",), CORRELATION_TAGS, correlation)
+        assert (achievements.calls, correlation.calls) == (2, 2)
+
+    asyncio.run(scenario())
+
+
+def test_missing_user_ids_are_ignored(views):
+    async def scenario():
+        compute = Compute()
+        tags = [("activities", "u1"), ("activities", None)]
+        await views.get_or_compute("achievements", ("u1",), tags, compute)
+        await views.invalidate("activities", None)
+        await views.get_or_compute("achievements", ("u1",), tags, compute)
+        assert compute.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_disabled_cache_always_computes(views, monkeypatch):
+    monkeypatch.setattr(view_cache, "VIEW_CACHE_ENABLED", False)
+
+    async def scenario():
+        compute = Compute()
+        await views.get_or_compute("achievements", ("u1",), ACHIEVEMENT_TAGS, compute)
+        await views.get_or_compute("achievements", ("u1",), ACHIEVEMENT_TAGS, compute)
+        assert compute.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_unavailable_store_computes_without_cache(views):
+    class BrokenClient(MemoryCacheClient):
+        async def mget(self, *keys):
+            raise ConnectionError("sin redis")
+
+    views.client = BrokenClient()
+
+    async def scenario():
+        compute = Compute()
+        assert await views.get_or_compute("achievements", ("u1",), ACHIEVEMENT_TAGS, compute) == {"calls": 1}
+        await views.get_or_compute("achievements", ("u1",), ACHIEVEMENT_TAGS, compute)
+        assert compute.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_memory_client_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(view_cache, "time", SimpleNamespace(monotonic=lambda: now[0]))
+
+    async def scenario():
+        client = MemoryCacheClient()
+        await client.set("k", "v", ex=10)
+        assert await client.get("k") == b"v"
+        assert await client.set("k", "w", nx=True) is None
+        now[0] += 10
+        assert await client.get("k") is None
+        assert client.used_bytes == 0
+
+    asyncio.run(scenario())
+
+
+def test_memory_client_evicts_least_recently_used():
+    async def scenario():
+        client = MemoryCacheClient(max_bytes=20)
+        await client.set("a", "123456789")
+        await client.set("b", "123456789")
+        await client.get("a")
+        await client.set("c", "123456789")
+        assert await client.mget("a", "b", "c") == [b"123456789", None, b"123456789"]
+        info = await client.info()
+        assert info["evicted_keys"] == 1
+        assert info["used_memory"] <= 20
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("environment, disabled", [
+    ({}, True),
+    ({"VIEW_CACHE_BACKEND": "redis"}, False),
+    ({"CHANGE_FEED_MODE": "stream"}, False),
+    ({"VIEW_CACHE_ENABLED": "0"}, True),
+])
+def test_run_disables_memory_cache_with_several_inline_workers(monkeypatch, environment, disabled):
+    for name in ("VIEW_CACHE_ENABLED", "VIEW_CACHE_BACKEND", "CHANGE_FEED_MODE"):
+        monkeypatch.delenv(name, raising=False)
+    for name, value in environment.items():
+        monkeypatch.setenv(name, value)
+    run.check_view_cache(1)
+    assert os.environ.get("VIEW_CACHE_ENABLED", "1") == environment.get("VIEW_CACHE_ENABLED", "1")
+    run.check_view_cache(4)
+    assert (os.environ.get("VIEW_CACHE_ENABLED", "1") == "0") == disabled